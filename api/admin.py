@@ -2,7 +2,7 @@ from django.contrib import admin
 from django_admin_relation_links import AdminChangeLinksMixin
 from django.contrib.auth.models import Group, User
 from django.contrib.auth.admin import UserAdmin
-from api.models import Order, LNPayment, Profile, MarketTick, Currency
+from api.models import Order, LNPayment, Profile, MarketTick, Currency, RateHistory
 
 admin.site.unregister(Group)
 admin.site.unregister(User)
@@ -142,6 +142,13 @@ class CurrencieAdmin(admin.ModelAdmin):
     readonly_fields = ("currency", "exchange_rate", "timestamp")
     ordering = ("id", )
 
+@admin.register(RateHistory)
+class RateHistoryAdmin(admin.ModelAdmin):
+    list_display = ("timestamp", "currency", "rate")
+    readonly_fields = ("timestamp", "currency", "rate")
+    list_filter = ["currency"]
+    ordering = ("-timestamp", )
+
 @admin.register(MarketTick)
 class MarketTickAdmin(admin.ModelAdmin):
     list_display = ("timestamp", "price", "volume", "premium", "currency",
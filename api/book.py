@@ -0,0 +1,194 @@
+from django.core.cache import cache
+from django.db.models import Case, F, PositiveBigIntegerField, Value, When
+
+import numpy as np
+
+from api.models import Order, Currency
+from api.serializers import ListOrderSerializer
+from api.logics import Logics
+from api import presence
+
+#######
+# Order book snapshots. The serialized public orders of every (currency, type)
+# are kept in the cache, so BookView does not touch the database. A snapshot is
+# rebuilt when one of its orders enters or leaves the book (see the Order
+# post_save receiver in models.py) and all of them after cache_market refreshes
+# the exchange rates (prices and premiums depend on them).
+#
+# The maker activity status is computed when serving, from the presence
+# heartbeats (api/presence.py). The number of orders and satoshis of every
+# snapshot are kept next to it for InfoView.
+#
+# Before that, reprice() brings the satoshis of every premium priced order in
+# the book up to date with the new rates, in one NumPy pass and one bulk UPDATE.
+#######
+
+
+def book_key(currency, type):
+    return f"book_{currency}_{type}"
+
+
+def stats_key(currency, type):
+    return f"book_stats_{currency}_{type}"
+
+
+def book_entry(order):
+    """What BookView shows of an order, plus the maker last seen time"""
+
+    data = dict(ListOrderSerializer(order).data)
+    data["maker_nick"] = str(order.maker)
+
+    # Compute current premium for those orders that are explicitly priced.
+    data["price"], data["premium"] = Logics.price_and_premium_now(order)
+    for key in ("status", "taker"):  # Non participants should not see the status or who is the taker
+        del data[key]
+
+    return {"data": data, "maker_last_seen": order.maker_last_seen}
+
+
+def reprice(rates):
+    """Recomputes Logics.satoshis_now of the public and paused orders priced by
+    premium with `rates` (by currency id) and saves it as their last_satoshis.
+    Orders of currencies without a rate, or no longer public or paused by the
+    time of writing, are left as they are. No signals are sent.
+    Returns the number of orders updated."""
+
+    rows = list(
+        Order.objects.filter(
+            status__in=[Order.Status.PUB, Order.Status.PAU],
+            is_explicit=False).values_list("id", "currency", "amount",
+                                           "max_amount", "premium",
+                                           "last_satoshis"))
+    if len(rows) == 0 or len(rates) == 0:
+        return 0
+
+    ids, currencies, amounts, max_amounts, premiums, last_satoshis = zip(*rows)
+    amounts = np.array(amounts, dtype=float)  # None is NaN
+    amounts = np.where(np.isnan(amounts), np.array(max_amounts, dtype=float), amounts)
+    last_satoshis = np.array(last_satoshis, dtype=float)
+
+    # Rate of every order, from a table indexed by currency id
+    table = np.full(max(max(rates), max(currencies)) + 1, np.nan)
+    table[list(rates.keys())] = list(rates.values())
+    rates = table[np.array(currencies)]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        premium_rates = rates * (1 + np.array(premiums, dtype=float) / 100)
+        satoshis = np.trunc(amounts / premium_rates * 100 * 1000 * 1000)
+        changed = np.isfinite(satoshis) & (satoshis != last_satoshis)
+
+    # Only while still public or paused. An order taken meanwhile has its trade
+    # amount fixed in last_satoshis, it must not be overwritten.
+    updates = list(zip(np.array(ids)[changed].tolist(),
+                       satoshis[changed].astype(np.int64).tolist()))
+    num_updated = 0
+    for start in range(0, len(updates), 1000):
+        batch = updates[start:start + 1000]
+        num_updated += Order.objects.filter(
+            id__in=[id for id, _ in batch],
+            status__in=[Order.Status.PUB, Order.Status.PAU],
+        ).update(last_satoshis=Case(
+            *[When(id=id, then=Value(sats)) for id, sats in batch],
+            default=F("last_satoshis"),
+            output_field=PositiveBigIntegerField()))
+    return num_updated
+
+
+def rebuild(currency=None, type=None):
+    """Rebuilds the snapshot of one (currency, type) or all of them.
+    Returns the snapshots written, by key."""
+
+    queryset = Order.objects.filter(status=Order.Status.PUB).select_related(
+        "maker", "currency").order_by("id")
+    if currency != None:
+        queryset = queryset.filter(currency=currency, type=type)
+        pairs = [(currency, type)]
+    else:
+        pairs = [(int(currency), type)
+                 for currency in Currency.currency_dict.keys()
+                 for type in Order.Types.values]
+    books = {book_key(c, t): [] for c, t in pairs}
+    stats = {stats_key(c, t): {"num_orders": 0, "liquidity": 0} for c, t in pairs}
+
+    for order in queryset:
+        books.setdefault(book_key(order.currency_id, order.type),
+                         []).append(book_entry(order))
+        book_stats = stats.setdefault(stats_key(order.currency_id, order.type),
+                                      {"num_orders": 0, "liquidity": 0})
+        book_stats["num_orders"] += 1
+        book_stats["liquidity"] += order.last_satoshis or 0
+
+    cache.set_many({**books, **stats}, timeout=None)
+    return books
+
+
+def book_stats():
+    """Number of public orders by type and their total satoshis, summed
+    over the per (currency, type) totals kept next to the snapshots."""
+
+    pairs = [(int(c), t) for c in Currency.currency_dict.keys()
+             for t in Order.Types.values]
+    stats = cache.get_many([stats_key(c, t) for c, t in pairs])
+    if len(stats) < len(pairs):
+        rebuild()
+        stats = cache.get_many([stats_key(c, t) for c, t in pairs])
+
+    num_orders = {t: 0 for t in Order.Types.values}
+    liquidity = 0
+    for c, t in pairs:
+        entry = stats.get(stats_key(c, t), {"num_orders": 0, "liquidity": 0})
+        num_orders[t] += entry["num_orders"]
+        liquidity += entry["liquidity"]
+    return num_orders, liquidity
+
+
+def get_book(currency, type):
+    """Public orders of a currency and type. Currency 0 and type 2 are "ANY".
+    Unknown currencies and types have no orders, and no snapshot is written
+    for them (it would never be refreshed nor expire)."""
+
+    currencies = [int(c) for c in Currency.currency_dict.keys()]
+    if int(currency) != 0:
+        if int(currency) not in currencies:
+            return []
+        currencies = [int(currency)]
+    types = Order.Types.values
+    if int(type) != 2:
+        if int(type) not in types:
+            return []
+        types = [int(type)]
+
+    pairs = [(c, t) for c in currencies for t in types]
+    books = cache.get_many([book_key(c, t) for c, t in pairs])
+
+    # Cold cache (e.g. after a restart). Missing ones are rebuilt once.
+    missing = [(c, t) for c, t in pairs if book_key(c, t) not in books]
+    if len(missing) == len(pairs) and len(pairs) > 1:
+        books = rebuild()
+    else:
+        for c, t in missing:
+            books.update(rebuild(c, t))
+
+    entries = []
+    for c, t in pairs:
+        entries += books.get(book_key(c, t), [])
+    if len(pairs) > 1:
+        entries.sort(key=lambda entry: entry["data"]["id"])
+
+    # Makers that polled their order lately, the snapshot does not follow those
+    seen = presence.heartbeats([entry["data"]["id"] for entry in entries],
+                               "maker")
+
+    book_data = []
+    for entry in entries:
+        data = dict(entry["data"])
+        data["maker_status"] = maker_status(
+            seen.get(data["id"], entry["maker_last_seen"]))
+        book_data.append(data)
+    return book_data
+
+
+def maker_status(last_seen):
+    if last_seen == None:
+        return "Inactive"
+    return Logics.user_activity_status(last_seen)
@@ -0,0 +1,53 @@
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from rest_framework.renderers import JSONRenderer
+
+
+class OrderConsumer(AsyncWebsocketConsumer):
+    """Pushes the OrderView.get payload to a robot every time the order
+    changes (see push_order_update in models.py), instead of being polled."""
+
+    @database_sync_to_async
+    def get_order_payload(self):
+        from api.views import OrderView
+        from api import presence
+
+        order = OrderView.order_queryset().filter(id=self.order_id).first()
+        if order == None:
+            return {"bad_request": "Invalid Order Id"}
+
+        # A robot following its order over the websocket is present, as when polling
+        if order.maker_id == self.user.id:
+            presence.heartbeat(order, "maker")
+        if order.taker_id == self.user.id:
+            presence.heartbeat(order, "taker")
+
+        data, _ = OrderView.order_payload(order, self.user)
+        return data
+
+    async def connect(self):
+        self.order_id = self.scope["url_route"]["kwargs"]["order_id"]
+        self.group_name = f"order_{self.order_id}"
+        self.user = self.scope["user"]
+
+        if not self.user.is_authenticated:
+            print("Robot avatar needed to follow an order")
+            await self.close()
+            return
+
+        await self.channel_layer.group_add(self.group_name,
+                                           self.channel_name)
+        await self.accept()
+        await self.send_order()
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(self.group_name,
+                                               self.channel_name)
+
+    async def order_update(self, event):
+        await self.send_order()
+
+    async def send_order(self):
+        # Every robot gets its own view of the order (maker, taker or other)
+        data = await self.get_order_payload()
+        await self.send(text_data=JSONRenderer().render(data).decode())
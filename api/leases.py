@@ -0,0 +1,83 @@
+from django.db import connection
+
+import hashlib
+import math
+import random
+
+#######
+# Splits work between replicas of a background command with Postgres session
+# advisory locks. Every replica holds one "member" lock, so the number of live
+# replicas can be counted, and one lock per partition it owns. Locks die with the
+# session, so the partitions of a replica that crashed are free for the others
+# on their next rebalance, and replicas that own more than their fair share
+# hand the extra partitions over.
+#######
+
+
+def lock_key(name):
+    """Positive int4 derived from a name, used as advisory lock class id"""
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:4],
+                          "big") & 0x7FFFFFFF
+
+
+class PartitionLeases:
+
+    max_members = 256
+
+    def __init__(self, name, partitions=16):
+        self.partitions = partitions
+        self.members_key = lock_key(f"{name}:members")
+        self.partitions_key = lock_key(f"{name}:partitions")
+
+    def held(self, cursor, key):
+        """Lock ids of `key` held by this session"""
+        cursor.execute(
+            """SELECT objid FROM pg_locks
+            WHERE locktype = 'advisory' AND granted AND objsubid = 2
+            AND classid = %s AND pid = pg_backend_pid()""", [key])
+        return set([row[0] for row in cursor.fetchall()])
+
+    def count_members(self, cursor):
+        cursor.execute(
+            """SELECT count(*) FROM pg_locks
+            WHERE locktype = 'advisory' AND granted AND objsubid = 2
+            AND classid = %s
+            AND database = (SELECT oid FROM pg_database WHERE datname = current_database())""",
+            [self.members_key])
+        return cursor.fetchone()[0]
+
+    def try_lock(self, cursor, key, id):
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", [key, id])
+        return cursor.fetchone()[0]
+
+    def unlock(self, cursor, key, id):
+        cursor.execute("SELECT pg_advisory_unlock(%s, %s)", [key, id])
+
+    def rebalance(self):
+        """Joins (again, if the connection was lost), takes free partitions up
+        to a fair share and releases those above it. Returns the owned partitions."""
+
+        with connection.cursor() as cursor:
+            if len(self.held(cursor, self.members_key)) == 0:
+                for slot in range(self.max_members):
+                    if self.try_lock(cursor, self.members_key, slot):
+                        break
+
+            members = max(self.count_members(cursor), 1)
+            fair_share = math.ceil(self.partitions / members)
+            owned = self.held(cursor, self.partitions_key)
+
+            for partition in sorted(owned)[fair_share:]:
+                self.unlock(cursor, self.partitions_key, partition)
+                owned.discard(partition)
+
+            # Random order, so joining replicas do not all fight over the same ones
+            free = [p for p in range(self.partitions) if p not in owned]
+            random.shuffle(free)
+            for partition in free:
+                if len(owned) >= fair_share:
+                    break
+                if self.try_lock(cursor, self.partitions_key, partition):
+                    owned.add(partition)
+
+        return owned
@@ -0,0 +1,48 @@
+import grpc
+
+from .node import (
+    LNNode,
+    LND_GRPC_HOST,
+    MACAROON_METADATA,
+    CHANNEL_OPTIONS,
+    DEADLINES,
+)
+from . import invoices_pb2 as invoicesrpc, invoices_pb2_grpc as invoicesstub
+
+#######
+# asyncio (grpc.aio) flavour of LNNode for the long running followers, where
+# thousands of concurrent calls and streams are cheap coroutines instead of threads.
+# Django views and Logics keep using the blocking LNNode facade, which shares the
+# same channel options (keepalives, retry policy), metadata and deadlines.
+#######
+
+
+class AsyncLNNode:
+
+    def __init__(self):
+        """grpc.aio channels are bound to the event loop they are created in,
+        so instances must be created inside the loop that will use them."""
+
+        self.channel = grpc.aio.secure_channel(LND_GRPC_HOST,
+                                               LNNode.creds,
+                                               options=CHANNEL_OPTIONS)
+        self.invoicesstub = invoicesstub.InvoicesStub(self.channel)
+
+    async def close(self):
+        await self.channel.close()
+
+    async def lookup_invoice(self, payment_hash, timeout=None):
+        request = invoicesrpc.LookupInvoiceMsg(
+            payment_hash=bytes.fromhex(payment_hash))
+        return await self.invoicesstub.LookupInvoiceV2(
+            request,
+            metadata=MACAROON_METADATA,
+            timeout=timeout or DEADLINES["LookupInvoiceV2"])
+
+    def subscribe_single_invoice(self, payment_hash):
+        """Stream of invoice updates. Starts with the current state.
+        No deadline: the stream lives as long as the invoice is open."""
+        request = invoicesrpc.SubscribeSingleInvoiceRequest(
+            r_hash=bytes.fromhex(payment_hash))
+        return self.invoicesstub.SubscribeSingleInvoice(
+            request, metadata=MACAROON_METADATA)
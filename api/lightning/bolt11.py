@@ -0,0 +1,423 @@
+import hashlib, secrets
+from collections import namedtuple
+from functools import lru_cache
+
+#######
+# Pure python BOLT11 (lightning payment request) decoder.
+# Replaces the LND DecodePayReq round trip when RoboSats generates hold invoices
+# or validates the invoices submitted by users. The result mirrors the fields of
+# LND's PayReq message that RoboSats uses, so it can be used as a drop in.
+#
+# The signature is used to recover the payee (destination) when the invoice has
+# no explicit `n` field, but it is not otherwise verified: LND does that anyway
+# before paying.
+#######
+
+PayReq = namedtuple("PayReq", [
+    "destination",
+    "payment_hash",
+    "num_satoshis",
+    "num_msat",
+    "timestamp",
+    "expiry",
+    "description",
+    "description_hash",
+    "cltv_expiry",
+    "route_hints",
+    "payment_addr",
+    "network",
+])
+RouteHint = namedtuple("RouteHint", ["hop_hints"])
+HopHint = namedtuple("HopHint", [
+    "node_id",
+    "chan_id",
+    "fee_base_msat",
+    "fee_proportional_millionths",
+    "cltv_expiry_delta",
+])
+
+DEFAULT_EXPIRY = 3600  # seconds
+DEFAULT_MIN_FINAL_CLTV_EXPIRY = 18  # blocks
+
+# Network prefixes, longest first (lnbcrt must not be read as lnbc + amount "rt")
+NETWORKS = [("bcrt", "regtest"), ("tbs", "signet"), ("tb", "testnet"),
+            ("bc", "mainnet")]
+
+# Amount multipliers in pico-bitcoin per unit (1 msat = 10 pico-bitcoin),
+# so amounts are integer all the way
+PICO_BTC = 1000000000000
+MULTIPLIERS = {
+    "m": 1000000000,
+    "u": 1000000,
+    "n": 1000,
+    "p": 1,
+}
+
+TAGS = {
+    "p": 1,  # payment hash
+    "r": 3,  # route hints
+    "x": 6,  # expiry
+    "d": 13,  # description
+    "s": 16,  # payment secret
+    "n": 19,  # payee pubkey
+    "h": 23,  # description hash
+    "c": 24,  # min final cltv expiry
+}
+
+##### bech32 #####
+
+CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+CHARSET_REV = {c: i for i, c in enumerate(CHARSET)}
+
+
+def bech32_polymod(values):
+    generator = [0x3B6A57B2, 0x26508E6D, 0x1EA119FA, 0x3D4233DD, 0x2A1462B3]
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1FFFFFF) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+def bech32_hrp_expand(hrp):
+    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+
+
+def bech32_decode(bech):
+    """Returns (hrp, data words without checksum). No length limit, BOLT11
+    invoices are longer than the 90 characters allowed to addresses."""
+
+    if bech.lower() != bech and bech.upper() != bech:
+        raise ValueError("Mixed case payment request")
+    bech = bech.lower()
+    pos = bech.rfind("1")
+    if pos < 1 or pos + 7 > len(bech):
+        raise ValueError("Payment request has no separator")
+    hrp = bech[:pos]
+    try:
+        data = [CHARSET_REV[x] for x in bech[pos + 1:]]
+    except KeyError:
+        raise ValueError("Invalid character in payment request")
+    if bech32_polymod(bech32_hrp_expand(hrp) + data) != 1:
+        raise ValueError("Invalid payment request checksum")
+    return hrp, data[:-6]
+
+
+def bech32_encode(hrp, data):
+    values = bech32_hrp_expand(hrp) + data
+    polymod = bech32_polymod(values + [0, 0, 0, 0, 0, 0]) ^ 1
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + "1" + "".join([CHARSET[d] for d in data + checksum])
+
+
+def convertbits(data, frombits, tobits, pad=True):
+    acc = 0
+    bits = 0
+    ret = []
+    maxv = (1 << tobits) - 1
+    for value in data:
+        acc = (acc << frombits) | value
+        bits += frombits
+        while bits >= tobits:
+            bits -= tobits
+            ret.append((acc >> bits) & maxv)
+    if pad and bits:
+        ret.append((acc << (tobits - bits)) & maxv)
+    return ret
+
+
+def words_to_int(words):
+    value = 0
+    for word in words:
+        value = value << 5 | word
+    return value
+
+
+def int_to_words(value, length=None):
+    words = []
+    while value > 0:
+        words.insert(0, value & 31)
+        value >>= 5
+    if length != None:
+        words = [0] * (length - len(words)) + words
+    return words or [0]
+
+
+def words_to_bytes(words):
+    """Tagged field payloads are padded to a whole number of bytes"""
+    return bytes(convertbits(words, 5, 8, pad=False))
+
+
+##### secp256k1, only what pubkey recovery and signing need #####
+
+P = 2**256 - 2**32 - 977
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (
+    0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+    0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8,
+)
+
+
+def _jacobian_double(point):
+    x, y, z = point
+    if y == 0:
+        return (0, 0, 0)
+    ysq = y * y % P
+    s = 4 * x * ysq % P
+    m = 3 * x * x % P
+    nx = (m * m - 2 * s) % P
+    ny = (m * (s - nx) - 8 * ysq * ysq) % P
+    nz = 2 * y * z % P
+    return (nx, ny, nz)
+
+
+def _jacobian_add(p, q):
+    if p[2] == 0:
+        return q
+    if q[2] == 0:
+        return p
+    z1z1 = p[2] * p[2] % P
+    z2z2 = q[2] * q[2] % P
+    u1 = p[0] * z2z2 % P
+    u2 = q[0] * z1z1 % P
+    s1 = p[1] * q[2] * z2z2 % P
+    s2 = q[1] * p[2] * z1z1 % P
+    if u1 == u2:
+        if s1 != s2:
+            return (0, 0, 0)
+        return _jacobian_double(p)
+    h = u2 - u1
+    r = s2 - s1
+    h2 = h * h % P
+    h3 = h * h2 % P
+    u1h2 = u1 * h2 % P
+    nx = (r * r - h3 - 2 * u1h2) % P
+    ny = (r * (u1h2 - nx) - s1 * h3) % P
+    nz = h * p[2] * q[2] % P
+    return (nx, ny, nz)
+
+
+def _multiply(point, scalar):
+    result = (0, 0, 0)
+    addend = (point[0], point[1], 1)
+    while scalar:
+        if scalar & 1:
+            result = _jacobian_add(result, addend)
+        addend = _jacobian_double(addend)
+        scalar >>= 1
+    return result
+
+
+def _to_affine(point):
+    z_inv = pow(point[2], -1, P)
+    return (point[0] * z_inv * z_inv % P, point[1] * z_inv**3 % P)
+
+
+def compress(point):
+    x, y = point
+    return bytes([2 + (y & 1)]) + x.to_bytes(32, "big")
+
+
+def recover_pubkey(msg_hash, signature, recovery_id):
+    """Compressed public key (hex) that produced the 64 byte compact signature"""
+
+    r = int.from_bytes(signature[:32], "big")
+    s = int.from_bytes(signature[32:], "big")
+    if not (0 < r < N and 0 < s < N) or recovery_id > 3:
+        raise ValueError("Invalid payment request signature")
+
+    x = r + (recovery_id >> 1) * N
+    alpha = (x**3 + 7) % P
+    y = pow(alpha, (P + 1) // 4, P)
+    if (y * y - alpha) % P != 0:
+        raise ValueError("Invalid payment request signature")
+    if y & 1 != recovery_id & 1:
+        y = P - y
+
+    e = int.from_bytes(msg_hash, "big")
+    r_inv = pow(r, -1, N)
+    sR = _multiply((x, y), s * r_inv % N)
+    eG = _multiply(G, (-e * r_inv) % N)
+    q = _jacobian_add(sR, eG)
+    if q[2] == 0:
+        raise ValueError("Invalid payment request signature")
+    return compress(_to_affine(q)).hex()
+
+
+def sign(msg_hash, privkey):
+    """Compact signature and recovery id. Only used to build test invoices."""
+
+    d = int.from_bytes(privkey, "big")
+    e = int.from_bytes(msg_hash, "big")
+    while True:
+        k = secrets.randbelow(N - 1) + 1
+        rx, ry = _to_affine(_multiply(G, k))
+        r = rx % N
+        s = pow(k, -1, N) * (e + r * d) % N
+        if r == 0 or s == 0:
+            continue
+        recovery_id = (ry & 1) | (2 if rx >= N else 0)
+        # Low S, as lightning nodes require
+        if s > N // 2:
+            s = N - s
+            recovery_id ^= 1
+        return r.to_bytes(32, "big") + s.to_bytes(32, "big"), recovery_id
+
+
+def pubkey_from_privkey(privkey):
+    return compress(_to_affine(_multiply(G, int.from_bytes(privkey,
+                                                            "big")))).hex()
+
+
+##### BOLT11 #####
+
+
+def parse_hrp(hrp):
+    """Returns (network, amount in msat or None)"""
+
+    if not hrp.startswith("ln"):
+        raise ValueError("Does not look like a lightning invoice")
+    rest = hrp[2:]
+    for prefix, network in NETWORKS:
+        if rest.startswith(prefix):
+            amount = rest[len(prefix):]
+            break
+    else:
+        raise ValueError("Unknown network in lightning invoice")
+
+    if amount == "":
+        return network, None
+    multiplier = PICO_BTC
+    if amount[-1] in MULTIPLIERS:
+        multiplier = MULTIPLIERS[amount[-1]]
+        amount = amount[:-1]
+    if not amount.isdigit():
+        raise ValueError("Invalid amount in lightning invoice")
+    num_msat, sub_msat = divmod(int(amount) * multiplier, 10)
+    if sub_msat != 0:
+        raise ValueError("Invalid sub-millisatoshi amount in lightning invoice")
+    return network, num_msat
+
+
+def parse_route_hint(data):
+    hop_hints = []
+    # Every hop is 51 bytes
+    for i in range(0, len(data) - 50, 51):
+        hop = data[i:i + 51]
+        hop_hints.append(
+            HopHint(
+                node_id=hop[0:33].hex(),
+                chan_id=int.from_bytes(hop[33:41], "big"),
+                fee_base_msat=int.from_bytes(hop[41:45], "big"),
+                fee_proportional_millionths=int.from_bytes(hop[45:49], "big"),
+                cltv_expiry_delta=int.from_bytes(hop[49:51], "big"),
+            ))
+    return RouteHint(hop_hints=tuple(hop_hints))
+
+
+@lru_cache(maxsize=4096)
+def decode(invoice):
+    """Decodes a BOLT11 payment request. Raises ValueError if malformed.
+    Results are cached by invoice string (they are immutable)."""
+
+    hrp, data = bech32_decode(invoice.strip())
+    network, num_msat = parse_hrp(hrp)
+
+    # 7 words timestamp, tagged fields, 104 words signature + recovery id
+    if len(data) < 7 + 104:
+        raise ValueError("Lightning invoice is too short")
+    timestamp = words_to_int(data[:7])
+    tagged = data[7:-104]
+    signature_words = data[-104:]
+
+    fields = {
+        "payment_hash": None,
+        "description": "",
+        "description_hash": "",
+        "destination": None,
+        "expiry": DEFAULT_EXPIRY,
+        "cltv_expiry": DEFAULT_MIN_FINAL_CLTV_EXPIRY,
+        "payment_addr": "",
+    }
+    route_hints = []
+
+    i = 0
+    while i < len(tagged):
+        if i + 3 > len(tagged):
+            raise ValueError("Truncated lightning invoice field")
+        tag = tagged[i]
+        length = tagged[i + 1] * 32 + tagged[i + 2]
+        words = tagged[i + 3:i + 3 + length]
+        if len(words) != length:
+            raise ValueError("Truncated lightning invoice field")
+        i += 3 + length
+
+        # Fields with unexpected lengths must be skipped (BOLT11)
+        if tag == TAGS["p"] and length == 52:
+            if fields["payment_hash"] == None:
+                fields["payment_hash"] = words_to_bytes(words).hex()
+        elif tag == TAGS["d"]:
+            fields["description"] = words_to_bytes(words).decode(
+                "utf-8", errors="replace")
+        elif tag == TAGS["h"] and length == 52:
+            fields["description_hash"] = words_to_bytes(words).hex()
+        elif tag == TAGS["n"] and length == 53:
+            fields["destination"] = words_to_bytes(words).hex()
+        elif tag == TAGS["s"] and length == 52:
+            fields["payment_addr"] = words_to_bytes(words).hex()
+        elif tag == TAGS["x"]:
+            fields["expiry"] = words_to_int(words)
+        elif tag == TAGS["c"]:
+            fields["cltv_expiry"] = words_to_int(words)
+        elif tag == TAGS["r"]:
+            route_hints.append(parse_route_hint(words_to_bytes(words)))
+
+    if fields["payment_hash"] == None:
+        raise ValueError("Lightning invoice has no payment hash")
+
+    if fields["destination"] == None:
+        signature = words_to_bytes(signature_words)
+        signed = hrp.encode() + bytes(convertbits(data[:-104], 5, 8))
+        fields["destination"] = recover_pubkey(
+            hashlib.sha256(signed).digest(), signature[:64], signature[64])
+
+    return PayReq(
+        num_satoshis=0 if num_msat == None else num_msat // 1000,
+        num_msat=0 if num_msat == None else num_msat,
+        timestamp=timestamp,
+        route_hints=tuple(route_hints),
+        network=network,
+        **fields,
+    )
+
+
+def encode(privkey,
+           payment_hash,
+           num_satoshis,
+           timestamp,
+           description="",
+           expiry=DEFAULT_EXPIRY,
+           cltv_expiry=DEFAULT_MIN_FINAL_CLTV_EXPIRY,
+           network="regtest"):
+    """Builds a signed BOLT11 payment request. Used by the fake LND server."""
+
+    prefix = {name: prefix for prefix, name in NETWORKS}[network]
+    hrp = "ln" + prefix
+    if num_satoshis:
+        hrp += f"{num_satoshis * 10}n"
+
+    def field(tag, words):
+        return [TAGS[tag], len(words) // 32, len(words) % 32] + words
+
+    data = int_to_words(timestamp, 7)
+    data += field("p", convertbits(bytes.fromhex(payment_hash), 8, 5))
+    data += field("d", convertbits(description.encode("utf-8"), 8, 5))
+    data += field("x", int_to_words(expiry))
+    data += field("c", int_to_words(cltv_expiry))
+
+    signed = hrp.encode() + bytes(convertbits(data, 5, 8))
+    signature, recovery_id = sign(hashlib.sha256(signed).digest(), privkey)
+    data += convertbits(signature + bytes([recovery_id]), 8, 5)
+    return bech32_encode(hrp, data)
@@ -0,0 +1,338 @@
+import asyncio, grpc, hashlib, random, secrets, time
+
+from . import lightning_pb2 as lnrpc, lightning_pb2_grpc as lightningstub
+from . import invoices_pb2 as invoicesrpc, invoices_pb2_grpc as invoicesstub
+from . import router_pb2 as routerrpc, router_pb2_grpc as routerstub
+from . import bolt11
+
+#######
+# In-memory stand-in for the subset of LND used by RoboSats (LNNode, the
+# follow_invoices command and the payment tasks). Meant for load tests and
+# local development without bitcoind and lnd containers. Nothing here is
+# imported by the app itself.
+#
+# Runs on grpc.aio: every call and stream is a coroutine on one event loop, so
+# thousands of open SubscribeSingleInvoice streams do not hold a thread each.
+# Streams wait on a Condition notified by every invoice change.
+#
+# Behaviour is scripted by a few knobs:
+#   latency, jitter     seconds added to every call
+#   failure_rate        fraction of unary calls aborted with UNAVAILABLE
+#   lock_after          seconds until a new hold invoice is "paid" (ACCEPTED).
+#                       None leaves them OPEN until they expire.
+#   payment_time        seconds a SendPaymentV2 stays IN_FLIGHT
+#   payment_failure_rate fraction of payments that end FAILED (no route)
+#   block_interval      seconds per fake block
+#   network             network of the BOLT11 invoices (must match NETWORK)
+#######
+
+# lnrpc.Invoice.InvoiceState
+OPEN, SETTLED, CANCELED, ACCEPTED = 0, 1, 2, 3
+# lnrpc.Payment.PaymentStatus
+UNKNOWN, IN_FLIGHT, SUCCEEDED, FAILED = 0, 1, 2, 3
+
+# Invoices are really signed, so decoders recover this node as destination
+NODE_PRIVKEY = hashlib.sha256(b"fake lnd").digest()
+NODE_PUBKEY = bolt11.pubkey_from_privkey(NODE_PRIVKEY)
+
+
+class FakeLNDState:
+
+    def __init__(self,
+                 latency=0,
+                 jitter=0,
+                 failure_rate=0,
+                 lock_after=None,
+                 payment_time=1,
+                 payment_failure_rate=0,
+                 block_interval=600,
+                 start_height=700000,
+                 network="testnet"):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.lock_after = lock_after
+        self.payment_time = payment_time
+        self.payment_failure_rate = payment_failure_rate
+        self.block_interval = block_interval
+        self.start_height = start_height
+        self.network = network
+        self.started_at = time.time()
+
+        self.invoices = {}  # payment hash hex -> dict
+        self.payreqs = {}  # payment request -> payment hash hex
+        self.payments = {}  # payment hash hex -> dict
+        self.changed = asyncio.Condition()
+
+    def block_height(self):
+        return self.start_height + int(
+            (time.time() - self.started_at) / self.block_interval)
+
+    async def delay(self, context, unary=True):
+        """Injected latency and failures"""
+        wait = self.latency + random.uniform(0, self.jitter)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if unary and random.random() < self.failure_rate:
+            await context.abort(grpc.StatusCode.UNAVAILABLE,
+                                "fake lnd: injected failure")
+
+    async def add_invoice(self, r_hash, value, memo, expiry, cltv_expiry, hold):
+        payment_hash = r_hash.hex()
+        creation_date = int(time.time())
+        payment_request = bolt11.encode(NODE_PRIVKEY,
+                                        payment_hash,
+                                        value,
+                                        creation_date,
+                                        description=memo,
+                                        expiry=expiry or 3600,
+                                        cltv_expiry=cltv_expiry or 40,
+                                        network=self.network)
+        async with self.changed:
+            self.invoices[payment_hash] = {
+                "r_hash": r_hash,
+                "value": value,
+                "memo": memo,
+                "expiry": expiry or 3600,
+                "cltv_expiry": cltv_expiry or 40,
+                "creation_date": creation_date,
+                "payment_request": payment_request,
+                "hold": hold,
+                "state": OPEN,
+                "expiry_height": None,
+            }
+            self.payreqs[payment_request] = payment_hash
+        return payment_request
+
+    def refresh(self, invoice):
+        """Applies the scripted, time driven transitions. Call with the lock held."""
+        now = time.time()
+        if invoice["state"] == OPEN:
+            if (self.lock_after != None and invoice["hold"]
+                    and now - invoice["creation_date"] >= self.lock_after):
+                invoice["state"] = ACCEPTED
+                invoice["expiry_height"] = self.block_height(
+                ) + invoice["cltv_expiry"]
+                self.changed.notify_all()
+            elif now > invoice["creation_date"] + invoice["expiry"]:
+                invoice["state"] = CANCELED
+                self.changed.notify_all()
+
+    async def get_invoice(self, payment_hash, context):
+        invoice = self.invoices.get(payment_hash)
+        if invoice == None:
+            await context.abort(grpc.StatusCode.UNKNOWN, "unable to locate invoice")
+        self.refresh(invoice)
+        return invoice
+
+    def invoice_message(self, invoice):
+        htlcs = []
+        if invoice["expiry_height"] != None:
+            htlcs.append(
+                lnrpc.InvoiceHTLC(amt_msat=invoice["value"] * 1000,
+                                  expiry_height=invoice["expiry_height"]))
+        return lnrpc.Invoice(
+            memo=invoice["memo"],
+            r_hash=invoice["r_hash"],
+            value=invoice["value"],
+            creation_date=invoice["creation_date"],
+            expiry=invoice["expiry"],
+            cltv_expiry=invoice["cltv_expiry"],
+            payment_request=invoice["payment_request"],
+            state=invoice["state"],
+            htlcs=htlcs,
+        )
+
+    async def set_state(self, payment_hash, state, context):
+        async with self.changed:
+            invoice = await self.get_invoice(payment_hash, context)
+            if state == SETTLED and invoice["state"] != ACCEPTED:
+                await context.abort(grpc.StatusCode.UNKNOWN,
+                                    "invoice still open" if invoice["state"] == OPEN
+                                    else "invoice already settled")
+            if state == CANCELED and invoice["state"] == SETTLED:
+                await context.abort(grpc.StatusCode.UNKNOWN,
+                                    "invoice already settled")
+            invoice["state"] = state
+            self.changed.notify_all()
+
+    def payment_message(self, payment):
+        elapsed = time.time() - payment["started_at"]
+        status = IN_FLIGHT
+        if elapsed >= self.payment_time:
+            status = FAILED if payment["fails"] else SUCCEEDED
+        return lnrpc.Payment(
+            payment_hash=payment["payment_hash"],
+            value_sat=payment["value"],
+            status=status,
+            fee_msat=0 if status != SUCCEEDED else payment["value"],
+            payment_preimage=payment["preimage"] if status == SUCCEEDED else "",
+            failure_reason=2 if status == FAILED else 0,
+        )
+
+
+class FakeLightning(lightningstub.LightningServicer):
+
+    def __init__(self, state):
+        self.state = state
+
+    async def GetInfo(self, request, context):
+        await self.state.delay(context)
+        return lnrpc.GetInfoResponse(identity_pubkey=NODE_PUBKEY,
+                                     alias="fake-lnd",
+                                     block_height=self.state.block_height(),
+                                     synced_to_chain=True)
+
+    async def AddInvoice(self, request, context):
+        """Regular invoices, e.g. buyer payout invoices in load tests"""
+        await self.state.delay(context)
+        preimage = request.r_preimage or secrets.token_bytes(32)
+        r_hash = hashlib.sha256(preimage).digest()
+        payment_request = await self.state.add_invoice(r_hash, request.value,
+                                                       request.memo, request.expiry,
+                                                       request.cltv_expiry, False)
+        return lnrpc.AddInvoiceResponse(r_hash=r_hash,
+                                        payment_request=payment_request)
+
+    async def DecodePayReq(self, request, context):
+        await self.state.delay(context)
+        try:
+            decoded = bolt11.decode(request.pay_req)
+        except ValueError as e:
+            await context.abort(grpc.StatusCode.UNKNOWN, str(e))
+        return lnrpc.PayReq(destination=decoded.destination,
+                            payment_hash=decoded.payment_hash,
+                            num_satoshis=decoded.num_satoshis,
+                            timestamp=decoded.timestamp,
+                            expiry=decoded.expiry,
+                            description=decoded.description,
+                            cltv_expiry=decoded.cltv_expiry)
+
+
+class FakeInvoices(invoicesstub.InvoicesServicer):
+
+    def __init__(self, state):
+        self.state = state
+
+    async def AddHoldInvoice(self, request, context):
+        await self.state.delay(context)
+        payment_request = await self.state.add_invoice(request.hash, request.value,
+                                                       request.memo, request.expiry,
+                                                       request.cltv_expiry, True)
+        return invoicesrpc.AddHoldInvoiceResp(payment_request=payment_request)
+
+    async def LookupInvoiceV2(self, request, context):
+        await self.state.delay(context)
+        async with self.state.changed:
+            invoice = await self.state.get_invoice(request.payment_hash.hex(),
+                                                   context)
+            return self.state.invoice_message(invoice)
+
+    async def SettleInvoice(self, request, context):
+        await self.state.delay(context)
+        payment_hash = hashlib.sha256(request.preimage).hexdigest()
+        await self.state.set_state(payment_hash, SETTLED, context)
+        return invoicesrpc.SettleInvoiceResp()
+
+    async def CancelInvoice(self, request, context):
+        await self.state.delay(context)
+        await self.state.set_state(request.payment_hash.hex(), CANCELED, context)
+        return invoicesrpc.CancelInvoiceResp()
+
+    async def SubscribeSingleInvoice(self, request, context):
+        """Sends the current state, then every change until the invoice
+        is settled or cancelled. Cancelled by grpc.aio if the client goes away."""
+        await self.state.delay(context, unary=False)
+        payment_hash = request.r_hash.hex()
+        last_state = None
+        while True:
+            message = None
+            async with self.state.changed:
+                invoice = await self.state.get_invoice(payment_hash, context)
+                if invoice["state"] != last_state:
+                    last_state = invoice["state"]
+                    message = self.state.invoice_message(invoice)
+                else:
+                    # Wake up on changes, or now and then for time driven transitions
+                    try:
+                        await asyncio.wait_for(self.state.changed.wait(), 0.5)
+                    except asyncio.TimeoutError:
+                        pass
+            # Never yield with the lock held, the client decides when we resume
+            if message != None:
+                yield message
+            if last_state in [SETTLED, CANCELED]:
+                return
+
+
+class FakeRouter(routerstub.RouterServicer):
+
+    def __init__(self, state):
+        self.state = state
+
+    async def SendPaymentV2(self, request, context):
+        await self.state.delay(context, unary=False)
+        payment_hash = self.state.payreqs.get(request.payment_request)
+        if payment_hash == None:
+            # Not one of ours, make up a payment hash for it
+            payment_hash = hashlib.sha256(
+                request.payment_request.encode()).hexdigest()
+            value = 0
+        else:
+            invoice = self.state.invoices[payment_hash]
+            value = invoice["value"]
+            if invoice["state"] == CANCELED:
+                await context.abort(grpc.StatusCode.UNKNOWN, "invoice expired")
+
+        async with self.state.changed:
+            payment = self.state.payments.get(payment_hash)
+            if payment == None or payment["fails"]:
+                payment = {
+                    "payment_hash": payment_hash,
+                    "value": value,
+                    "started_at": time.time(),
+                    "fails": random.random() < self.state.payment_failure_rate,
+                    "preimage": secrets.token_hex(32),
+                }
+                self.state.payments[payment_hash] = payment
+
+        async for message in self.follow_payment(payment):
+            yield message
+
+    async def TrackPaymentV2(self, request, context):
+        await self.state.delay(context, unary=False)
+        payment = self.state.payments.get(request.payment_hash.hex())
+        if payment == None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "payment isn't initiated")
+        async for message in self.follow_payment(payment):
+            yield message
+
+    async def follow_payment(self, payment):
+        message = self.state.payment_message(payment)
+        yield message
+        while message.status == IN_FLIGHT:
+            await asyncio.sleep(min(0.5, self.state.payment_time))
+            message = self.state.payment_message(payment)
+            if message.status != IN_FLIGHT:
+                yield message
+
+    async def ResetMissionControl(self, request, context):
+        await self.state.delay(context)
+        return routerrpc.ResetMissionControlResponse()
+
+
+async def serve(port, cert, key, **knobs):
+    """Starts a TLS grpc.aio server on `port`, in the running event loop.
+    Returns (server, state). LNNode must trust `cert` (LND_CERT_BASE64) and
+    point LND_GRPC_HOST to this port. The macaroon is not checked."""
+
+    state = FakeLNDState(**knobs)
+    server = grpc.aio.server(options=[("grpc.max_concurrent_streams", 10000)])
+    lightningstub.add_LightningServicer_to_server(FakeLightning(state), server)
+    invoicesstub.add_InvoicesServicer_to_server(FakeInvoices(state), server)
+    routerstub.add_RouterServicer_to_server(FakeRouter(state), server)
+
+    credentials = grpc.ssl_server_credentials([(key, cert)])
+    server.add_secure_port(f"[::]:{port}", credentials)
+    await server.start()
+    return server, state
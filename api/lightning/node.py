@@ -1,7 +1,8 @@
-import grpc, os, hashlib, secrets
+import grpc, os, hashlib, secrets, json
 from . import lightning_pb2 as lnrpc, lightning_pb2_grpc as lightningstub
 from . import invoices_pb2 as invoicesrpc, invoices_pb2_grpc as invoicesstub
 from . import router_pb2 as routerrpc, router_pb2_grpc as routerstub
+from . import bolt11
 
 from decouple import config
 from base64 import b64decode
@@ -30,13 +31,60 @@ except:
 
 LND_GRPC_HOST = config("LND_GRPC_HOST")
 
+# Encoded once, sent with every call
+MACAROON_METADATA = (("macaroon", MACAROON.hex()), )
+
+# Calls that are safe to repeat are retried by grpc itself if LND is briefly
+# unreachable. Nothing is retried once LND has started processing the call.
+SERVICE_CONFIG = {
+    "methodConfig": [{
+        "name": [
+            {"service": "lnrpc.Lightning", "method": "GetInfo"},
+            {"service": "invoicesrpc.Invoices", "method": "LookupInvoiceV2"},
+            {"service": "invoicesrpc.Invoices", "method": "CancelInvoice"},
+            {"service": "invoicesrpc.Invoices", "method": "SettleInvoice"},
+        ],
+        "retryPolicy": {
+            "maxAttempts": 3,
+            "initialBackoff": "0.2s",
+            "maxBackoff": "2s",
+            "backoffMultiplier": 2,
+            "retryableStatusCodes": ["UNAVAILABLE"],
+        },
+    }]
+}
+
+CHANNEL_OPTIONS = [
+    # Detect dead connections (e.g. Tor circuits) instead of hanging on them
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.enable_retries", 1),
+    ("grpc.service_config", json.dumps(SERVICE_CONFIG)),
+    # Some invoices / route hints are large
+    ("grpc.max_receive_message_length", 50 * 1024 * 1024),
+]
+
+# Seconds before giving up on a call. A hung LND must not block a worker forever.
+DEADLINES = {
+    "GetInfo": 10,
+    "AddHoldInvoice": 30,
+    "LookupInvoiceV2": 10,
+    "CancelInvoice": 30,
+    "SettleInvoice": 30,
+    "ResetMissionControl": 10,
+    "SendPaymentV2": 120,  # streaming, payment itself times out earlier
+    "TrackPaymentV2": 120,
+}
+
 
 class LNNode:
 
     os.environ["GRPC_SSL_CIPHER_SUITES"] = "HIGH+ECDSA"
 
     creds = grpc.ssl_channel_credentials(CERT)
-    channel = grpc.secure_channel(LND_GRPC_HOST, creds)
+    channel = grpc.secure_channel(LND_GRPC_HOST, creds, options=CHANNEL_OPTIONS)
 
     lightningstub = lightningstub.LightningStub(channel)
     invoicesstub = invoicesstub.InvoicesStub(channel)
@@ -60,12 +108,9 @@ class LNNode:
 
     @classmethod
     def decode_payreq(cls, invoice):
-        """Decodes a lightning payment request (invoice)"""
-        request = lnrpc.PayReqString(pay_req=invoice)
-        response = cls.lightningstub.DecodePayReq(request,
-                                                  metadata=[("macaroon",
-                                                             MACAROON.hex())])
-        return response
+        """Decodes a lightning payment request (invoice). Done locally, no LND
+        round trip. Raises ValueError if the invoice is malformed."""
+        return bolt11.decode(invoice)
 
     @classmethod
     def cancel_return_hold_invoice(cls, payment_hash):
@@ -73,8 +118,8 @@ class LNNode:
         request = invoicesrpc.CancelInvoiceMsg(
             payment_hash=bytes.fromhex(payment_hash))
         response = cls.invoicesstub.CancelInvoice(request,
-                                                  metadata=[("macaroon",
-                                                             MACAROON.hex())])
+                                                  metadata=MACAROON_METADATA,
+                                                  timeout=DEADLINES["CancelInvoice"])
         # Fix this: tricky because canceling sucessfully an invoice has no response. TODO
         return str(response) == ""  # True if no response, false otherwise.
 
@@ -84,8 +129,8 @@ class LNNode:
         request = invoicesrpc.SettleInvoiceMsg(
             preimage=bytes.fromhex(preimage))
         response = cls.invoicesstub.SettleInvoice(request,
-                                                  metadata=[("macaroon",
-                                                             MACAROON.hex())])
+                                                  metadata=MACAROON_METADATA,
+                                                  timeout=DEADLINES["SettleInvoice"])
         # Fix this: tricky because settling sucessfully an invoice has None response. TODO
         return str(response) == ""  # True if no response, false otherwise.
 
@@ -113,13 +158,13 @@ class LNNode:
             cltv_expiry=cltv_expiry_blocks,
         )
         response = cls.invoicesstub.AddHoldInvoice(request,
-                                                   metadata=[("macaroon",
-                                                              MACAROON.hex())])
+                                                   metadata=MACAROON_METADATA,
+                                                   timeout=DEADLINES["AddHoldInvoice"])
 
         hold_payment["invoice"] = response.payment_request
         payreq_decoded = cls.decode_payreq(hold_payment["invoice"])
         hold_payment["preimage"] = preimage.hex()
-        hold_payment["payment_hash"] = payreq_decoded.payment_hash
+        hold_payment["payment_hash"] = r_hash.hex()
         hold_payment["created_at"] = timezone.make_aware(
             datetime.fromtimestamp(payreq_decoded.timestamp))
         hold_payment["expires_at"] = hold_payment["created_at"] + timedelta(
@@ -134,9 +179,8 @@ class LNNode:
         request = invoicesrpc.LookupInvoiceMsg(
             payment_hash=bytes.fromhex(lnpayment.payment_hash))
         response = cls.invoicesstub.LookupInvoiceV2(request,
-                                                    metadata=[("macaroon",
-                                                               MACAROON.hex())
-                                                              ])
+                                                    metadata=MACAROON_METADATA,
+                                                    timeout=DEADLINES["LookupInvoiceV2"])
         print("status here")
         print(response.state)
 
@@ -158,14 +202,21 @@ class LNNode:
             lnpayment.save()
             return True
 
+    @classmethod
+    def get_block_height(cls):
+        """Best block height known by LND"""
+        request = lnrpc.GetInfoRequest()
+        response = cls.lightningstub.GetInfo(request,
+                                             metadata=MACAROON_METADATA,
+                                             timeout=DEADLINES["GetInfo"])
+        return response.block_height
+
     @classmethod
     def resetmc(cls):
         request = routerrpc.ResetMissionControlRequest()
         response = cls.routerstub.ResetMissionControl(request,
-                                                      metadata=[
-                                                          ("macaroon",
-                                                           MACAROON.hex())
-                                                      ])
+                                                      metadata=MACAROON_METADATA,
+                                                      timeout=DEADLINES["ResetMissionControl"])
         return True
 
     @classmethod
@@ -183,13 +234,19 @@ class LNNode:
 
         try:
             payreq_decoded = cls.decode_payreq(invoice)
-            print(payreq_decoded)
         except:
             payout["context"] = {
                 "bad_invoice": "Does not look like a valid lightning invoice"
             }
             return payout
 
+        # LND used to reject these when decoding
+        if payreq_decoded.network != config("NETWORK"):
+            payout["context"] = {
+                "bad_invoice": f"The invoice provided is not for {config('NETWORK')}"
+            }
+            return payout
+
         ## Some wallet providers (e.g. Muun) force routing through a private channel with high fees >1500ppm
         ## These payments will fail. So it is best to let the user know in advance this invoice is not valid.
         route_hints = payreq_decoded.route_hints
@@ -262,9 +319,8 @@ class LNNode:
                                                timeout_seconds=30)
 
         for response in cls.routerstub.SendPaymentV2(request,
-                                                     metadata=[("macaroon",
-                                                                MACAROON.hex())
-                                                               ]):
+                                                     metadata=MACAROON_METADATA,
+                                                     timeout=DEADLINES["SendPaymentV2"]):
 
             if response.status == 0:  # Status 0 'UNKNOWN'
                 # Not sure when this status happens
@@ -302,9 +358,8 @@ class LNNode:
         request = invoicesrpc.LookupInvoiceMsg(
             payment_hash=bytes.fromhex(payment_hash))
         response = cls.invoicesstub.LookupInvoiceV2(request,
-                                                    metadata=[("macaroon",
-                                                               MACAROON.hex())
-                                                              ])
+                                                    metadata=MACAROON_METADATA,
+                                                    timeout=DEADLINES["LookupInvoiceV2"])
 
         return (
             response.state == 1
@@ -0,0 +1,103 @@
+import heapq
+import time
+
+from api.models import LNPayment
+
+#######
+# Decides when every active hold invoice has to be looked up again.
+# Invoices waiting to be paid (INVGEN) are what users are staring at, so they
+# are checked often. Bonds that have been LOCKED for hours rarely change on the
+# LND side and back off towards `max_interval`.
+#######
+
+
+class InvoiceScheduler:
+
+    # The follower loop wakes up every 5 seconds, shorter intervals are pointless.
+    min_interval = 5  # seconds, right after creation or a status change
+    invgen_interval = 5  # seconds, cap while waiting to be paid
+    max_interval = 300  # seconds, cap for long locked invoices
+    growth = 2  # interval multiplier for every unchanged lookup
+    block_time = 60  # seconds of interval allowed per block left to CLTV expiry
+
+    def __init__(self):
+        self.queue = []  # heap of (next_check_at, payment_hash)
+        self.entries = {}  # payment_hash -> {"next_check_at", "interval", "status"}
+
+    def sync(self, hold_lnpayments, now=None):
+        """Adds new invoices to the schedule (due now) and forgets those
+        that are not active anymore. Invoices whose status was changed
+        by someone else (e.g. Logics) are brought forward."""
+
+        now = time.time() if now == None else now
+        active = set()
+        for lnpayment in hold_lnpayments:
+            active.add(lnpayment.payment_hash)
+            entry = self.entries.get(lnpayment.payment_hash)
+            if entry == None or entry["status"] != lnpayment.status:
+                self.schedule(lnpayment.payment_hash, lnpayment.status,
+                              self.min_interval, now)
+
+        for payment_hash in list(self.entries.keys()):
+            if payment_hash not in active:
+                del self.entries[payment_hash]
+
+    def schedule(self, payment_hash, status, interval, next_check_at):
+        self.entries[payment_hash] = {
+            "next_check_at": next_check_at,
+            "interval": interval,
+            "status": status,
+        }
+        heapq.heappush(self.queue, (next_check_at, payment_hash))
+
+    def pop_due(self, now=None):
+        """Returns the payment hashes that have to be looked up now"""
+
+        now = time.time() if now == None else now
+        due = []
+        while len(self.queue) > 0 and self.queue[0][0] <= now:
+            next_check_at, payment_hash = heapq.heappop(self.queue)
+            entry = self.entries.get(payment_hash)
+            # Stale heap item: invoice is gone or it was rescheduled since
+            if entry == None or entry["next_check_at"] != next_check_at:
+                continue
+            due.append(payment_hash)
+        return due
+
+    def reschedule(self, lnpayment, changed, block_height=None, now=None):
+        """Schedules the next lookup of an invoice that was just checked"""
+
+        now = time.time() if now == None else now
+        entry = self.entries.get(lnpayment.payment_hash)
+
+        if lnpayment.status not in [
+                LNPayment.Status.INVGEN, LNPayment.Status.LOCKED
+        ]:
+            self.entries.pop(lnpayment.payment_hash, None)
+            return
+
+        if changed or entry == None:
+            interval = self.min_interval
+        else:
+            interval = entry["interval"] * self.growth
+
+        if lnpayment.status == LNPayment.Status.INVGEN:
+            interval = min(interval, self.invgen_interval)
+            # Check right after the invoice expires, LND will have cancelled it.
+            if lnpayment.expires_at != None:
+                to_expiry = lnpayment.expires_at.timestamp() - now
+                if to_expiry > 0:
+                    interval = min(interval, to_expiry + 1)
+        else:
+            interval = min(interval, self.max_interval)
+            # Locked HTLCs close to their CLTV expiry are checked more often.
+            if lnpayment.expiry_height != None and block_height != None:
+                blocks_left = max(lnpayment.expiry_height - block_height, 0)
+                interval = min(interval,
+                               max(self.min_interval, blocks_left * self.block_time))
+
+        self.schedule(lnpayment.payment_hash, lnpayment.status, interval,
+                      now + interval)
+
+    def __len__(self):
+        return len(self.entries)
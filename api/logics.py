@@ -6,6 +6,7 @@ from django.db.models import Q
 
 from api.models import Order, LNPayment, MarketTick, User, Currency
 from api.tasks import send_message
+from api.rates import exchange_rate
 from decouple import config
 
 import gnupg
@@ -158,8 +159,8 @@ class Logics:
                     " Sats"
                 }
         elif order.has_range:
-            min_sats = cls.calc_sats(order.min_amount, order.currency.exchange_rate, order.premium)
-            max_sats = cls.calc_sats(order.max_amount, order.currency.exchange_rate, order.premium)
+            min_sats = cls.calc_sats(order.min_amount, exchange_rate(order.currency_id), order.premium)
+            max_sats = cls.calc_sats(order.max_amount, exchange_rate(order.currency_id), order.premium)
             if min_sats > max_sats/1.5:
                 return False, {
                     "bad_request":
@@ -249,20 +250,20 @@ class Logics:
             satoshis_now = order.satoshis
         else:
             amount = order.amount if order.amount != None else order.max_amount
-            satoshis_now = cls.calc_sats(amount, order.currency.exchange_rate, order.premium)
+            satoshis_now = cls.calc_sats(amount, exchange_rate(order.currency_id), order.premium)
 
         return int(satoshis_now)
 
     def price_and_premium_now(order):
         """computes order price and premium with current rates"""
-        exchange_rate = float(order.currency.exchange_rate)
+        rate = exchange_rate(order.currency_id)
         if not order.is_explicit:
             premium = order.premium
-            price = exchange_rate * (1 + float(premium) / 100)
+            price = rate * (1 + float(premium) / 100)
         else:
             amount = order.amount if not order.has_range else order.max_amount
             order_rate = float(amount) / (float(order.satoshis) / 100000000)
-            premium = order_rate / exchange_rate - 1
+            premium = order_rate / rate - 1
             premium = int(premium * 10000) / 100  # 2 decimals left
             price = order_rate
 
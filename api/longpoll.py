@@ -0,0 +1,119 @@
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.db.models import Q
+from django.http.cookie import parse_cookie
+from django.utils.module_loading import import_string
+from django_redis import get_redis_connection
+from decouple import config
+from urllib.parse import parse_qs
+
+import asyncio
+
+#######
+# Long-polling of OrderView, for clients that cannot keep a websocket open
+# (e.g. over Tor). Every order has a version in Redis, bumped when a change is
+# committed (see push_order_update in models.py). OrderView.get returns it, and
+# a GET /api/order/?order_id=<id>&since=<version> is held here, without a worker
+# thread, until the version moves past <version> or LONG_POLL_TIMEOUT seconds go
+# by. Then it is served by OrderView as usual.
+#
+# Only the maker and the taker of the order are held, as found by their session
+# cookie. Anyone else is passed on to OrderView right away.
+#
+# Waiting uses the same channel layer group as the order websocket consumer.
+#
+# Needs the app served over ASGI (robosats.routing). Under robosats.wsgi nothing
+# is held, so OrderView tells clients with "long_poll": false in its response.
+#######
+
+LONG_POLL_TIMEOUT = config("LONG_POLL_TIMEOUT", cast=int, default=60)
+# Versions of orders that stopped changing are dropped. A long-poll on a dropped
+# version is answered right away (see wait), then starts over from 0.
+VERSION_TTL = 2 * 24 * 60 * 60  # seconds
+
+
+def version_key(order_id):
+    return f"order_version_{order_id}"
+
+
+def bump_version(order_id):
+    pipe = get_redis_connection("default").pipeline()
+    pipe.incr(version_key(order_id))
+    pipe.expire(version_key(order_id), VERSION_TTL)
+    return pipe.execute()[0]
+
+
+def order_version(order_id):
+    version = get_redis_connection("default").get(version_key(order_id))
+    return 0 if version == None else int(version)
+
+
+class OrderLongPoll:
+    """ASGI middleware holding the order long-polls before they reach Django"""
+
+    path = "/api/order/"
+
+    def __init__(self, app):
+        self.app = app
+
+    def long_poll(self, scope):
+        """(order_id, since) if the request is a long-poll, None otherwise"""
+
+        if (scope["type"] != "http" or scope["method"] != "GET"
+                or scope["path"] != self.path):
+            return None
+        query = parse_qs(scope["query_string"].decode())
+        try:
+            return int(query["order_id"][0]), int(query["since"][0])
+        except (KeyError, ValueError):
+            return None
+
+    def participant(self, scope, order_id):
+        """Whether the session of the request is the maker's or the taker's"""
+
+        from api.models import Order
+
+        cookies = {}
+        for name, value in scope.get("headers", []):
+            if name == b"cookie":
+                cookies = parse_cookie(value.decode("latin1"))
+        session_key = cookies.get(settings.SESSION_COOKIE_NAME)
+        if session_key == None:
+            return False
+
+        SessionStore = import_string(settings.SESSION_ENGINE + ".SessionStore")
+        user_id = SessionStore(session_key).get(SESSION_KEY)
+        if user_id == None:
+            return False
+        return Order.objects.filter(id=order_id).filter(
+            Q(maker=user_id) | Q(taker=user_id)).exists()
+
+    async def wait(self, order_id, since):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        group = f"order_{order_id}"
+
+        # Join first, so a change right after reading the version is not missed
+        await layer.group_add(group, channel)
+        try:
+            # Only while the client is up to date. Also stops waiting on a
+            # version older than `since`, e.g. Redis lost the counters.
+            if await sync_to_async(order_version)(order_id) == since:
+                await asyncio.wait_for(layer.receive(channel),
+                                       LONG_POLL_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await layer.group_discard(group, channel)
+
+    async def __call__(self, scope, receive, send):
+        # Read by OrderView (request.scope), long-polls are held here
+        scope = dict(scope, long_poll=True)
+        long_poll = self.long_poll(scope)
+        if long_poll != None and await database_sync_to_async(self.participant)(
+                scope, long_poll[0]):
+            await self.wait(*long_poll)
+        return await self.app(scope, receive, send)
@@ -0,0 +1,124 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api.models import Order, LNPayment, MarketTick, Currency
+from api.management.commands.clean_orders import Command as CleanOrders
+from api.management.commands.follow_payouts import Command as FollowPayouts
+
+from django.contrib.auth.models import User
+from django.utils import timezone
+from datetime import timedelta
+import secrets
+
+
+class Command(BaseCommand):
+
+    help = """EXPLAINs the hot Order/LNPayment/MarketTick queries and fails if any of
+    them would scan a whole table. Runs in a transaction that is rolled back.
+    Without --seed, sequential scans are disabled for the check, so tables too
+    small to bother with an index still reveal a missing one."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Insert this many finished orders, payments and ticks first (e.g. 1000000)",
+        )
+
+    def hot_queries(self):
+        user = User.objects.first()
+        user_id = user.id if user != None else 1
+        currency = Currency.objects.first()
+        currency_id = currency.id if currency != None else 1
+        active = [
+            Order.Status.WFB, Order.Status.PUB, Order.Status.PAU,
+            Order.Status.TAK, Order.Status.WF2, Order.Status.WFE,
+            Order.Status.WFI, Order.Status.CHA, Order.Status.FSE,
+            Order.Status.DIS, Order.Status.WFR
+        ]
+
+        return {
+            "book (BookView)":
+            Order.objects.filter(status=Order.Status.PUB,
+                                 currency=currency_id,
+                                 type=Order.Types.BUY),
+            "book count (MakerView)":
+            Order.objects.filter(status=Order.Status.PUB),
+            "maker active (validate_already_maker_or_taker)":
+            Order.objects.filter(maker=user_id, status__in=active),
+            "taker active (validate_already_maker_or_taker)":
+            Order.objects.filter(taker=user_id, status__in=active),
+            "expiries (clean_orders)":
+            Order.objects.filter(status__in=CleanOrders.expirable,
+                                 expires_at__lte=timezone.now()),
+            "payouts due (follow_payouts)":
+            FollowPayouts().due_payments(),
+            "hold invoices (follow_invoices)":
+            LNPayment.objects.filter(
+                type=LNPayment.Types.HOLD,
+                status__in=[LNPayment.Status.INVGEN, LNPayment.Status.LOCKED]),
+            "last tick (PriceView)":
+            MarketTick.objects.order_by("currency", "-timestamp").distinct("currency"),
+        }
+
+    def seed(self, num):
+        """Finished trades, the rows that pile up in production"""
+
+        currency = Currency.objects.first()
+        now = timezone.now()
+        batch = 10000
+        for start in range(0, num, batch):
+            size = min(batch, num - start)
+            Order.objects.bulk_create([
+                Order(status=Order.Status.SUC,
+                      type=i % 2,
+                      currency=currency,
+                      amount=100,
+                      expires_at=now - timedelta(days=1)) for i in range(size)
+            ])
+            LNPayment.objects.bulk_create([
+                LNPayment(payment_hash=secrets.token_hex(32),
+                          type=i % 2,
+                          status=LNPayment.Status.SETLED if i % 2 else LNPayment.Status.SUCCED,
+                          num_satoshis=100000,
+                          created_at=now - timedelta(days=1),
+                          expires_at=now - timedelta(days=1)) for i in range(size)
+            ])
+            MarketTick.objects.bulk_create([
+                MarketTick(price=30000,
+                           volume=0.001,
+                           premium=1,
+                           currency=currency,
+                           timestamp=now - timedelta(seconds=i)) for i in range(size)
+            ])
+
+        with connection.cursor() as cursor:
+            for model in [Order, LNPayment, MarketTick]:
+                cursor.execute(f'ANALYZE "{model._meta.db_table}"')
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Query plans are only checked on PostgreSQL")
+
+        failed = []
+        with transaction.atomic():
+            if options["seed"] > 0:
+                self.stdout.write(f"Seeding {options['seed']} rows per table...")
+                self.seed(options["seed"])
+            else:
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+
+            for name, queryset in self.hot_queries().items():
+                plan = queryset.explain()
+                ok = "Seq Scan" not in plan
+                if not ok:
+                    failed.append(name)
+                self.stdout.write(f"{'OK' if ok else 'SEQ SCAN'} {name}")
+                self.stdout.write(plan)
+
+            transaction.set_rollback(True)
+
+        if len(failed) > 0:
+            raise CommandError(f"Sequential scans in: {', '.join(failed)}")
@@ -1,79 +1,283 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.core.cache import cache
 
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import select
 import time
-from api.models import Order
+from api.models import Order, ORDER_CHANGES_CHANNEL
 from api.logics import Logics
 from django.utils import timezone
 
 
 class Command(BaseCommand):
-    help = "Follows all active hold invoices"
+    help = "Expires orders as soon as their time is up"
 
-    # def add_arguments(self, parser):
-    #     parser.add_argument('debug', nargs='+', type=boolean)
+    # Orders in these status are not expired by this command
+    do_nothing = [
+        Order.Status.UCA,
+        Order.Status.EXP,
+        Order.Status.DIS,
+        Order.Status.CCA,
+        Order.Status.PAY,
+        Order.Status.SUC,
+        Order.Status.FAI,
+        Order.Status.MLD,
+        Order.Status.TLD,
+        Order.Status.WFR,
+    ]
+    # All the others. Queried by status__in to use the order_expiry_idx partial index.
+    expirable = [
+        Order.Status.WFB,
+        Order.Status.PUB,
+        Order.Status.PAU,
+        Order.Status.TAK,
+        Order.Status.WF2,
+        Order.Status.WFE,
+        Order.Status.WFI,
+        Order.Status.CHA,
+        Order.Status.FSE,
+    ]
+    resync = 300  # seconds between full reloads of the active orders
+    workers = 4  # threads expiring orders in parallel
+    batch_size = 5  # orders claimed at once by a worker
+    claim_timeout = 300  # seconds an order stays claimed, should its worker die
+    retry = 30  # seconds before due orders that were not expired are looked at again
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=self.workers,
+            help="Threads expiring orders in parallel",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=self.batch_size,
+            help="Orders claimed per transaction",
+        )
 
     def clean_orders(self, *args, **options):
-        """Continuously checks order expiration times for 1 hour. If order
-        has expires, it calls the logics module for expiration handling."""
+        """Keeps a min-heap of (expires_at, order id) of the active orders and
+        sleeps until the next one is due. Every order save is notified by Postgres
+        (see api.models.notify_order_change), so the heap follows Logics without
+        polling the orders table. A full reload every `resync` seconds covers
+        anything missed. Due orders are handed to the logics module for
+        expiration handling, those that were not expired go back to the heap.
+        Several replicas can run at once, see claim."""
 
         # TODO handle 'database is locked'
 
-        do_nothing = [
-            Order.Status.UCA,
-            Order.Status.EXP,
-            Order.Status.DIS,
-            Order.Status.CCA,
-            Order.Status.PAY,
-            Order.Status.SUC,
-            Order.Status.FAI,
-            Order.Status.MLD,
-            Order.Status.TLD,
-            Order.Status.WFR,
-        ]
+        self.queue = []  # heap of (expires_at timestamp, order id)
+        self.entries = {}  # order id -> expires_at timestamp
+
+        self.listen()
+        self.load_orders()
+        last_resync = time.time()
 
         while True:
-            time.sleep(5)
+            now = time.time()
+            timeout = last_resync + self.resync - now
+            if len(self.queue) > 0:
+                timeout = min(timeout, self.queue[0][0] - now)
+
+            changed = self.wait_for_changes(max(timeout, 0))
+            if len(changed) > 0:
+                self.load_orders(changed)
+
+            due = self.pop_due()
+            expired = self.expire_orders(due)
+            self.retry_later(set(due) - expired)
+
+            if time.time() - last_resync > self.resync:
+                self.load_orders()
+                last_resync = time.time()
+
+    def listen(self):
+        connection.ensure_connection()
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN "{ORDER_CHANGES_CHANNEL}"')
+
+    def wait_for_changes(self, timeout):
+        """Sleeps up to `timeout` seconds. Returns the ids of the orders
+        notified as changed meanwhile."""
+
+        pg_connection = connection.connection
+        changed = set()
+        # Our own queries can also pick up notifications, do not wait on those
+        if len(pg_connection.notifies) == 0:
+            if select.select([pg_connection], [], [], timeout) != ([], [], []):
+                pg_connection.poll()
+        while pg_connection.notifies:
+            notify = pg_connection.notifies.pop(0)
+            changed.add(int(notify.payload))
+        return changed
+
+    def load_orders(self, order_ids=None):
+        """(Re)schedules the given orders, or all active orders when None"""
+
+        queryset = Order.objects.all()
+        if order_ids != None:
+            queryset = queryset.filter(id__in=order_ids)
+        else:
+            queryset = queryset.filter(status__in=self.expirable)
+            self.queue = []
+            self.entries = {}
+
+        seen = set()
+        for order_id, status, expires_at in queryset.values_list(
+                "id", "status", "expires_at"):
+            seen.add(order_id)
+            if status not in self.expirable:
+                self.entries.pop(order_id, None)
+                continue
+            self.schedule(order_id, expires_at.timestamp())
+
+        # Deleted orders
+        if order_ids != None:
+            for order_id in set(order_ids) - seen:
+                self.entries.pop(order_id, None)
+
+    def schedule(self, order_id, expires_at):
+        if self.entries.get(order_id) == expires_at:
+            return
+        self.entries[order_id] = expires_at
+        heapq.heappush(self.queue, (expires_at, order_id))
+
+    def pop_due(self):
+        now = time.time()
+        due = []
+        while len(self.queue) > 0 and self.queue[0][0] <= now:
+            expires_at, order_id = heapq.heappop(self.queue)
+            # Stale heap item: order left the schedule or was rescheduled since
+            if self.entries.get(order_id) != expires_at:
+                continue
+            del self.entries[order_id]
+            due.append(order_id)
+        return due
+
+    def retry_later(self, order_ids):
+        """Puts back due orders that were not expired: claimed by another
+        replica, failed, or not due after all (the heap was behind). They are
+        looked at again when due, but not before `retry` seconds."""
+
+        if len(order_ids) == 0:
+            return
+        for order_id, expires_at in Order.objects.filter(
+                id__in=order_ids, status__in=self.expirable).values_list(
+                    "id", "expires_at"):
+            self.schedule(order_id, max(expires_at.timestamp(), time.time() + self.retry))
+
+    def expire_orders(self, order_ids):
+        """Splits the due orders in batches, expired in parallel by the workers.
+        Returns the ids of the expired orders."""
 
-            queryset = Order.objects.exclude(status__in=do_nothing)
+        if len(order_ids) == 0:
+            return set()
+
+        batches = [
+            order_ids[i:i + self.batch_size]
+            for i in range(0, len(order_ids), self.batch_size)
+        ]
+
+        debug = {}
+        debug["num_expired_orders"] = 0
+        debug["expired_orders"] = []
+        debug["failed_order_expiry"] = []
+        debug["reason_failure"] = []
+
+        for result in self.executor.map(self.expire_batch, batches):
+            for key in debug:
+                debug[key] += result[key]
+
+        if debug["num_expired_orders"] > 0:
+            self.stdout.write(str(timezone.now()))
+            self.stdout.write(str(debug))
+
+        return {
+            order_id for expired in debug["expired_orders"] for order_id in expired
+        }
+
+    def claim_key(self, order_id):
+        return f"expiring_order_{order_id}"
+
+    def claim(self, order_ids):
+        """Due orders of `order_ids` nobody else is expiring. The row locks only
+        last for the claim, a lease in Redis keeps other workers and replicas
+        away while the order is expired."""
+
+        with transaction.atomic():
+            # Double check against the database, the heap could be behind
+            queryset = Order.objects.select_for_update(
+                skip_locked=True).filter(id__in=order_ids,
+                                         status__in=self.expirable)
             queryset = queryset.filter(
-                expires_at__lt=timezone.now())  # expires at lower than now
+                expires_at__lte=timezone.now())  # expires at lower than now
 
-            debug = {}
-            debug["num_expired_orders"] = len(queryset)
-            debug["expired_orders"] = []
-            debug["failed_order_expiry"] = []
-            debug["reason_failure"] = []
+            return [
+                order for order in queryset if cache.add(
+                    self.claim_key(order.id), 1, timeout=self.claim_timeout)
+            ]
 
-            for idx, order in enumerate(queryset):
+    def expire_batch(self, order_ids):
+        """Runs in a worker thread. Orders claimed by another worker or replica
+        are skipped, that one is already expiring them. No transaction is open
+        while LND is called: every change is committed right after the bond or
+        escrow call it follows, so a failure halfway does not undo what
+        LND already did."""
+
+        debug = {}
+        debug["expired_orders"] = []
+        debug["failed_order_expiry"] = []
+        debug["reason_failure"] = []
+
+        try:
+            orders = self.claim(order_ids)
+            debug["num_expired_orders"] = len(orders)
+
+            for order in orders:
                 context = str(order) + " was " + Order.Status(
                     order.status).label
                 try:
                     if Logics.order_expires(
                             order):  # Order send to expire here
-                        debug["expired_orders"].append({idx: context})
+                        debug["expired_orders"].append(
+                            {order.id: context})
 
                 # It should not happen, but if it cannot locate the hold invoice
                 # it probably was cancelled by another thread, make it expire anyway.
                 except Exception as e:
-                    debug["failed_order_expiry"].append({idx: context})
-                    debug["reason_failure"].append({idx: str(e)})
-                    
+                    debug["failed_order_expiry"].append({order.id: context})
+                    debug["reason_failure"].append({order.id: str(e)})
+
                     if "unable to locate invoice" in str(e):
                         self.stdout.write(str(e))
                         order.status = Order.Status.EXP
                         order.save()
-                        debug["expired_orders"].append({idx: context})
+                        debug["expired_orders"].append({order.id: context})
+                finally:
+                    cache.delete(self.claim_key(order.id))
+        finally:
+            connection.close()
 
-            if debug["num_expired_orders"] > 0:
-                self.stdout.write(str(timezone.now()))
-                self.stdout.write(str(debug))
+        return debug
 
     def handle(self, *args, **options):
-        """Never mind database locked error, keep going, print them out"""
-        try:
-            self.clean_orders()
-        except Exception as e:
-            if "database is locked" in str(e):
-                self.stdout.write("database is locked")
+        """Never mind database locked error, keep going, print them out.
+        A lost connection also loses the LISTEN, so start over."""
+        self.workers = options["workers"]
+        self.batch_size = options["batch_size"]
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        while True:
+            try:
+                self.clean_orders()
+            except Exception as e:
+                if "database is locked" in str(e):
+                    self.stdout.write("database is locked")
 
-            self.stdout.write(str(e))
+                self.stdout.write(str(e))
+                connection.close()
+                time.sleep(5)
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand, CommandError
+from decouple import config
+
+from api.lightning.fake_lnd import serve
+import asyncio
+
+
+class Command(BaseCommand):
+
+    help = """Runs an in-memory fake LND gRPC server for load tests.
+    Generate a throwaway TLS pair, e.g.
+    openssl req -x509 -newkey ec -pkeyopt ec_paramgen_curve:prime256v1 -nodes
+        -days 30 -subj /CN=localhost -addext subjectAltName=DNS:localhost
+        -keyout fake.key -out fake.cert
+    then point LND_GRPC_HOST to localhost:<port> and LND_CERT_BASE64 to fake.cert"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=10009)
+        parser.add_argument("--cert", required=True, help="TLS certificate (PEM)")
+        parser.add_argument("--key", required=True, help="TLS private key (PEM)")
+        parser.add_argument("--latency", type=float, default=0,
+                            help="Seconds added to every call")
+        parser.add_argument("--jitter", type=float, default=0,
+                            help="Random extra seconds, up to this value")
+        parser.add_argument("--failure-rate", type=float, default=0,
+                            help="Fraction of unary calls failing as UNAVAILABLE")
+        parser.add_argument("--lock-after", type=float, default=None,
+                            help="Seconds until hold invoices are paid (ACCEPTED)")
+        parser.add_argument("--payment-time", type=float, default=1,
+                            help="Seconds a payment stays in flight")
+        parser.add_argument("--payment-failure-rate", type=float, default=0,
+                            help="Fraction of payments that fail")
+        parser.add_argument("--block-interval", type=float, default=600,
+                            help="Seconds per block")
+        parser.add_argument("--network", default=config("NETWORK", default="testnet"),
+                            help="Network of the invoices (mainnet, testnet, regtest, signet)")
+
+    def handle(self, *args, **options):
+        with open(options["cert"], "rb") as f:
+            cert = f.read()
+        with open(options["key"], "rb") as f:
+            key = f.read()
+
+        asyncio.run(self.run(cert, key, options))
+
+    async def run(self, cert, key, options):
+        server, state = await serve(
+            options["port"],
+            cert,
+            key,
+            latency=options["latency"],
+            jitter=options["jitter"],
+            failure_rate=options["failure_rate"],
+            lock_after=options["lock_after"],
+            payment_time=options["payment_time"],
+            payment_failure_rate=options["payment_failure_rate"],
+            block_interval=options["block_interval"],
+            network=options["network"],
+        )
+        self.stdout.write(f"Fake LND listening on port {options['port']}")
+
+        while True:
+            await asyncio.sleep(60)
+            self.stdout.write(
+                f"{len(state.invoices)} invoices, {len(state.payments)} payments, height {state.block_height()}")
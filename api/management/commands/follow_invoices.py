@@ -1,42 +1,97 @@
 from django.core.management.base import BaseCommand, CommandError
+from asgiref.sync import sync_to_async
 
-from api.lightning.node import LNNode
-from api.tasks import follow_send_payment
+from api.lightning.node import LNNode, MACAROON_METADATA, DEADLINES
+from api.lightning.aio import AsyncLNNode
+from api.lightning.scheduler import InvoiceScheduler
+from api.leases import PartitionLeases
 from api.models import LNPayment, Order
 from api.logics import Logics
 from api.tasks import send_message
 
 from django.utils import timezone
-from datetime import timedelta
-from decouple import config
-from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from django.utils.functional import cached_property
+import numpy as np
+import asyncio
+import json
 import time
 
-MACAROON = b64decode(config("LND_MACAROON_BASE64"))
-
 
 class Command(BaseCommand):
 
     help = "Follows all active hold invoices"
     rest = 5  # seconds between consecutive checks for invoice updates
+    sweep = 60  # seconds between consistency lookups when streaming
+    concurrency = 32  # max LookupInvoiceV2 calls in flight
+    deadline = DEADLINES["LookupInvoiceV2"]  # seconds before a lookup is given up
+    block_height = None
+    block_height_time = 0
+    leases = None  # PartitionLeases when running --partitioned
+    partitions = None  # first payment hash hex digits this replica follows, None for all
+
+    # Reverse relations from a hold invoice to its order, and everything
+    # Logics reads from that order when a bond or escrow changes.
+    owner_relations = ("order_made", "order_taken", "order_escrow")
+    owner_related = [
+        f"{relation}__{field}" for relation in owner_relations
+        for field in ("maker__profile", "taker__profile", "currency")
+    ]
+
+    lnd_state_to_lnpayment_status = {
+        0: LNPayment.Status.INVGEN,  # OPEN
+        1: LNPayment.Status.SETLED,  # SETTLED
+        2: LNPayment.Status.CANCEL,  # CANCELLED
+        3: LNPayment.Status.LOCKED,  # ACCEPTED
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            help="Subscribe to every active hold invoice instead of polling them",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=self.concurrency,
+            help="Max number of concurrent invoice lookups",
+        )
+        parser.add_argument(
+            "--deadline",
+            type=float,
+            default=self.deadline,
+            help="Seconds before a single invoice lookup times out",
+        )
+        parser.add_argument(
+            "--partitioned",
+            action="store_true",
+            help="Share the invoices with other replicas started with --partitioned",
+        )
 
     def handle(self, *args, **options):
-        """Infinite loop to check invoices and retry payments.
+        """Infinite loop to check invoices. Payouts are sent by follow_payouts.
         ever mind database locked error, keep going, print out"""
 
+        self.concurrency = options["concurrency"]
+        self.deadline = options["deadline"]
+        if options["partitioned"]:
+            self.leases = PartitionLeases("follow_invoices")
+
+        if options["stream"]:
+            asyncio.run(self.stream_hold_invoices())
+            return
+
         while True:
             time.sleep(self.rest)
 
             try:
+                self.rebalance()
                 self.follow_hold_invoices()
             except Exception as e:
                 self.stdout.write(str(e))
-            try:
-                self.send_payments()
-            except Exception as e:
-                self.stdout.write(str(e))
 
-    def follow_hold_invoices(self):
+    def follow_hold_invoices(self, adaptive=True):
         """Follows and updates LNpayment objects
         until settled or canceled
 
@@ -45,140 +100,406 @@ class Command(BaseCommand):
         We are very interested on the other two states (CANCELLED and ACCEPTED).
         Therefore, this thread (follow_invoices) will iterate over all LNpayment
         objects and do InvoiceLookupV2 every X seconds to update their state 'live'
-        """
 
-        lnd_state_to_lnpayment_status = {
-            0: LNPayment.Status.INVGEN,  # OPEN
-            1: LNPayment.Status.SETLED,  # SETTLED
-            2: LNPayment.Status.CANCEL,  # CANCELLED
-            3: LNPayment.Status.LOCKED,  # ACCEPTED
-        }
+        SubscribeSingleInvoice does report ACCEPTED and CANCELLED. Running with
+        --stream uses it (see stream_hold_invoices) and this becomes a low rate sweep.
 
-        stub = LNNode.invoicesstub
+        If adaptive, only the invoices that the InvoiceScheduler considers
+        due are looked up. Otherwise every active invoice is.
+        """
 
         # time it for debugging
         t0 = time.time()
-        queryset = LNPayment.objects.filter(
-            type=LNPayment.Types.HOLD,
-            status__in=[LNPayment.Status.INVGEN, LNPayment.Status.LOCKED],
+        hold_lnpayments = self.active_hold_lnpayments()
+        num_active_invoices = len(hold_lnpayments)
+
+        if adaptive:
+            self.scheduler.sync(hold_lnpayments)
+            due = set(self.scheduler.pop_due())
+            hold_lnpayments = [
+                lnpayment for lnpayment in hold_lnpayments
+                if lnpayment.payment_hash in due
+            ]
+            block_height = self.get_block_height()
+
+        # LND round trips run concurrently (at most `concurrency` in flight),
+        # database writes and order transitions stay in this thread.
+        lookups = self.executor.map(
+            self.lookup_invoice,
+            [lnpayment.payment_hash for lnpayment in hold_lnpayments],
         )
 
-        debug = {}
-        debug["num_active_invoices"] = len(queryset)
-        debug["invoices"] = []
-        at_least_one_changed = False
+        report = {
+            "num_active_invoices": num_active_invoices,
+            "num_lookups": len(hold_lnpayments),
+            "num_errors": 0,
+            "invoices": [],
+        }
+        changes = self.review_lookups(hold_lnpayments, lookups, report)
+
+        if adaptive:
+            for hold_lnpayment in hold_lnpayments:
+                self.scheduler.reschedule(
+                    hold_lnpayment, hold_lnpayment.payment_hash in changes,
+                    block_height)
+
+        if len(changes) > 0:
+            self.apply_changes(changes)
+
+        return self.write_report(report, t0)
+
+    def active_hold_lnpayments(self):
+        """Only what the scheduler needs. Orders are loaded later, and only
+        for the invoices that changed."""
+
+        return list(self.active_hold_invoices().only(
+            "payment_hash", "status", "expires_at", "expiry_height"))
+
+    def review_lookups(self, hold_lnpayments, lookups, report):
+        """Copies the lookup results, (response, error, latency) tuples, into
+        the LNPayment objects and the report. No database access.
+        Returns the changes to be written with apply_changes."""
+
+        latencies = []
+        changes = {}
 
-        for idx, hold_lnpayment in enumerate(queryset):
+        for hold_lnpayment, (response, error, latency) in zip(hold_lnpayments, lookups):
+            latencies.append(latency)
             old_status = LNPayment.Status(hold_lnpayment.status).label
-            try:
-                # this is similar to LNNnode.validate_hold_invoice_locked
-                request = LNNode.invoicesrpc.LookupInvoiceMsg(
-                    payment_hash=bytes.fromhex(hold_lnpayment.payment_hash))
-                response = stub.LookupInvoiceV2(request,
-                                                metadata=[("macaroon",
-                                                           MACAROON.hex())])
-                hold_lnpayment.status = lnd_state_to_lnpayment_status[
-                    response.state]
-
-                # try saving expiry height
-                if hasattr(response, "htlcs"):
-                    try:
-                        hold_lnpayment.expiry_height = response.htlcs[
-                            0].expiry_height
-                    except:
-                        pass
 
-            except Exception as e:
+            if error == None:
+                self.update_hold_lnpayment(hold_lnpayment, response)
+            else:
+                report["num_errors"] += 1
                 # If it fails at finding the invoice: it has been canceled.
                 # In RoboSats DB we make a distinction between cancelled and returned (LND does not)
-                if "unable to locate invoice" in str(e):
-                    self.stdout.write(str(e))
+                if "unable to locate invoice" in str(error):
+                    self.stdout.write(str(error))
                     hold_lnpayment.status = LNPayment.Status.CANCEL
 
                 # LND restarted.
-                if "wallet locked, unlock it" in str(e):
+                if "wallet locked, unlock it" in str(error):
                     self.stdout.write(
                         str(timezone.now()) + " :: Wallet Locked")
                 # Other write to logs
                 else:
-                    self.stdout.write(str(e))
+                    self.stdout.write(str(error))
 
             new_status = LNPayment.Status(hold_lnpayment.status).label
 
             # Only save the hold_payments that change (otherwise this function does not scale)
-            changed = not old_status == new_status
-            if changed:
-                # self.handle_status_change(hold_lnpayment, old_status)
-                self.update_order_status(hold_lnpayment)
-                hold_lnpayment.save()
+            if not old_status == new_status:
+                changes[hold_lnpayment.payment_hash] = (
+                    hold_lnpayment.status, hold_lnpayment.expiry_height)
 
                 # Report for debugging
-                new_status = LNPayment.Status(hold_lnpayment.status).label
-                debug["invoices"].append({
-                    idx: {
-                        "payment_hash": str(hold_lnpayment.payment_hash),
-                        "old_status": old_status,
-                        "new_status": new_status,
-                    }
+                report["invoices"].append({
+                    "payment_hash": str(hold_lnpayment.payment_hash),
+                    "old_status": old_status,
+                    "new_status": new_status,
                 })
 
-            at_least_one_changed = at_least_one_changed or changed
+        if len(latencies) > 0:
+            report["lookup_p50"] = round(np.percentile(latencies, 50), 3)
+            report["lookup_p99"] = round(np.percentile(latencies, 99), 3)
+
+        return changes
+
+    def write_report(self, report, t0):
+        """One line per cycle with its wall time and lookup latencies.
+        The invoices that changed are only listed when there are any."""
+
+        report["wall_time"] = round(time.time() - t0, 3)
+        report["timestamp"] = str(timezone.now())
+
+        line = dict(report)
+        if len(line["invoices"]) == 0:
+            del line["invoices"]
+        self.stdout.write(json.dumps(line))
+
+        return report
+
+    def apply_changes(self, changes):
+        """Writes back invoices whose LND state changed and moves their orders
+        forward. `changes` maps payment_hash -> (status, expiry_height).
+        One query loads the invoices with their orders and participants,
+        one bulk UPDATE stores them, whatever the number of changes."""
+
+        lnpayments = list(
+            LNPayment.objects.filter(
+                payment_hash__in=list(changes.keys()),
+                status__in=[LNPayment.Status.INVGEN, LNPayment.Status.LOCKED],
+            ).select_related(*self.owner_related))
+
+        updated = []
+        for lnpayment in lnpayments:
+            status, expiry_height = changes[lnpayment.payment_hash]
+            # Already moved there meanwhile, e.g. by its SubscribeSingleInvoice
+            # stream while a sweep was waiting on LND.
+            if lnpayment.status == status:
+                continue
+            lnpayment.status, lnpayment.expiry_height = status, expiry_height
+            try:
+                self.update_order_status(lnpayment)
+            except Exception as e:
+                self.stdout.write(str(e))
+            updated.append(lnpayment)
 
-        debug["time"] = time.time() - t0
+        # Logics might have moved the same (cached) objects further, e.g. to
+        # RETNED, in which case that is what gets written.
+        LNPayment.objects.bulk_update(updated, ["status", "expiry_height"])
 
-        if at_least_one_changed:
-            self.stdout.write(str(timezone.now()))
-            self.stdout.write(str(debug))
+    @cached_property
+    def scheduler(self):
+        return InvoiceScheduler()
 
-    def send_payments(self):
-        """
-        Checks for invoices that are due to pay; i.e., INFLIGHT status and 0 routing_attempts.
-        Checks if any payment is due for retry, and tries to pay it.
+    def get_block_height(self):
+        """Best block height, refreshed at most every `sweep` seconds.
+        Used to bring forward lookups of HTLCs close to CLTV expiry"""
+
+        if time.time() - self.block_height_time > self.sweep:
+            try:
+                self.block_height = LNNode.get_block_height()
+                self.block_height_time = time.time()
+            except Exception as e:
+                self.stdout.write(str(e))
+        return self.block_height
+
+    @cached_property
+    def executor(self):
+        return ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def lookup_invoice(self, payment_hash):
+        """Single LookupInvoiceV2 with a deadline. Runs in the executor
+        threads, so it must not touch the database.
+        Returns (response, error, latency in seconds)"""
+
+        t0 = time.time()
+        try:
+            # this is similar to LNNnode.validate_hold_invoice_locked
+            request = LNNode.invoicesrpc.LookupInvoiceMsg(
+                payment_hash=bytes.fromhex(payment_hash))
+            response = LNNode.invoicesstub.LookupInvoiceV2(
+                request,
+                metadata=MACAROON_METADATA,
+                timeout=self.deadline,
+            )
+            return response, None, time.time() - t0
+        except Exception as e:
+            return None, e, time.time() - t0
+
+    def update_hold_lnpayment(self, hold_lnpayment, response):
+        """Copies the LND invoice state (LookupInvoiceV2 or
+        SubscribeSingleInvoice response) into the LNPayment object"""
+
+        hold_lnpayment.status = self.lnd_state_to_lnpayment_status[
+            response.state]
+
+        # try saving expiry height
+        if hasattr(response, "htlcs"):
+            try:
+                hold_lnpayment.expiry_height = response.htlcs[
+                    0].expiry_height
+            except:
+                pass
+
+    async def stream_hold_invoices(self):
+        """Event driven alternative to follow_hold_invoices.
+
+        Opens one SubscribeSingleInvoice stream per active hold invoice, so
+        a lock is noticed as soon as LND accepts the HTLC no matter how many
+        bonds are open. New invoices are picked up every `rest` seconds.
+        A full LookupInvoiceV2 sweep still runs every `sweep` seconds to catch
+        anything a broken stream might have missed. It runs as a task of its
+        own, so streamed updates and new invoices are not held up by it.
         """
 
-        queryset = LNPayment.objects.filter(
-            type=LNPayment.Types.NORM,
-            status=LNPayment.Status.FLIGHT,
-            in_flight=False,
-            routing_attempts=0,
-        )
+        node = AsyncLNNode()
+        streams = {}
+        sweep = None
+        last_sweep = 0
+
+        try:
+            while True:
+                try:
+                    await sync_to_async(self.rebalance)()
+                    active_hashes = await sync_to_async(self.active_hold_hashes)()
+                except Exception as e:
+                    self.stdout.write(str(e))
+                    active_hashes = None
 
-        queryset_retries = LNPayment.objects.filter(
-            type=LNPayment.Types.NORM,
-            status__in=[LNPayment.Status.VALIDI, LNPayment.Status.FAILRO],
-            in_flight=False,
-            last_routing_time__lt=(
-                timezone.now() - timedelta(minutes=int(config("RETRY_TIME")))),
-        )
+                # Forget finished streams, they are re-opened if still active.
+                # Streams of invoices handed to another replica are closed.
+                for payment_hash, task in list(streams.items()):
+                    if active_hashes != None and payment_hash not in active_hashes:
+                        task.cancel()
+                    if task.done():
+                        del streams[payment_hash]
+
+                if active_hashes == None:
+                    active_hashes = set()
+
+                for payment_hash in active_hashes - streams.keys():
+                    streams[payment_hash] = asyncio.create_task(
+                        self.follow_single_invoice(node, payment_hash))
+
+                # A slow sweep is not stacked with the next one
+                if (sweep == None or sweep.done()) and time.time() - last_sweep > self.sweep:
+                    sweep = asyncio.create_task(self.sweep_hold_invoices(node))
+                    last_sweep = time.time()
 
-        queryset = queryset.union(queryset_retries)
+                await asyncio.sleep(self.rest)
+        finally:
+            await node.close()
 
-        for lnpayment in queryset:
-            follow_send_payment(lnpayment.payment_hash)
+    async def sweep_hold_invoices(self, node):
+        """Looks up every active hold invoice over the grpc.aio channel, at most
+        `concurrency` at a time. Only the database read and the write back go
+        through sync_to_async, never the LND round trips."""
+
+        t0 = time.time()
+        try:
+            hold_lnpayments = await sync_to_async(self.active_hold_lnpayments)()
+            semaphore = asyncio.Semaphore(self.concurrency)
+            lookups = await asyncio.gather(*[
+                self.async_lookup_invoice(node, semaphore, lnpayment.payment_hash)
+                for lnpayment in hold_lnpayments
+            ])
+
+            report = {
+                "num_active_invoices": len(hold_lnpayments),
+                "num_lookups": len(hold_lnpayments),
+                "num_errors": 0,
+                "invoices": [],
+            }
+            changes = self.review_lookups(hold_lnpayments, lookups, report)
+            if len(changes) > 0:
+                await sync_to_async(self.apply_changes)(changes)
+
+            return self.write_report(report, t0)
+        except Exception as e:
+            self.stdout.write(str(e))
+
+    async def async_lookup_invoice(self, node, semaphore, payment_hash):
+        """lookup_invoice over the grpc.aio channel"""
+
+        async with semaphore:
+            t0 = time.time()
+            try:
+                response = await node.lookup_invoice(payment_hash,
+                                                     timeout=self.deadline)
+                return response, None, time.time() - t0
+            except Exception as e:
+                return None, e, time.time() - t0
+
+    def active_hold_hashes(self):
+        return set(
+            self.active_hold_invoices().values_list("payment_hash", flat=True))
+
+    def active_hold_invoices(self):
+        """Hold invoices still to be followed, by this replica"""
+
+        queryset = LNPayment.objects.filter(
+            type=LNPayment.Types.HOLD,
+            status__in=[LNPayment.Status.INVGEN, LNPayment.Status.LOCKED],
+        )
+        if self.partitions != None:
+            if len(self.partitions) == 0:
+                return queryset.none()
+            digits = "".join(["0123456789abcdef"[p] for p in sorted(self.partitions)])
+            queryset = queryset.filter(payment_hash__regex=f"^[{digits}]")
+        return queryset
+
+    def rebalance(self):
+        """Renews the partition leases. Needs the same database connection every
+        time (advisory locks belong to the session), which holds for the polling
+        loop and for sync_to_async in the streaming loop (single thread)."""
+
+        if self.leases == None:
+            return
+        partitions = self.leases.rebalance()
+        if partitions != self.partitions:
+            self.stdout.write(
+                str(timezone.now()) + " :: following partitions " +
+                str(sorted(partitions)))
+            self.partitions = partitions
+
+    async def follow_single_invoice(self, node, payment_hash):
+        """Follows one hold invoice until it leaves INVGEN/LOCKED"""
+
+        try:
+            async for response in node.subscribe_single_invoice(payment_hash):
+                finished = await sync_to_async(self.handle_invoice_update)(
+                    payment_hash, response)
+                if finished:
+                    return
+        except Exception as e:
+            # The stream is re-opened in the next discovery round
+            self.stdout.write(str(e))
+
+    def handle_invoice_update(self, payment_hash, response):
+        """Applies one streamed invoice update. Returns True once the
+        invoice does not need to be followed anymore"""
+
+        hold_lnpayment = LNPayment.objects.select_related(
+            *self.owner_related).get(payment_hash=payment_hash)
+        if hold_lnpayment.status not in [
+                LNPayment.Status.INVGEN, LNPayment.Status.LOCKED
+        ]:
+            return True
+
+        old_status = LNPayment.Status(hold_lnpayment.status).label
+        self.update_hold_lnpayment(hold_lnpayment, response)
+        new_status = LNPayment.Status(hold_lnpayment.status).label
+
+        if not old_status == new_status:
+            self.update_order_status(hold_lnpayment)
+            hold_lnpayment.save(update_fields=["status", "expiry_height"])
+            self.stdout.write(
+                str(timezone.now()) + " :: " + str(payment_hash) + " " +
+                old_status + " -> " + new_status)
+
+        return hold_lnpayment.status not in [
+            LNPayment.Status.INVGEN, LNPayment.Status.LOCKED
+        ]
+
+    def owning_order(self, lnpayment):
+        """Returns (relation, order) for the order this hold invoice belongs to.
+        Uses the select_related cache, no queries."""
+
+        for relation in self.owner_relations:
+            order = getattr(lnpayment, relation, None)
+            if order != None:
+                return relation, order
+        return None, None
 
     def update_order_status(self, lnpayment):
         """Background process following LND hold invoices
         can catch LNpayments changing status. If they do,
         the order status might have to change too."""
 
+        relation, order = self.owning_order(lnpayment)
+        if order == None:
+            return
+
         # If the LNPayment goes to LOCKED (ACCEPTED)
         if lnpayment.status == LNPayment.Status.LOCKED:
             try:
                 # It is a maker bond => Publish order.
-                if hasattr(lnpayment, "order_made"):
-                    Logics.publish_order(lnpayment.order_made)
-                    send_message.delay(lnpayment.order_made.id,'order_published')
+                if relation == "order_made":
+                    Logics.publish_order(order)
+                    send_message.delay(order.id,'order_published')
                     return
 
                 # It is a taker bond => close contract.
-                elif hasattr(lnpayment, "order_taken"):
-                    if lnpayment.order_taken.status == Order.Status.TAK:
-                        Logics.finalize_contract(lnpayment.order_taken)
+                elif relation == "order_taken":
+                    if order.status == Order.Status.TAK:
+                        Logics.finalize_contract(order)
                         return
 
                 # It is a trade escrow => move foward order status.
-                elif hasattr(lnpayment, "order_escrow"):
-                    Logics.trade_escrow_received(lnpayment.order_escrow)
+                elif relation == "order_escrow":
+                    Logics.trade_escrow_received(order)
                     return
 
             except Exception as e:
@@ -188,17 +509,8 @@ class Command(BaseCommand):
         # If it goes to CANCEL from LOCKED the bond was unlocked. Order had expired in both cases.
         # Testing needed for end of time trades!
         if lnpayment.status == LNPayment.Status.CANCEL:
-            if hasattr(lnpayment, "order_made"):
-                Logics.order_expires(lnpayment.order_made)
-                return
-
-            elif hasattr(lnpayment, "order_taken"):
-                Logics.order_expires(lnpayment.order_taken)
-                return
-
-            elif hasattr(lnpayment, "order_escrow"):
-                Logics.order_expires(lnpayment.order_escrow)
-                return
+            Logics.order_expires(order)
+            return
 
         # TODO If a lnpayment goes from LOCKED to INVGEN. Totally weird
         # halt the order
@@ -0,0 +1,173 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.lightning import bolt11
+from api.models import LNPayment
+from api.tasks import follow_send_payment, follow_track_payment
+
+from django.utils import timezone
+from datetime import timedelta
+from decouple import config
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Sends buyer payouts, many at a time. Run a single instance."
+    rest = 5  # seconds between checks for payouts that are due
+    reconcile = 300  # seconds between checks for payouts left in flight
+    max_payments = 32  # SendPaymentV2 streams in flight
+    max_per_destination = 4  # streams in flight towards the same node
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-payments",
+            type=int,
+            default=self.max_payments,
+            help="Max number of payouts in flight",
+        )
+        parser.add_argument(
+            "--max-per-destination",
+            type=int,
+            default=self.max_per_destination,
+            help="Max number of payouts in flight to the same destination node",
+        )
+
+    def handle(self, *args, **options):
+        """Infinite loop. Starts every payout that is due as long as there are
+        free slots, then waits until a slot frees up or `rest` seconds pass.
+        A slow route only holds one slot."""
+
+        self.max_payments = options["max_payments"]
+        self.max_per_destination = options["max_per_destination"]
+        self.executor = ThreadPoolExecutor(max_workers=self.max_payments)
+        self.running = {}  # future -> (payment_hash, destination)
+        last_reconcile = 0
+
+        while True:
+            # Also on startup: payouts claimed by a previous run that died
+            if time.time() - last_reconcile > self.reconcile:
+                try:
+                    self.track_payments()
+                except Exception as e:
+                    self.stdout.write(str(e))
+                last_reconcile = time.time()
+
+            try:
+                self.start_payments()
+            except Exception as e:
+                self.stdout.write(str(e))
+
+            if len(self.running) > 0:
+                done, _ = wait(self.running.keys(),
+                               timeout=self.rest,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    payment_hash, destination = self.running.pop(future)
+                    if future.exception() != None:
+                        self.stdout.write(
+                            f"{payment_hash}: {future.exception()}")
+            else:
+                time.sleep(self.rest)
+
+    def due_payments(self):
+        """
+        Checks for invoices that are due to pay; i.e., INFLIGHT status and 0 routing_attempts.
+        Checks if any payment is due for retry.
+        """
+
+        queryset = LNPayment.objects.filter(
+            type=LNPayment.Types.NORM,
+            status=LNPayment.Status.FLIGHT,
+            in_flight=False,
+            routing_attempts=0,
+        )
+
+        queryset_retries = LNPayment.objects.filter(
+            type=LNPayment.Types.NORM,
+            status__in=[LNPayment.Status.VALIDI, LNPayment.Status.FAILRO],
+            in_flight=False,
+            last_routing_time__lt=(
+                timezone.now() - timedelta(minutes=int(config("RETRY_TIME")))),
+        )
+
+        return queryset.union(queryset_retries).values_list(
+            "payment_hash", "invoice")
+
+    def stuck_payments(self):
+        """Payouts marked in flight that no worker of ours is following"""
+
+        return LNPayment.objects.filter(
+            type=LNPayment.Types.NORM,
+            status__in=[
+                LNPayment.Status.FLIGHT,
+                LNPayment.Status.VALIDI,
+                LNPayment.Status.FAILRO,
+            ],
+            in_flight=True,
+        ).values_list("payment_hash", "invoice")
+
+    def track_payments(self):
+        """Attaches to payouts LND might still be sending and records how they
+        ended. Those LND never started are released to be sent again."""
+
+        self.start_payments(self.stuck_payments(), self.track_payment)
+
+    def start_payments(self, payments=None, job=None):
+        payments = self.due_payments() if payments == None else payments
+        job = self.send_payment if job == None else job
+
+        in_flight = {}  # destination -> number of running payouts
+        running_hashes = set()
+        for payment_hash, destination in self.running.values():
+            in_flight[destination] = in_flight.get(destination, 0) + 1
+            running_hashes.add(payment_hash)
+
+        for payment_hash, invoice in payments:
+            if len(self.running) >= self.max_payments:
+                return
+            if payment_hash in running_hashes:
+                continue
+
+            destination = self.destination(invoice)
+            if in_flight.get(destination, 0) >= self.max_per_destination:
+                continue
+
+            # Stuck payouts are already claimed
+            if job == self.send_payment and not self.claim(payment_hash):
+                continue
+
+            future = self.executor.submit(job, payment_hash)
+            self.running[future] = (payment_hash, destination)
+            in_flight[destination] = in_flight.get(destination, 0) + 1
+            running_hashes.add(payment_hash)
+
+    def destination(self, invoice):
+        try:
+            return bolt11.decode(invoice).destination
+        except ValueError:
+            return None
+
+    def claim(self, payment_hash):
+        """Marks the payout as in flight. Only one follower can win the
+        claim, so a payout is never sent twice at the same time."""
+
+        return LNPayment.objects.filter(
+            payment_hash=payment_hash,
+            in_flight=False,
+        ).update(in_flight=True) == 1
+
+    def send_payment(self, payment_hash):
+        """Runs in a worker thread, which has its own DB connection"""
+
+        try:
+            follow_send_payment(payment_hash)
+        finally:
+            connection.close()
+
+    def track_payment(self, payment_hash):
+        try:
+            follow_track_payment(payment_hash)
+        finally:
+            connection.close()
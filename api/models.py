@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, connection, transaction
+from django.db.models import Q
 from django.contrib.auth.models import User
 from django.core.validators import (
     MaxValueValidator,
@@ -12,6 +13,7 @@ from django.dispatch import receiver
 from django.utils.html import mark_safe
 import uuid
 from django.conf import settings
+from model_utils import FieldTracker
 
 from decouple import config
 from pathlib import Path
@@ -155,6 +157,19 @@ class LNPayment(models.Model):
     class Meta:
         verbose_name = "Lightning payment"
         verbose_name_plural = "Lightning payments"
+        # Partial indexes only hold the few rows the followers look for,
+        # they do not grow with the history. Status values as in LNPayment.Status.
+        indexes = [
+            # follow_invoices: hold invoices Generated (0) or Locked (1)
+            models.Index(fields=["status"],
+                         name="lnpayment_active_hold_idx",
+                         condition=Q(type=1, status__in=[0, 1])),
+            # follow_payouts: payouts In flight (7) to start, or Valid (6) and
+            # Routing failed (9) to retry after last_routing_time
+            models.Index(fields=["status", "last_routing_time"],
+                         name="lnpayment_due_payout_idx",
+                         condition=Q(type=0, in_flight=False, status__in=[6, 7, 9])),
+        ]
 
     @property
     def hash(self):
@@ -372,6 +387,31 @@ class Order(models.Model):
     maker_platform_rated = models.BooleanField(default=False, null=False)
     taker_platform_rated = models.BooleanField(default=False, null=False)
 
+    # Previous values, for the post_save receivers
+    tracker = FieldTracker(fields=["status"])
+
+    class Meta:
+        # Status values as in Order.Status (not reachable from here)
+        indexes = [
+            # Public (1) order book, by currency and type
+            models.Index(fields=["currency", "type"],
+                         name="order_book_idx",
+                         condition=Q(status=1)),
+            # Orders a robot is part of and not finished yet: every status but
+            # Cancelled (4), Expired (5), Collaboratively cancelled (12),
+            # Sucessful trade (14) and lost disputes (17, 18)
+            models.Index(fields=["maker", "status"],
+                         name="order_maker_active_idx",
+                         condition=Q(status__in=[0, 1, 2, 3, 6, 7, 8, 9, 10, 11, 13, 15, 16])),
+            models.Index(fields=["taker", "status"],
+                         name="order_taker_active_idx",
+                         condition=Q(status__in=[0, 1, 2, 3, 6, 7, 8, 9, 10, 11, 13, 15, 16])),
+            # Orders clean_orders expires: Waiting for maker bond (0) to Fiat sent (10)
+            models.Index(fields=["expires_at"],
+                         name="order_expiry_idx",
+                         condition=Q(status__in=[0, 1, 2, 3, 6, 7, 8, 9, 10])),
+        ]
+
     def __str__(self):
         if self.has_range and self.amount == None:
             amt = str(float(self.min_amount))+"-"+ str(float(self.max_amount))
@@ -406,6 +446,53 @@ class Order(models.Model):
         return t_to_expire[status]
 
 
+# Postgres NOTIFY channel. clean_orders LISTENs to it to keep its expiry schedule up to date.
+ORDER_CHANGES_CHANNEL = "order_changes"
+
+@receiver(post_save, sender=Order)
+def notify_order_change(sender, instance, **kwargs):
+    """Delivered when the transaction commits, with the order id as payload"""
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)",
+                           [ORDER_CHANGES_CHANNEL, str(instance.id)])
+
+
+@receiver(post_save, sender=Order)
+def refresh_book_snapshot(sender, instance, created, **kwargs):
+    """Rebuilds the cached book (api/book.py) of the order's currency and type
+    when it enters or leaves the book."""
+    from api.book import rebuild
+
+    old_status = instance.tracker.previous("status")
+    moved = (created or instance.tracker.has_changed("status")) and (
+        Order.Status.PUB in [old_status, instance.status])
+
+    if moved:
+        currency, type = instance.currency_id, instance.type
+        transaction.on_commit(lambda: rebuild(currency, type))
+
+
+@receiver(post_save, sender=Order)
+def push_order_update(sender, instance, **kwargs):
+    """Bumps the order version and tells the order websocket consumers
+    (api/consumers.py) and long-polls (api/longpoll.py) to push the new order
+    state to their robots."""
+    from channels.layers import get_channel_layer
+    from asgiref.sync import async_to_sync
+    from api.longpoll import bump_version
+
+    def push():
+        try:
+            bump_version(instance.id)
+            async_to_sync(get_channel_layer().group_send)(
+                f"order_{instance.id}", {"type": "order_update"})
+        except Exception as e:
+            print(e)
+
+    transaction.on_commit(push)
+
+
 @receiver(pre_delete, sender=Order)
 def delete_lnpayment_at_order_deletion(sender, instance, **kwargs):
     to_delete = (
@@ -573,6 +660,42 @@ class Profile(models.Model):
                          self.get_avatar())
 
 
+class RateHistory(models.Model):
+    """
+    Exchange rate of a currency at a point in time, as cached
+    by cache_market every minute. Append only.
+
+    Rows older than RATE_HISTORY_FULL_DAYS are downsampled to one
+    per hour and those older than RATE_HISTORY_DAYS are deleted
+    (see the prune_rate_history task).
+    """
+
+    currency = models.ForeignKey(Currency,
+                                 null=False,
+                                 on_delete=models.CASCADE,
+                                 db_index=False)
+    rate = models.DecimalField(
+        max_digits=14,
+        decimal_places=4,
+        validators=[MinValueValidator(0)],
+    )
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Rate: {str(self.currency)} {self.rate} at {self.timestamp}"
+
+    class Meta:
+        verbose_name = "Exchange rate history"
+        verbose_name_plural = "Exchange rate history"
+        indexes = [
+            # Rate of a currency at a point in time (rates.rate_at)
+            models.Index(fields=["currency", "timestamp"],
+                         name="ratehistory_currency_time_idx"),
+            # Downsampling and retention
+            models.Index(fields=["timestamp"], name="ratehistory_time_idx"),
+        ]
+
+
 class MarketTick(models.Model):
     """
     Records tick by tick Non-KYC Bitcoin price.
@@ -645,9 +768,17 @@ class MarketTick(models.Model):
 
             tick.save()
 
+            from api.stats import record_tick
+            transaction.on_commit(lambda: record_tick(tick))
+
     def __str__(self):
         return f"Tick: {str(self.id)[:8]}"
 
     class Meta:
         verbose_name = "Market tick"
-        verbose_name_plural = "Market ticks"
\ No newline at end of file
+        verbose_name_plural = "Market ticks"
+        indexes = [
+            # Latest ticks of a currency (newest first, as PriceView walks it)
+            models.Index(fields=["currency", "-timestamp"],
+                         name="marketick_currency_time_idx"),
+        ]
\ No newline at end of file
@@ -0,0 +1,86 @@
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from django.utils import timezone
+from datetime import datetime
+
+from api.logics import Logics
+
+#######
+# Maker / taker presence. Every OrderView poll is a heartbeat written to Redis
+# (a key with TTL per order and role) instead of an UPDATE of the order row.
+# The last seen times are written back to the orders now and then by the
+# flush_presence task, in one bulk UPDATE, so they survive Redis restarts.
+#######
+
+ROLES = ("maker", "taker")
+TTL = 15 * 60  # seconds. Longer ago than 10 minutes is "Inactive" anyway
+DIRTY_KEY = "presence_dirty"  # Redis set of order ids with heartbeats to flush
+
+
+def presence_key(order_id, role):
+    return f"presence_{order_id}_{role}"
+
+
+def heartbeat(order, role):
+    """Notes down that the maker/taker was here just now"""
+    cache.set(presence_key(order.id, role), timezone.now().timestamp(), TTL)
+    get_redis_connection("default").sadd(DIRTY_KEY, order.id)
+
+
+def heartbeats(order_ids, role):
+    """Last heartbeat of the maker/taker of several orders, by order id.
+    Only for those seen in the last TTL seconds. One round trip."""
+
+    keys = {order_id: presence_key(order_id, role) for order_id in order_ids}
+    seen = cache.get_many(list(keys.values()))
+    return {
+        order_id: timezone.make_aware(datetime.utcfromtimestamp(seen[key]),
+                                      timezone.utc)
+        for order_id, key in keys.items() if key in seen
+    }
+
+
+def last_seen(orders, role):
+    """Last seen time of the maker/taker of several orders, by order id.
+    Recent heartbeats first, the order row otherwise."""
+
+    seen = heartbeats([order.id for order in orders], role)
+    return {
+        order.id: seen.get(order.id, getattr(order, f"{role}_last_seen"))
+        for order in orders
+    }
+
+
+def activity_status(order, role):
+    """'Active', 'Seen recently', 'Inactive' or None if never seen"""
+    seen = last_seen([order], role)[order.id]
+    if seen == None:
+        return None
+    return Logics.user_activity_status(seen)
+
+
+def flush(batch_size=1000):
+    """Writes the heartbeats received since the last flush to the orders.
+    Bulk UPDATE of the two last seen fields only, no signals are sent."""
+
+    from api.models import Order
+
+    redis = get_redis_connection("default")
+    num_flushed = 0
+    while True:
+        order_ids = [int(id) for id in redis.spop(DIRTY_KEY, batch_size)]
+        if len(order_ids) == 0:
+            break
+
+        orders = list(
+            Order.objects.filter(id__in=order_ids).only(
+                "id", "maker_last_seen", "taker_last_seen"))
+        for role in ROLES:
+            seen = last_seen(orders, role)
+            for order in orders:
+                setattr(order, f"{role}_last_seen", seen[order.id])
+
+        Order.objects.bulk_update(orders, ["maker_last_seen", "taker_last_seen"])
+        num_flushed += len(orders)
+
+    return num_flushed
@@ -0,0 +1,316 @@
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from decouple import config
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+import numpy as np
+import requests
+import time
+import warnings
+
+#######
+# Exchange rates from the public APIs in MARKET_PRICE_APIS. All of them are
+# asked at once (threads sharing one pooled Tor session), each with a hard
+# deadline. The answer is ready as soon as a quorum of them replied, so a slow
+# API does not hold up the others. Latency and success rate of every API are
+# kept in Redis (see source_stats()).
+#
+# The last good rates are cached. While a refresh is in flight (e.g. cache_market
+# runs overlap) or when every API failed, they are served instead, flagged as
+# not fresh. cache_market saves only fresh rates.
+#
+# Every API has a parser registered with @source, turning its response into a
+# vector aligned with the requested currencies (NaN where it has no rate). The
+# vectors are aggregated per currency (see aggregate()): outliers are rejected by
+# their distance to the median in MADs, and APIs that did not reply this time
+# still count with their last rates, weighted down as they get older.
+#
+# cache_market saves the rates to the Currency table and publishes them to a
+# Redis hash, where exchange_rate() reads them without touching the database.
+# It also appends them to the RateHistory table, for rate_at().
+#######
+
+APIS = config("MARKET_PRICE_APIS",
+              cast=lambda v: [s.strip() for s in v.split(",")])
+DEADLINE = config("MARKET_PRICE_DEADLINE", cast=float, default=20)  # seconds
+QUORUM = config("MARKET_PRICE_QUORUM", cast=int, default=len(APIS) // 2 + 1)
+AGGREGATION = config("MARKET_PRICE_AGGREGATION", default="mad")  # "median" or "mad"
+OUTLIER_MADS = config("MARKET_PRICE_OUTLIER_MADS", cast=float, default=3)
+MIN_SPREAD = 0.01  # Never reject rates within 1% * OUTLIER_MADS of the median
+MAX_AGE = config("MARKET_PRICE_MAX_AGE", cast=float, default=600)  # seconds
+
+LAST_GOOD_KEY = "rates_last_good"
+RATES_KEY = "rates_by_currency"  # Redis hash, currency id -> rate
+REFRESH_LOCK_KEY = "rates_refreshing"
+
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rates")
+session = None
+
+
+def get_session():
+    """One Tor session for all the APIs, its connections are reused"""
+
+    global session
+    if session == None:
+        session = requests.session()
+        adapter = HTTPAdapter(pool_connections=len(APIS), pool_maxsize=8)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        # Tor uses the 9050 port as the default socks port
+        session.proxies = {'http':  'socks5://127.0.0.1:9050',
+                           'https': 'socks5://127.0.0.1:9050'}
+    return session
+
+
+def source_name(api_url):
+    return urlparse(api_url).netloc
+
+
+def stats_key(api_url):
+    return f"rates_stats_{source_name(api_url)}"
+
+
+def record_fetch(api_url, success, latency):
+    pipe = get_redis_connection("default").pipeline()
+    key = stats_key(api_url)
+    pipe.hincrby(key, "requests", 1)
+    pipe.hset(key, "last_latency", latency)
+    if success:
+        pipe.hincrby(key, "successes", 1)
+        pipe.hincrbyfloat(key, "total_latency", latency)
+        pipe.hset(key, "last_success", time.time())
+    pipe.execute()
+
+
+def source_stats():
+    """Requests, success rate and latencies of every API, by name"""
+
+    redis = get_redis_connection("default")
+    stats = {}
+    for api_url in APIS:
+        raw = {k.decode(): float(v) for k, v in redis.hgetall(stats_key(api_url)).items()}
+        num_requests, successes = raw.get("requests", 0), raw.get("successes", 0)
+        stats[source_name(api_url)] = {
+            "requests": int(num_requests),
+            "success_rate": successes / num_requests if num_requests > 0 else None,
+            "avg_latency": raw["total_latency"] / successes if successes > 0 else None,
+            "last_latency": raw.get("last_latency"),
+            "last_success": raw.get("last_success"),
+        }
+    return stats
+
+
+SOURCES = {}
+
+
+def source(host):
+    """Registers the parser of the API responses from `host`"""
+
+    def register(parse):
+        SOURCES[host] = parse
+        return parse
+
+    return register
+
+
+def rates_vector(currencies, rate):
+    """Applies `rate` to every currency code, NaN if it fails"""
+
+    rates = []
+    for currency in currencies:
+        try:  # If a currency is missing place a NaN
+            rates.append(float(rate(currency)))
+        except:
+            rates.append(np.nan)
+    return np.array(rates)
+
+
+@source("blockchain.info")
+def parse_blockchain(prices, currencies):
+    return rates_vector(currencies, lambda currency: prices[currency]["last"])
+
+
+@source("yadio.io")
+def parse_yadio(prices, currencies):
+    return rates_vector(currencies, lambda currency: prices["BTC"][currency])
+
+
+def get_parser(api_url):
+    host = source_name(api_url)
+    for source_host, parse in SOURCES.items():
+        if host == source_host or host.endswith(f".{source_host}"):
+            return parse
+    return None
+
+
+def last_source_key(api_url):
+    return f"rates_source_{source_name(api_url)}"
+
+
+def fetch_source(api_url, currencies):
+    start = time.monotonic()
+    try:
+        prices = get_session().get(api_url, timeout=DEADLINE).json()
+        rates = get_parser(api_url)(prices, currencies)
+    except Exception as e:
+        record_fetch(api_url, False, time.monotonic() - start)
+        raise e
+    record_fetch(api_url, True, time.monotonic() - start)
+
+    cache.set(last_source_key(api_url), {
+        "currencies": list(currencies),
+        "rates": rates.tolist(),
+        "timestamp": time.time(),
+    }, timeout=None)
+    return rates
+
+
+def weighted_median(rates, weights):
+    """Median of every column of `rates` (sources x currencies), each source
+    weighted. NaN are left out, columns without rates give NaN."""
+
+    weights = np.where(np.isnan(rates), 0, weights[:, None])
+    order = np.argsort(np.where(np.isnan(rates), np.inf, rates), axis=0)
+    rates = np.take_along_axis(rates, order, axis=0)
+    cumulative = np.cumsum(np.take_along_axis(weights, order, axis=0), axis=0)
+    half = cumulative[-1] / 2
+
+    # Between the two middle rates if the weights split exactly in half
+    lower = np.argmax(cumulative >= half, axis=0)
+    upper = np.argmax(cumulative > half, axis=0)
+    columns = np.arange(rates.shape[1])
+    median = (rates[lower, columns] + rates[upper, columns]) / 2
+    return np.where(cumulative[-1] > 0, median, np.nan)
+
+
+def aggregate(rates, weights):
+    """Rates of every currency out of those of every source (rows).
+    Returns the rates and how many sources contributed to each."""
+
+    median = weighted_median(rates, weights)
+    if AGGREGATION == "mad":
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # All-NaN currencies
+            deviation = np.abs(rates - median)
+            mad = np.nanmedian(np.where(np.isnan(rates), np.nan, deviation), axis=0)
+            spread = np.maximum(1.4826 * mad, MIN_SPREAD * median)
+            outlier = deviation > OUTLIER_MADS * spread
+        rates = np.where(outlier, np.nan, rates)
+        median = weighted_median(rates, weights)
+
+    contributors = np.sum(~np.isnan(rates) & (weights[:, None] > 0), axis=0)
+    return median, contributors
+
+
+def fetch_rates(currencies):
+    """Rates of the APIs that replied before the deadline, as soon as QUORUM
+    of them did, plus the recent ones of the others. None if none replied."""
+
+    futures = {}
+    for api_url in APIS:
+        if get_parser(api_url) == None:
+            print(f"No parser for the market price API {api_url}")
+            continue
+        futures[executor.submit(fetch_source, api_url, currencies)] = api_url
+
+    fresh = {}
+    try:
+        for future in as_completed(futures, timeout=DEADLINE):
+            try:  # If one API is unavailable pass
+                fresh[futures[future]] = future.result()
+            except:
+                continue
+            if len(fresh) >= QUORUM:
+                break
+    except TimeoutError:
+        pass
+
+    if len(fresh) == 0:
+        return None  # Wops there is not API available!
+
+    api_rates = list(fresh.values())
+    weights = [1.0] * len(api_rates)
+
+    # The others, with their last rates weighted down by age
+    now = time.time()
+    for key, last in cache.get_many(
+            [last_source_key(u) for u in futures.values() if u not in fresh]).items():
+        age = now - last["timestamp"]
+        if last["currencies"] == list(currencies) and age < MAX_AGE:
+            api_rates.append(np.array(last["rates"]))
+            weights.append(1 - age / MAX_AGE)
+
+    rates, contributors = aggregate(np.array(api_rates), np.array(weights))
+    return rates.tolist(), contributors.tolist()
+
+
+def get_exchange_rates(currencies):
+    """
+    Params: list of currency codes.
+    Returns (rates, fresh): the aggregated rates list, or the last good one while
+    another refresh is in flight or if no API replied (fresh is then False).
+    None if there never was one.
+    """
+
+    last_good = last_rates(currencies)
+    stale = None if last_good == None else (last_good["rates"], False)
+
+    # Lock expires by itself, should the refreshing process die
+    if not cache.add(REFRESH_LOCK_KEY, 1, timeout=int(DEADLINE) + 10):
+        return stale
+
+    try:
+        fetched = fetch_rates(currencies)
+        if fetched == None:
+            return stale
+        rates, contributors = fetched
+        cache.set(LAST_GOOD_KEY, {
+            "currencies": list(currencies),
+            "rates": rates,
+            "contributors": contributors,
+            "timestamp": time.time(),
+        }, timeout=None)
+        return rates, True
+    finally:
+        cache.delete(REFRESH_LOCK_KEY)
+
+
+def last_rates(currencies):
+    """Last good rates of `currencies` with the number of APIs that contributed
+    to each and when they were fetched, or None"""
+
+    last_good = cache.get(LAST_GOOD_KEY)
+    if last_good == None or last_good["currencies"] != list(currencies):
+        return None
+    return last_good
+
+
+def publish_rates(rates):
+    """Makes the rates (by currency id) readable by exchange_rate()"""
+    get_redis_connection("default").hset(
+        RATES_KEY, mapping={id: float(rate) for id, rate in rates.items()})
+
+
+def exchange_rate(currency_id):
+    """Current rate of a currency. From Redis, from the database if not there."""
+
+    rate = get_redis_connection("default").hget(RATES_KEY, currency_id)
+    if rate == None:
+        from api.models import Currency
+        rate = Currency.objects.get(id=currency_id).exchange_rate
+    return float(rate)
+
+
+def rate_at(currency_id, timestamp):
+    """Rate of a currency at a point in time: the last one cached by then.
+    None if there is no history that old."""
+
+    from api.models import RateHistory
+
+    rate = RateHistory.objects.filter(
+        currency=currency_id,
+        timestamp__lte=timestamp).order_by("-timestamp").values_list(
+            "rate", flat=True).first()
+    return None if rate == None else float(rate)
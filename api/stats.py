@@ -0,0 +1,186 @@
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from django.db.models import Sum, F
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+from datetime import timedelta
+
+from api.models import MarketTick, Currency
+
+#######
+# Running market statistics for InfoView. Every new MarketTick adds its volume
+# and volume weighted premium to Redis hashes: one for the lifetime totals and
+# one per hour for the last day. Reads are a handful of hash lookups, whatever
+# the number of ticks. Missing hashes (e.g. Redis was flushed) are rebuilt once
+# from database aggregates.
+#
+# Rebuilds and new ticks take the same Redis lock. A rebuild notes up to when it
+# counted ticks, later ticks are added on top and earlier ones are already in.
+#
+# BTC (currency 1000) ticks count for the lifetime volume only. LN <-> BTC swap
+# premiums should not be mixed with FIAT.
+#
+# The last tick of every currency (PriceView) is cached until the next tick.
+#######
+
+BTC = 1000
+LIFETIME_KEY = "stats_lifetime"
+HOURS_READY_KEY = "stats_hours_ready"  # hourly buckets of the last day are complete
+HOUR_TTL = 25 * 60 * 60  # seconds
+LAST_TICKS_KEY = "stats_last_ticks"
+LOCK_KEY = "stats_lock"
+LOCK_TIMEOUT = 60  # seconds, in case the holder dies
+
+
+def hour_key(dt):
+    return f"stats_hour_{int(dt.replace(minute=0, second=0, microsecond=0).timestamp())}"
+
+
+def record_tick(tick):
+    """Adds a new tick to the running statistics"""
+
+    cache.delete(LAST_TICKS_KEY)
+
+    redis = get_redis_connection("default")
+    volume = float(tick.volume)
+    premium_volume = float(tick.premium) * volume
+
+    with redis.lock(LOCK_KEY, timeout=LOCK_TIMEOUT):
+        # Only add to what exists and does not count it yet. Otherwise it is
+        # rebuilt from the database, tick included.
+        if counts_after(redis.hget(LIFETIME_KEY, "until"), tick):
+            pipe = redis.pipeline()
+            pipe.hincrbyfloat(LIFETIME_KEY, "volume", volume)
+            if tick.currency_id != BTC:
+                pipe.hincrbyfloat(LIFETIME_KEY, "fiat_volume", volume)
+                pipe.hincrbyfloat(LIFETIME_KEY, "premium_volume", premium_volume)
+            pipe.execute()
+
+        if tick.currency_id != BTC and counts_after(redis.get(HOURS_READY_KEY), tick):
+            key = hour_key(tick.timestamp)
+            pipe = redis.pipeline()
+            pipe.hincrbyfloat(key, "volume", volume)
+            pipe.hincrbyfloat(key, "premium_volume", premium_volume)
+            pipe.expire(key, HOUR_TTL)
+            pipe.execute()
+
+
+def counts_after(until, tick):
+    """Whether running totals rebuilt with the ticks until `until` (a timestamp,
+    None if there are no totals) are missing `tick`"""
+
+    return until != None and tick.timestamp.timestamp() > float(until)
+
+
+def rebuild_lifetime(redis):
+    with redis.lock(LOCK_KEY, timeout=LOCK_TIMEOUT):
+        until = timezone.now()
+        ticks = MarketTick.objects.filter(timestamp__lte=until)
+        # Not aliased as "volume", F("volume") would refer to the sum then
+        totals = ticks.aggregate(sum_volume=Sum("volume"))
+        fiat = ticks.exclude(currency=BTC).aggregate(
+            sum_volume=Sum("volume"), sum_premium_volume=Sum(F("premium") * F("volume")))
+        lifetime = {
+            "volume": float(totals["sum_volume"] or 0),
+            "fiat_volume": float(fiat["sum_volume"] or 0),
+            "premium_volume": float(fiat["sum_premium_volume"] or 0),
+            "until": until.timestamp(),
+        }
+        redis.hset(LIFETIME_KEY, mapping=lifetime)
+    return lifetime
+
+
+def rebuild_hours(redis, now):
+    start = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=24)
+    with redis.lock(LOCK_KEY, timeout=LOCK_TIMEOUT):
+        until = timezone.now()
+        queryset = MarketTick.objects.filter(
+            timestamp__gte=start, timestamp__lte=until).exclude(
+                currency=BTC).annotate(hour=TruncHour("timestamp")).values("hour").annotate(
+                    sum_volume=Sum("volume"),
+                    sum_premium_volume=Sum(F("premium") * F("volume")))
+
+        pipe = redis.pipeline()
+        for hour in queryset:
+            key = hour_key(hour["hour"])
+            pipe.delete(key)
+            pipe.hset(key, mapping={
+                "volume": float(hour["sum_volume"]),
+                "premium_volume": float(hour["sum_premium_volume"]),
+            })
+            pipe.expire(key, HOUR_TTL)
+        pipe.set(HOURS_READY_KEY, until.timestamp(), ex=HOUR_TTL)
+        pipe.execute()
+
+
+def market_stats():
+    """Lifetime volume, last day volume and volume weighted premium.
+    The last day is the rolling 24 hours: the current hour, the 23 before it and
+    the share of the hour before those still in the window (its trades taken as
+    evenly spread). If there were no trades, the premium falls back to the
+    lifetime average."""
+
+    redis = get_redis_connection("default")
+    now = timezone.now()
+
+    lifetime = redis.hgetall(LIFETIME_KEY)
+    if len(lifetime) == 0:
+        lifetime = rebuild_lifetime(redis)
+    lifetime = {key if isinstance(key, str) else key.decode(): float(value)
+                for key, value in lifetime.items()}
+
+    if not redis.exists(HOURS_READY_KEY):
+        rebuild_hours(redis, now)
+
+    hour_start = now.replace(minute=0, second=0, microsecond=0)
+    weights = [1] * 24 + [1 - (now - hour_start) / timedelta(hours=1)]
+
+    pipe = redis.pipeline()
+    for hours_ago in range(len(weights)):
+        key = hour_key(now - timedelta(hours=hours_ago))
+        pipe.hget(key, "volume")
+        pipe.hget(key, "premium_volume")
+    values = pipe.execute()
+    last_day_volume = sum([w * float(v) for w, v in zip(weights, values[0::2])
+                           if v != None])
+    last_day_premium_volume = sum([w * float(v) for w, v in zip(weights, values[1::2])
+                                   if v != None])
+
+    if last_day_volume > 0:
+        avg_premium = last_day_premium_volume / last_day_volume
+    elif lifetime.get("fiat_volume", 0) > 0:
+        avg_premium = lifetime["premium_volume"] / lifetime["fiat_volume"]
+    else:
+        avg_premium = 0
+
+    return {
+        "last_day_nonkyc_btc_premium": round(avg_premium, 2),
+        "last_day_volume": last_day_volume,
+        "lifetime_volume": lifetime.get("volume", 0),
+    }
+
+
+def last_ticks():
+    """Last tick of every currency, by currency code (None if never traded)"""
+
+    payload = cache.get(LAST_TICKS_KEY)
+    if payload != None:
+        return payload
+
+    # One row per currency, walking the (currency, timestamp) index
+    ticks = MarketTick.objects.order_by("currency", "-timestamp").distinct("currency")
+    ticks = {tick.currency_id: tick for tick in ticks}
+
+    payload = {}
+    for currency in Currency.objects.all().order_by("currency"):
+        code = Currency.currency_dict[str(currency.currency)]
+        tick = ticks.get(currency.id)
+        payload[code] = None if tick == None else {
+            "price": tick.price,
+            "volume": tick.volume,
+            "premium": tick.premium,
+            "timestamp": tick.timestamp,
+        }
+
+    cache.set(LAST_TICKS_KEY, payload, timeout=None)
+    return payload
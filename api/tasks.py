@@ -61,16 +61,146 @@ def give_rewards():
 
     return results
 
+def handle_payment_update(lnpayment, order, response):
+    """Applies one SendPaymentV2 / TrackPaymentV2 update to the payout and its order.
+    Returns None while the payment is still going, (success, context) once it ended."""
+
+    from django.utils import timezone
+    from datetime import timedelta
+
+    from api.lightning.node import LNNode
+    from api.models import LNPayment, Order
+
+    if response.status == 0:  # Status 0 'UNKNOWN'
+        # Not sure when this status happens
+        lnpayment.in_flight = False
+        lnpayment.save()
+
+    if response.status == 1:  # Status 1 'IN_FLIGHT'
+        print("IN_FLIGHT")
+        lnpayment.status = LNPayment.Status.FLIGHT
+        lnpayment.in_flight = True
+        lnpayment.save()
+        order.status = Order.Status.PAY
+        order.save()
+
+    if response.status == 3:  # Status 3 'FAILED'
+        print("FAILED")
+        lnpayment.status = LNPayment.Status.FAILRO
+        lnpayment.last_routing_time = timezone.now()
+        lnpayment.routing_attempts += 1
+        lnpayment.failure_reason = response.failure_reason
+        lnpayment.in_flight = False
+        if lnpayment.routing_attempts > 2:
+            lnpayment.status = LNPayment.Status.EXPIRE
+            lnpayment.routing_attempts = 0
+        lnpayment.save()
+
+        order.status = Order.Status.FAI
+        order.expires_at = timezone.now() + timedelta(
+            seconds=order.t_to_expire(Order.Status.FAI))
+        order.save()
+        context = {
+            "routing_failed":
+            LNNode.payment_failure_context[response.failure_reason],
+            "IN_FLIGHT":False,
+        }
+        print(context)
+
+        # If failed due to not route, reset mission control. (This won't scale well, just a temporary fix)
+        # ResetMC deactivate temporary for tests
+        #if response.failure_reason==2:
+        #    LNNode.resetmc()
+
+        return False, context
+
+    if response.status == 2:  # Status 2 'SUCCEEDED'
+        print("SUCCEEDED")
+        lnpayment.status = LNPayment.Status.SUCCED
+        lnpayment.fee = float(response.fee_msat)/1000
+        lnpayment.preimage = response.payment_preimage
+        lnpayment.save()
+        order.status = Order.Status.SUC
+        order.expires_at = timezone.now() + timedelta(
+            seconds=order.t_to_expire(Order.Status.SUC))
+        order.save()
+        return True, None
+
+    return None
+
+def handle_payment_expired(lnpayment, order):
+    from django.utils import timezone
+    from datetime import timedelta
+
+    from api.models import LNPayment, Order
+
+    print("INVOICE EXPIRED")
+    lnpayment.status = LNPayment.Status.EXPIRE
+    lnpayment.last_routing_time = timezone.now()
+    lnpayment.in_flight = False
+    lnpayment.save()
+    order.status = Order.Status.FAI
+    order.expires_at = timezone.now() + timedelta(
+        seconds=order.t_to_expire(Order.Status.FAI))
+    order.save()
+    context = {"routing_failed": "The payout invoice has expired"}
+    return False, context
+
+@shared_task(name="flush_presence")
+def flush_presence():
+    """
+    Writes the maker/taker heartbeats kept in Redis to the orders last seen fields.
+    """
+    from api.presence import flush
+
+    results = {"num_flushed": flush()}
+    return results
+
+@shared_task(name="prune_rate_history")
+def prune_rate_history():
+    """
+    Keeps the exchange rate history compact. Older than RATE_HISTORY_FULL_DAYS,
+    only the first rate of every hour and currency is kept. Older than
+    RATE_HISTORY_DAYS, none.
+    """
+    from api.models import RateHistory
+    from decouple import config
+    from django.core.cache import cache
+    from django.db.models import Exists, OuterRef
+    from django.db.models.functions import TruncHour
+    from django.utils import timezone
+    from datetime import timedelta
+
+    now = timezone.now()
+    retention = now - timedelta(days=config("RATE_HISTORY_DAYS", cast=int, default=730))
+    full_resolution = now - timedelta(days=config("RATE_HISTORY_FULL_DAYS", cast=int, default=7))
+    full_resolution = full_resolution.replace(minute=0, second=0, microsecond=0)
+
+    num_expired, _ = RateHistory.objects.filter(timestamp__lt=retention).delete()
+
+    # From where the last run left it, whole hours only
+    start = max(cache.get("rate_history_downsampled_until", retention), retention)
+    window = RateHistory.objects.filter(timestamp__gte=start, timestamp__lt=full_resolution)
+    # Every rate with an earlier one in its hour goes (index range scans)
+    earlier_in_hour = RateHistory.objects.filter(
+        currency=OuterRef("currency"),
+        timestamp__gte=OuterRef("hour"),
+        timestamp__lt=OuterRef("timestamp"))
+    num_downsampled, _ = window.annotate(hour=TruncHour("timestamp")).filter(
+        Exists(earlier_in_hour)).delete()
+    cache.set("rate_history_downsampled_until", full_resolution, timeout=None)
+
+    results = {"num_expired": num_expired, "num_downsampled": num_downsampled}
+    return results
+
 @shared_task(name="follow_send_payment")
 def follow_send_payment(hash):
     """Sends sats to buyer, continuous update"""
 
     from decouple import config
-    from django.utils import timezone
-    from datetime import timedelta
 
-    from api.lightning.node import LNNode, MACAROON
-    from api.models import LNPayment, Order
+    from api.lightning.node import LNNode, MACAROON_METADATA, DEADLINES
+    from api.models import LNPayment
 
     lnpayment = LNPayment.objects.get(payment_hash=hash)
     fee_limit_sat = int(
@@ -86,84 +216,65 @@ def follow_send_payment(hash):
     )  # time out payment in 75 seconds
 
     order = lnpayment.order_paid
+    responded = False
     try:
         for response in LNNode.routerstub.SendPaymentV2(request,
-                                                        metadata=[
-                                                            ("macaroon",
-                                                             MACAROON.hex())
-                                                        ]):
+                                                        metadata=MACAROON_METADATA,
+                                                        timeout=DEADLINES["SendPaymentV2"]):
                                                         
+            responded = True
             lnpayment.in_flight = True
             lnpayment.save()
-                
-            if response.status == 0:  # Status 0 'UNKNOWN'
-                # Not sure when this status happens
-                lnpayment.in_flight = False
-                lnpayment.save()
-
-            if response.status == 1:  # Status 1 'IN_FLIGHT'
-                print("IN_FLIGHT")
-                lnpayment.status = LNPayment.Status.FLIGHT
-                lnpayment.in_flight = True
-                lnpayment.save()
-                order.status = Order.Status.PAY
-                order.save()
-
-            if response.status == 3:  # Status 3 'FAILED'
-                print("FAILED")
-                lnpayment.status = LNPayment.Status.FAILRO
-                lnpayment.last_routing_time = timezone.now()
-                lnpayment.routing_attempts += 1
-                lnpayment.failure_reason = response.failure_reason
-                lnpayment.in_flight = False
-                if lnpayment.routing_attempts > 2:
-                    lnpayment.status = LNPayment.Status.EXPIRE
-                    lnpayment.routing_attempts = 0
-                lnpayment.save()
-
-                order.status = Order.Status.FAI
-                order.expires_at = timezone.now() + timedelta(
-                    seconds=order.t_to_expire(Order.Status.FAI))
-                order.save()
-                context = {
-                    "routing_failed":
-                    LNNode.payment_failure_context[response.failure_reason],
-                    "IN_FLIGHT":False,
-                }
-                print(context)
-
-                # If failed due to not route, reset mission control. (This won't scale well, just a temporary fix)
-                # ResetMC deactivate temporary for tests
-                #if response.failure_reason==2:
-                #    LNNode.resetmc()
-
-                return False, context
-
-            if response.status == 2:  # Status 2 'SUCCEEDED'
-                print("SUCCEEDED")
-                lnpayment.status = LNPayment.Status.SUCCED
-                lnpayment.fee = float(response.fee_msat)/1000
-                lnpayment.preimage = response.payment_preimage
-                lnpayment.save()
-                order.status = Order.Status.SUC
-                order.expires_at = timezone.now() + timedelta(
-                    seconds=order.t_to_expire(Order.Status.SUC))
-                order.save()
-                return True, None
+
+            result = handle_payment_update(lnpayment, order, response)
+            if result != None:
+                return result
 
     except Exception as e:
         if "invoice expired" in str(e):
-            print("INVOICE EXPIRED")
-            lnpayment.status = LNPayment.Status.EXPIRE
-            lnpayment.last_routing_time = timezone.now()
+            return handle_payment_expired(lnpayment, order)
+
+        # LND never took the payment (e.g. unreachable). Release the claim so it is retried.
+        if not responded:
+            print(e)
+            lnpayment.in_flight = False
+            lnpayment.save()
+
+@shared_task(name="follow_track_payment")
+def follow_track_payment(hash):
+    """Attaches to a payout LND may already be sending (e.g. the process
+    that sent it died) and records its true outcome"""
+
+    import grpc
+
+    from api.lightning.node import LNNode, MACAROON_METADATA, DEADLINES
+    from api.models import LNPayment
+
+    lnpayment = LNPayment.objects.get(payment_hash=hash)
+    request = LNNode.routerrpc.TrackPaymentRequest(
+        payment_hash=bytes.fromhex(hash),
+        no_inflight_updates=True,
+    )
+
+    order = lnpayment.order_paid
+    try:
+        for response in LNNode.routerstub.TrackPaymentV2(request,
+                                                         metadata=MACAROON_METADATA,
+                                                         timeout=DEADLINES["TrackPaymentV2"]):
+            result = handle_payment_update(lnpayment, order, response)
+            if result != None:
+                return result
+
+    except grpc.RpcError as e:
+        if e.code() == grpc.StatusCode.NOT_FOUND:
+            # LND never started this payment, it is safe to send it again.
+            print("NOT INITIATED")
             lnpayment.in_flight = False
             lnpayment.save()
-            order.status = Order.Status.FAI
-            order.expires_at = timezone.now() + timedelta(
-                seconds=order.t_to_expire(Order.Status.FAI))
-            order.save()
-            context = {"routing_failed": "The payout invoice has expired"}
-            return False, context
+            return False, None
+        if "invoice expired" in str(e):
+            return handle_payment_expired(lnpayment, order)
+        print(e)
 
 @shared_task(name="lnpayments_cleansing")
 def lnpayments_cleansing():
@@ -206,35 +317,53 @@ def lnpayments_cleansing():
 @shared_task(name="cache_external_market_prices", ignore_result=True)
 def cache_market():
 
-    from .models import Currency
-    from .utils import get_exchange_rates
+    from .models import Currency, RateHistory
+    from .rates import get_exchange_rates, publish_rates
+    from .stats import LAST_TICKS_KEY
 
+    from django.core.cache import cache
     from django.utils import timezone
 
+    currency_keys = list(Currency.currency_dict.keys())
     currency_codes = list(Currency.currency_dict.values())
-    exchange_rates = get_exchange_rates(currency_codes)
+    exchange_rates, fresh = get_exchange_rates(currency_codes) or (None, False)
 
     results = {}
-    for i in range(len(Currency.currency_dict.values())):  # currencies are indexed starting at 1 (USD)
+    # Stale rates were saved, published and added to the history when fresh
+    if not fresh:
+        return results
 
-        rate = exchange_rates[i]
-        results[i] = {currency_codes[i], rate}
+    now = timezone.now()
+    currencies = []
+    for key, code, rate in zip(currency_keys, currency_codes, exchange_rates):
+        results[code] = rate
 
         # Do not update if no new rate was found
         if str(rate) == "nan":
             continue
-
-        # Create / Update database cached prices
-        currency_key = list(Currency.currency_dict.keys())[i]
-        Currency.objects.update_or_create(
-            id=int(currency_key),
-            currency=int(currency_key),
-            # if there is a Cached market prices matching that id, it updates it with defaults below
-            defaults={
-                "exchange_rate": float(rate),
-                "timestamp": timezone.now(),
-            },
-        )
+        currencies.append(Currency(id=int(key), currency=int(key),
+                                   exchange_rate=rate, timestamp=now))
+
+    # One UPDATE for all the cached prices. Missing currencies (first run) are inserted.
+    existing = set(Currency.objects.values_list("id", flat=True))
+    Currency.objects.bulk_update(
+        [currency for currency in currencies if currency.id in existing],
+        ["exchange_rate", "timestamp"])
+    new = [currency for currency in currencies if currency.id not in existing]
+    if len(new) > 0:
+        Currency.objects.bulk_create(new)
+        cache.delete(LAST_TICKS_KEY)  # PriceView lists them
+
+    publish_rates({currency.id: currency.exchange_rate for currency in currencies})
+    RateHistory.objects.bulk_create([
+        RateHistory(currency_id=currency.id, rate=currency.exchange_rate, timestamp=now)
+        for currency in currencies
+    ])
+
+    # Book satoshis, prices and premiums follow the new rates
+    from .book import reprice, rebuild
+    reprice({currency.id: float(currency.exchange_rate) for currency in currencies})
+    rebuild()
 
     return results
 
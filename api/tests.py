@@ -1,3 +1,1160 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from rest_framework.test import APIRequestFactory, force_authenticate
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from django.db import connection
+from django.utils import timezone
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decouple import config
+from unittest.mock import patch, AsyncMock
+from types import SimpleNamespace
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import StringIO
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
 
-# Create your tests here.
+import numpy as np
+import asyncio
+import grpc
+import hashlib
+import json
+import threading
+import time
+
+from api.models import Currency, RateHistory, Order, LNPayment, MarketTick
+from api.views import OrderView, BookView
+from api.consumers import OrderConsumer
+from api import presence, stats
+from api.longpoll import OrderLongPoll, VERSION_TTL, version_key, order_version, bump_version
+from api.tasks import prune_rate_history, cache_market
+from api.rates import (LAST_GOOD_KEY, REFRESH_LOCK_KEY, get_exchange_rates, publish_rates,
+                       weighted_median, aggregate, rate_at)
+from api.book import reprice, book_key, stats_key
+from api.lightning import bolt11
+from api.lightning.node import LNNode
+from api.lightning.scheduler import InvoiceScheduler
+from api.management.commands.check_query_plans import Command as CheckQueryPlans
+from api.management.commands.clean_orders import Command as CleanOrders
+from api.management.commands.follow_invoices import Command as FollowInvoices
+from api.management.commands.follow_payouts import Command as FollowPayouts
+
+
+class PruneRateHistoryTest(TestCase):
+
+    def setUp(self):
+        cache.delete("rate_history_downsampled_until")
+        self.usd = Currency.objects.create(id=1, currency=1, exchange_rate=30000)
+        self.eur = Currency.objects.create(id=2, currency=2, exchange_rate=28000)
+        self.hour = (timezone.now() - timedelta(days=30)).replace(
+            minute=0, second=0, microsecond=0)
+
+    def add_rates(self, currency, start, minutes):
+        RateHistory.objects.bulk_create([
+            RateHistory(currency=currency, rate=1000 + i,
+                        timestamp=start + timedelta(minutes=i))
+            for i in range(minutes)
+        ])
+
+    def test_downsamples_old_rates_to_first_of_hour(self):
+        # Two hours of minute rates for two currencies, a month ago
+        self.add_rates(self.usd, self.hour, 120)
+        self.add_rates(self.eur, self.hour, 120)
+        # Recent rates are kept at full resolution
+        self.add_rates(self.usd, timezone.now() - timedelta(hours=1), 30)
+
+        results = prune_rate_history()
+
+        self.assertEqual(results["num_downsampled"], 2 * (120 - 2))
+        old = RateHistory.objects.filter(timestamp__lt=self.hour + timedelta(hours=2))
+        self.assertEqual(
+            sorted(old.values_list("currency", "timestamp")),
+            sorted([(currency, self.hour + timedelta(hours=h))
+                    for currency in (1, 2) for h in (0, 1)]))
+        self.assertEqual(
+            RateHistory.objects.filter(
+                timestamp__gte=timezone.now() - timedelta(days=1)).count(), 30)
+
+    def test_expires_rates_past_retention(self):
+        self.add_rates(self.usd, timezone.now() - timedelta(days=800), 3)
+        self.add_rates(self.usd, self.hour, 3)
+
+        results = prune_rate_history()
+
+        self.assertEqual(results["num_expired"], 3)
+        self.assertEqual(RateHistory.objects.count(), 1)
+
+    def test_next_run_starts_where_the_last_one_left(self):
+        prune_rate_history()
+        self.add_rates(self.usd, self.hour, 60)
+
+        # Already downsampled window, rows inserted late are left alone
+        self.assertEqual(prune_rate_history()["num_downsampled"], 0)
+        self.assertEqual(RateHistory.objects.count(), 60)
+
+
+class RateAtTest(TestCase):
+
+    def setUp(self):
+        self.usd = Currency.objects.create(id=1, currency=1, exchange_rate=30000)
+        self.eur = Currency.objects.create(id=2, currency=2, exchange_rate=28000)
+        self.start = (timezone.now() - timedelta(days=30)).replace(
+            minute=0, second=0, microsecond=0)
+        RateHistory.objects.bulk_create([
+            RateHistory(currency=self.usd, rate=1000 + i,
+                        timestamp=self.start + timedelta(minutes=i))
+            for i in range(120)
+        ] + [RateHistory(currency=self.eur, rate=900, timestamp=self.start)])
+
+    def test_last_rate_by_then(self):
+        self.assertEqual(rate_at(self.usd.id, self.start), 1000)
+        self.assertEqual(rate_at(self.usd.id, self.start + timedelta(seconds=150)), 1002)
+        self.assertEqual(rate_at(self.usd.id, timezone.now()), 1119)
+        self.assertEqual(rate_at(self.eur.id, timezone.now()), 900)
+
+    def test_no_history_that_old(self):
+        self.assertEqual(rate_at(self.usd.id, self.start - timedelta(seconds=1)), None)
+        self.assertEqual(rate_at(3, timezone.now()), None)
+
+    def test_downsampled_history(self):
+        cache.delete("rate_history_downsampled_until")
+        prune_rate_history()
+        # Only the first rate of every hour is left
+        self.assertEqual(rate_at(self.usd.id, self.start + timedelta(minutes=59)), 1000)
+        self.assertEqual(rate_at(self.usd.id, self.start + timedelta(minutes=90)), 1060)
+
+
+class RepriceTest(TestCase):
+
+    def setUp(self):
+        self.usd = Currency.objects.create(id=1, currency=1, exchange_rate=30000)
+
+    def make_order(self, status, **kwargs):
+        return Order.objects.create(type=Order.Types.BUY,
+                                    currency=self.usd,
+                                    status=status,
+                                    expires_at=timezone.now(),
+                                    **kwargs)
+
+    def test_reprices_public_and_paused_orders(self):
+        public = self.make_order(Order.Status.PUB, amount=300, premium=0, last_satoshis=1)
+        paused = self.make_order(Order.Status.PAU, amount=300, premium=2, last_satoshis=1)
+        ranged = self.make_order(Order.Status.PUB, has_range=True, min_amount=100,
+                                 max_amount=600, premium=0, last_satoshis=1)
+        explicit = self.make_order(Order.Status.PUB, amount=300, is_explicit=True,
+                                   satoshis=50000, last_satoshis=50000)
+        taken = self.make_order(Order.Status.TAK, amount=300, premium=0, last_satoshis=1)
+
+        self.assertEqual(reprice({1: 40000.0}), 3)
+
+        public.refresh_from_db()
+        paused.refresh_from_db()
+        ranged.refresh_from_db()
+        explicit.refresh_from_db()
+        taken.refresh_from_db()
+        self.assertEqual(public.last_satoshis, 750000)
+        self.assertEqual(paused.last_satoshis, int(300 / (40000 * 1.02) * 100000000))
+        self.assertEqual(ranged.last_satoshis, 1500000)
+        self.assertEqual(explicit.last_satoshis, 50000)
+        self.assertEqual(taken.last_satoshis, 1)
+
+    def test_orders_taken_while_repricing_keep_their_amount(self):
+        order = self.make_order(Order.Status.PUB, amount=300, premium=0, last_satoshis=1)
+        trunc = np.trunc
+
+        def take_and_trunc(values):
+            # The order is taken and its trade amount fixed between read and write
+            Order.objects.filter(id=order.id).update(status=Order.Status.TAK,
+                                                     last_satoshis=700000)
+            return trunc(values)
+
+        with patch("api.book.np.trunc", side_effect=take_and_trunc):
+            self.assertEqual(reprice({1: 40000.0}), 0)
+
+        order.refresh_from_db()
+        self.assertEqual(order.last_satoshis, 700000)
+
+
+class QueryPlanTest(TestCase):
+    """The hot queries are served by their (partial) indexes. Sequential scans
+    are disabled, so the planner picks an index on these small tables too,
+    if there is one that fits."""
+
+    indexes = {
+        "book (BookView)": "order_book_idx",
+        "book count (MakerView)": "order_book_idx",
+        "maker active (validate_already_maker_or_taker)": "order_maker_active_idx",
+        "taker active (validate_already_maker_or_taker)": "order_taker_active_idx",
+        "expiries (clean_orders)": "order_expiry_idx",
+        "payouts due (follow_payouts)": "lnpayment_due_payout_idx",
+        "hold invoices (follow_invoices)": "lnpayment_active_hold_idx",
+        "last tick (PriceView)": "marketick_currency_time_idx",
+    }
+
+    def setUp(self):
+        # Orders of a few robots in every status, so that the planner weighs
+        # the indexes by how many rows each one holds
+        users = [User.objects.create(username=f"robot{i}") for i in range(10)]
+        currencies = [Currency.objects.create(id=i, currency=i, exchange_rate=30000)
+                      for i in (1, 2)]
+        statuses = list(Order.Status)
+        Order.objects.bulk_create([
+            Order(status=statuses[i % len(statuses)],
+                  type=i % 2,
+                  currency=currencies[i % 3 % 2],
+                  amount=100,
+                  maker=users[i % 10],
+                  taker=users[(i + 1) % 10],
+                  expires_at=timezone.now() + timedelta(minutes=i))
+            for i in range(2000)
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE "api_order"')
+            cursor.execute("SET enable_seqscan = off")
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute("RESET enable_seqscan")
+
+    def test_hot_queries_use_their_indexes(self):
+        queries = CheckQueryPlans().hot_queries()
+        self.assertEqual(set(queries), set(self.indexes))
+
+        for name, queryset in queries.items():
+            with self.subTest(name):
+                plan = queryset.explain()
+                self.assertNotIn("Seq Scan", plan)
+                self.assertIn(self.indexes[name], plan)
+
+
+class OrderViewQueriesTest(TestCase):
+    """OrderView.get runs the same number of queries for an order in a given
+    status, whatever else is in the database (see OrderView.query_budget)."""
+
+    def setUp(self):
+        self.usd = Currency.objects.create(id=1, currency=1, exchange_rate=30000)
+        User.objects.create(username=config("ESCROW_USERNAME"))
+        self.maker = User.objects.create(username="maker")
+        self.taker = User.objects.create(username="taker")
+        self.outsider = User.objects.create(username="outsider")
+        for user in (self.maker, self.taker, self.outsider):
+            user.profile.telegram_token = "token"
+            user.profile.save()
+        self.num_payments = 0
+        # As in production, rates are read from Redis (see exchange_rate)
+        publish_rates({self.usd.id: 30000})
+
+        # No Lightning node in tests: hold invoices are never found locked,
+        # new ones are made up
+        for method, mock in [("validate_hold_invoice_locked", {"return_value": False}),
+                             ("gen_hold_invoice", {"side_effect": self.hold_invoice})]:
+            patcher = patch(f"api.logics.LNNode.{method}", **mock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def hold_invoice(self, *args, **kwargs):
+        self.num_payments += 1
+        return {
+            "invoice": f"lnbc{self.num_payments}",
+            "preimage": f"{self.num_payments:064x}",
+            "payment_hash": f"{self.num_payments:064x}",
+            "created_at": timezone.now(),
+            "expires_at": timezone.now() + timedelta(hours=1),
+            "cltv_expiry": 100,
+        }
+
+    def payment(self, status, type=LNPayment.Types.HOLD, **kwargs):
+        self.num_payments += 1
+        return LNPayment.objects.create(payment_hash=f"{self.num_payments:064x}",
+                                        invoice=f"lnbc{self.num_payments}",
+                                        type=type,
+                                        status=status,
+                                        num_satoshis=10000,
+                                        created_at=timezone.now(),
+                                        expires_at=timezone.now() + timedelta(hours=1),
+                                        **kwargs)
+
+    def make_order(self, status):
+        """An order in `status` with the bonds, escrow and payout it has by then"""
+
+        locked = LNPayment.Status.LOCKED
+        order = Order(type=Order.Types.BUY,
+                      currency=self.usd,
+                      amount=300,
+                      premium=1,
+                      last_satoshis=1000000,
+                      status=status,
+                      maker=self.maker,
+                      expires_at=timezone.now() + timedelta(hours=1))
+        order.maker_bond = self.payment(
+            LNPayment.Status.INVGEN if status == Order.Status.WFB else locked)
+
+        if status not in [Order.Status.WFB, Order.Status.PUB, Order.Status.PAU,
+                          Order.Status.UCA]:
+            order.taker = self.taker
+            order.taker_bond = self.payment(
+                LNPayment.Status.INVGEN if status == Order.Status.TAK else locked)
+        if status >= Order.Status.WFI and status != Order.Status.CCA:
+            order.trade_escrow = self.payment(locked)
+        if status in [Order.Status.PAY, Order.Status.SUC, Order.Status.FAI]:
+            order.payout = self.payment(LNPayment.Status.FAILRO,
+                                        type=LNPayment.Types.NORM,
+                                        receiver=self.maker,
+                                        last_routing_time=timezone.now())
+        if status == Order.Status.EXP:
+            order.expiry_reason = Order.ExpiryReasons.NTAKEN
+        order.save()
+        return order
+
+    def get(self, order, user):
+        request = APIRequestFactory().get("/api/order/", {"order_id": order.id})
+        force_authenticate(request, user=user)
+        return OrderView.as_view({"get": "get"})(request)
+
+    def test_queries_per_status(self):
+        viewers = {"maker": self.maker, "taker": self.taker, "outsider": self.outsider}
+
+        for status in Order.Status:
+            order = self.make_order(status)
+            budget = OrderView.query_budget[status]
+            counts = []
+            for role, user in viewers.items():
+                with self.subTest(status=status.label, viewer=role):
+                    with CaptureQueriesContext(connection) as queries:
+                        self.get(order, user)
+                    self.assertLessEqual(len(queries), budget)
+                    counts.append(len(queries))
+            # The budget is tight, lower it if queries were saved
+            with self.subTest(status=status.label):
+                self.assertEqual(max(counts), budget)
+
+    def test_overruns_are_printed(self):
+        order = self.make_order(Order.Status.PUB)
+        with patch.dict(OrderView.query_budget, {Order.Status.PUB: 1}):
+            with patch("sys.stdout", new_callable=StringIO) as stdout:
+                self.get(order, self.maker)
+        self.assertIn("its budget is 1", stdout.getvalue())
+
+    def test_version_is_read_before_the_order(self):
+        order = self.make_order(Order.Status.PUB)
+        version = order_version(order.id)
+        order_queryset = OrderView.order_queryset
+
+        def change_and_load():
+            # The order changes while it is being loaded
+            bump_version(order.id)
+            return order_queryset()
+
+        with patch.object(OrderView, "order_queryset", side_effect=change_and_load):
+            response = self.get(order, self.maker)
+
+        # The client does not take the change as seen, its next long-poll returns
+        self.assertEqual(response.data["version"], version)
+
+    def test_long_polls_are_only_announced_under_asgi(self):
+        order = self.make_order(Order.Status.PUB)
+        self.assertFalse(self.get(order, self.maker).data["long_poll"])
+
+        request = APIRequestFactory().get("/api/order/", {"order_id": order.id})
+        request.scope = {"type": "http", "long_poll": True}  # As set by OrderLongPoll
+        force_authenticate(request, user=self.maker)
+        response = OrderView.as_view({"get": "get"})(request)
+        self.assertTrue(response.data["long_poll"])
+
+
+class OrderLongPollTest(TestCase):
+
+    def setUp(self):
+        usd = Currency.objects.create(id=1, currency=1, exchange_rate=30000)
+        self.maker = User.objects.create(username="maker")
+        self.taker = User.objects.create(username="taker")
+        self.outsider = User.objects.create(username="outsider")
+        self.order = Order.objects.create(type=Order.Types.BUY,
+                                          currency=usd,
+                                          status=Order.Status.WF2,
+                                          amount=300,
+                                          maker=self.maker,
+                                          taker=self.taker,
+                                          expires_at=timezone.now())
+
+    def scope(self, user=None):
+        headers = []
+        if user != None:
+            self.client.force_login(user)
+            cookie = self.client.cookies[settings.SESSION_COOKIE_NAME]
+            headers.append((b"cookie", f"{cookie.key}={cookie.value}".encode()))
+        return {
+            "type": "http",
+            "method": "GET",
+            "path": "/api/order/",
+            "query_string": f"order_id={self.order.id}&since=1".encode(),
+            "headers": headers,
+        }
+
+    def test_only_participants_are_held(self):
+        long_poll = OrderLongPoll(None)
+        self.assertTrue(long_poll.participant(self.scope(self.maker), self.order.id))
+        self.assertTrue(long_poll.participant(self.scope(self.taker), self.order.id))
+        self.assertFalse(long_poll.participant(self.scope(self.outsider), self.order.id))
+        self.assertFalse(long_poll.participant(self.scope(), self.order.id))
+
+    def test_others_are_passed_on_right_away(self):
+        app = AsyncMock()
+        # database_sync_to_async would close the connection of the test
+        with patch("api.longpoll.database_sync_to_async", sync_to_async), \
+                patch.object(OrderLongPoll, "wait") as wait:
+            async_to_sync(OrderLongPoll(app))(self.scope(self.outsider), None, None)
+            wait.assert_not_called()
+
+            async_to_sync(OrderLongPoll(app))(self.scope(self.maker), None, None)
+            wait.assert_awaited_once_with(self.order.id, 1)
+        self.assertEqual(app.await_count, 2)
+        # Both are told long-polls are held here
+        for call in app.await_args_list:
+            self.assertTrue(call.args[0]["long_poll"])
+
+    def test_versions_expire(self):
+        version = order_version(self.order.id)
+        self.assertEqual(bump_version(self.order.id), version + 1)
+        ttl = get_redis_connection("default").ttl(version_key(self.order.id))
+        self.assertTrue(0 < ttl <= VERSION_TTL)
+
+
+class CacheMarketTest(TestCase):
+
+    def setUp(self):
+        cache.delete_many([LAST_GOOD_KEY, REFRESH_LOCK_KEY])
+        self.codes = list(Currency.currency_dict.values())
+
+    def rates(self, rate):
+        return [rate] * len(self.codes), [1] * len(self.codes)
+
+    def test_saves_fresh_rates(self):
+        with patch("api.rates.fetch_rates", return_value=self.rates(30000.0)):
+            results = cache_market()
+
+        self.assertEqual(results["USD"], 30000.0)
+        self.assertEqual(Currency.objects.get(id=1).exchange_rate, 30000)
+        self.assertEqual(RateHistory.objects.count(), len(self.codes))
+
+    def test_skips_stale_rates(self):
+        with patch("api.rates.fetch_rates", return_value=self.rates(30000.0)):
+            cache_market()
+
+        # Every API failed, and then a refresh is in flight
+        with patch("api.rates.fetch_rates", return_value=None), \
+                patch("api.book.reprice") as reprice:
+            self.assertEqual(get_exchange_rates(self.codes), ([30000.0] * len(self.codes), False))
+            self.assertEqual(cache_market(), {})
+            cache.add(REFRESH_LOCK_KEY, 1)
+            self.assertEqual(cache_market(), {})
+        reprice.assert_not_called()
+        self.assertEqual(RateHistory.objects.count(), len(self.codes))
+
+
+class CleanOrdersTest(TestCase):
+
+    def setUp(self):
+        self.usd = Currency.objects.create(id=1, currency=1, exchange_rate=30000)
+        self.command = CleanOrders(stdout=StringIO())
+        self.command.executor = SimpleNamespace(map=map)  # No threads, same connection
+        self.command.queue = []
+        self.command.entries = {}
+        # The workers close their connection when done, not the one of the test
+        patcher = patch.object(connection, "close")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_order(self, expires_at):
+        order = Order.objects.create(type=Order.Types.BUY,
+                                     currency=self.usd,
+                                     status=Order.Status.PUB,
+                                     amount=300,
+                                     expires_at=expires_at)
+        cache.delete(self.command.claim_key(order.id))
+        return order
+
+    def test_no_transaction_is_open_while_expiring(self):
+        order = self.make_order(timezone.now())
+        savepoints = len(connection.savepoint_ids)
+
+        def order_expires(order):
+            # Neither the claim's row locks nor a savepoint are held meanwhile
+            self.assertEqual(len(connection.savepoint_ids), savepoints)
+            self.assertTrue(cache.get(self.command.claim_key(order.id)))
+            return True
+
+        with patch("api.management.commands.clean_orders.Logics.order_expires",
+                   side_effect=order_expires) as expires:
+            self.assertEqual(self.command.expire_orders([order.id]), {order.id})
+        expires.assert_called_once()
+        self.assertEqual(cache.get(self.command.claim_key(order.id)), None)
+
+    def test_orders_claimed_elsewhere_are_retried_later(self):
+        claimed = self.make_order(timezone.now() - timedelta(minutes=1))
+        cache.add(self.command.claim_key(claimed.id), 1)
+        # The heap was behind, the expiry was extended meanwhile
+        later = timezone.now() + timedelta(hours=1)
+        extended = self.make_order(later)
+        for order in (claimed, extended):
+            self.command.schedule(order.id, time.time() - 1)
+
+        due = self.command.pop_due()
+        with patch("api.management.commands.clean_orders.Logics.order_expires") as expires:
+            self.assertEqual(self.command.expire_orders(due), set())
+        expires.assert_not_called()
+        self.command.retry_later(set(due))
+
+        self.assertGreaterEqual(self.command.entries[claimed.id],
+                                time.time() + self.command.retry - 1)
+        self.assertEqual(self.command.entries[extended.id], later.timestamp())
+        self.assertEqual(len(self.command.pop_due()), 0)
+
+
+class Bolt11Test(SimpleTestCase):
+
+    # Examples of the BOLT #11 spec, all signed by the same node
+    payee = "03e7156ae33b0a208d0744199163177e909e80176e55d97a2f221ede0f934dd9ad"
+    payment_hash = "0001020304050607080900010203040506070809000102030405060708090102"
+    donation = (
+        "lnbc1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygspp5qq"
+        "qsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdpl2pkx2ctnv5sxxmmwwd5"
+        "kgetjypeh2ursdae8g6twvus8g6rfwvs8qun0dfjkxaq9qrsgq357wnc5r2ueh7ck6q93dj3"
+        "2dlqnls087fxdwk8qakdyafkq3yap9us6v52vjjsrvywa6rt52cm9r9zqt8r2t7mlcwspyet"
+        "p5h2tztugp9lfyql")
+    coffee = (
+        "lnbc2500u1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygs"
+        "pp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdq5xysxxatsyp3k7e"
+        "nxv4jsxqzpu9qrsgquk0rl77nj30yxdy8j9vdx85fkpmdla2087ne0xh8nhedh8w27kyke0l"
+        "p53ut353s06fv3qfegext0eh0ymjpf39tuven09sam30g4vgpfna3rh")
+    hashed = (
+        "lnbc20m1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygspp"
+        "5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqhp58yjmdan79s6qqdhd"
+        "zgynm4zwqd5d7xmw5fk98klysy043l2ahrqs9qrsgq7ea976txfraylvgzuxs8kgcw23ezlr"
+        "szfnh8r6qtfpr6cxga50aj6txm9rxrydzd06dfeawfk6swupvz4erwnyutnjq7x39ymw6j38"
+        "gp7ynn44")
+    routed = (
+        "lnbc20m1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygspp"
+        "5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqhp58yjmdan79s6qqdhd"
+        "zgynm4zwqd5d7xmw5fk98klysy043l2ahrqsfpp3qjmp7lwpagxun9pygexvgpjdc4jdj85f"
+        "r9yq20q82gphp2nflc7jtzrcazrra7wwgzxqc8u7754cdlpfrmccae92qgzqvzq2ps8pqqqq"
+        "qqpqqqqq9qqqvpeuqafqxu92d8lr6fvg0r5gv0heeeqgcrqlnm6jhphu9y00rrhy4grqszsv"
+        "pcgpy9qqqqqqgqqqqq7qqzq9qrsgqdfjcdk6w3ak5pca9hwfwfh63zrrz06wwfya0ydlzpgz"
+        "xkn5xagsqz7x9j4jwe7yj7vaf2k9lqsdk45kts2fd0fkr28am0u4w95tt2nsq76cqw0")
+    pico = (
+        "lnbc9678785340p1pwmna7lpp5gc3xfm08u9qy06djf8dfflhugl6p7lgza6dsjxq454gxhj"
+        "9t7a0sd8dgfkx7cmtwd68yetpd5s9xar0wfjn5gpc8qhrsdfq24f5ggrxdaezqsnvda3kkum"
+        "5wfjkzmfqf3jkgem9wgsyuctwdus9xgrcyqcjcgpzgfskx6eqf9hzqnteypzxz7fzypfhg6t"
+        "rddjhygrcyqezcgpzfysywmm5ypxxjemgw3hxjmn8yptk7untd9hxwg3q2d6xjcmtv4ezq7p"
+        "qxgsxzmnyyqcjqmt0wfjjq6t5v4khxsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg"
+        "3zyg3zyg3zygsxqyjw5qcqp2rzjq0gxwkzc8w6323m55m4jyxcjwmy7stt9hwkwe2qxmy8zp"
+        "sgg7jcuwz87fcqqeuqqqyqqqqlgqqqqn3qq9q9qrsgqrvgkpnmps664wgkp43l22qsgdw4ve"
+        "24aca4nymnxddlnp8vh9v2sdxlu5ywdxefsfvm0fq3sesf08uf6q9a2ke0hc9j6z6wlxg5z5"
+        "kqpu2v9wz")
+    explicit_payee = (
+        "lnbc10n1p0v27vqpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqnp"
+        "4q0n326hr8v9zprg8gsvezcch06gfaqqhde2aj730yg0durunfhv66sp5zyg3zyg3zyg3zyg"
+        "3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygsdqjv3jhxcmjd9c8g6t0dcjctywagxza9lah"
+        "zzf8yrd4m4dn8lx7q9dtf5896pfx2jc30dv2w8vw38j2kpr7trhfuqdkavr2925n2f85g0uz"
+        "ansyy5pusrwansemqp0ux0x3")
+
+    def test_spec_example(self):
+        decoded = bolt11.decode(self.coffee)
+        self.assertEqual(decoded.network, "mainnet")
+        self.assertEqual(decoded.timestamp, 1496314658)
+        self.assertEqual(decoded.payment_hash, self.payment_hash)
+        self.assertEqual(decoded.payment_addr, "11" * 32)
+        self.assertEqual(decoded.description, "1 cup coffee")
+        self.assertEqual(decoded.expiry, 60)
+        self.assertEqual(decoded.cltv_expiry, bolt11.DEFAULT_MIN_FINAL_CLTV_EXPIRY)
+        # No `n` field, recovered from the signature
+        self.assertEqual(decoded.destination, self.payee)
+
+    def test_amount_multipliers(self):
+        amounts = {
+            self.donation: 0,  # Any amount
+            self.hashed: 2000000000,  # 20m
+            self.coffee: 250000000,  # 2500u
+            self.explicit_payee: 1000,  # 10n
+            self.pico: 967878534,  # 9678785340p
+        }
+        for invoice, num_msat in amounts.items():
+            decoded = bolt11.decode(invoice)
+            self.assertEqual(decoded.num_msat, num_msat)
+            self.assertEqual(decoded.num_satoshis, num_msat // 1000)
+        self.assertEqual(bolt11.parse_hrp("lnbc1"), ("mainnet", 100000000000))
+
+    def test_amounts_are_exact(self):
+        # Past 2**53 msat a float multiplier would round
+        self.assertEqual(bolt11.parse_hrp("lnbc12345678901234567890p"),
+                         ("mainnet", 1234567890123456789))
+        with self.assertRaises(ValueError):
+            bolt11.parse_hrp("lnbc12345678901234567891p")
+
+    def test_route_hints(self):
+        decoded = bolt11.decode(self.routed)
+        self.assertEqual(decoded.route_hints, (bolt11.RouteHint(hop_hints=(
+            bolt11.HopHint(
+                node_id="029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255",
+                chan_id=72623859790382856,  # 66051x263430x1800
+                fee_base_msat=1,
+                fee_proportional_millionths=20,
+                cltv_expiry_delta=3),
+            bolt11.HopHint(
+                node_id="039e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255",
+                chan_id=217304205466536202,  # 197637x395016x2314
+                fee_base_msat=2,
+                fee_proportional_millionths=30,
+                cltv_expiry_delta=4),
+        )), ))
+
+        decoded = bolt11.decode(self.pico)
+        self.assertEqual(decoded.expiry, 604800)
+        self.assertEqual(decoded.cltv_expiry, 10)
+        self.assertEqual(decoded.route_hints, (bolt11.RouteHint(hop_hints=(
+            bolt11.HopHint(
+                node_id="03d06758583bb5154774a6eb221b1276c9e82d65bbaceca806d90e20c108f4b1c7",
+                chan_id=648041158511951873,  # 589390x3312x1
+                fee_base_msat=1000,
+                fee_proportional_millionths=2500,
+                cltv_expiry_delta=40),
+        )), ))
+
+    def test_explicit_payee(self):
+        with patch("api.lightning.bolt11.recover_pubkey") as recover_pubkey:
+            decoded = bolt11.decode(self.explicit_payee)
+        recover_pubkey.assert_not_called()
+        self.assertEqual(decoded.destination, self.payee)
+        self.assertEqual(decoded.description, "description")
+
+    def test_description_hash(self):
+        decoded = bolt11.decode(self.hashed)
+        self.assertEqual(decoded.description, "")
+        self.assertEqual(
+            decoded.description_hash,
+            hashlib.sha256(
+                b"One piece of chocolate cake, one icecream cone, one pickle, one slice "
+                b"of swiss cheese, one slice of salami, one lollypop, one piece of cherry "
+                b"pie, one sausage, one cupcake, and one slice of watermelon").hexdigest())
+        self.assertEqual(decoded.destination, self.payee)
+
+    def test_bad_checksum(self):
+        last = self.coffee[-1]
+        with self.assertRaisesRegex(ValueError, "checksum"):
+            bolt11.decode(self.coffee[:-1] + ("q" if last != "q" else "p"))
+
+
+class InvoiceSchedulerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.scheduler = InvoiceScheduler()
+        self.now = 1000000.0
+
+    def invoice(self, status, expires_in=None, expiry_height=None):
+        expires_at = None
+        if expires_in != None:
+            expires_at = datetime.fromtimestamp(self.now + expires_in, tz=dt_timezone.utc)
+        return SimpleNamespace(payment_hash="aa" * 32,
+                               status=status,
+                               expires_at=expires_at,
+                               expiry_height=expiry_height)
+
+    def intervals(self, invoice, checks, block_height=None):
+        """Intervals between the lookups of an invoice that never changes"""
+
+        self.scheduler.sync([invoice], now=self.now)
+        intervals = []
+        for i in range(checks):
+            self.scheduler.reschedule(invoice, False, block_height=block_height,
+                                      now=self.now)
+            intervals.append(self.scheduler.entries[invoice.payment_hash]["interval"])
+        return intervals
+
+    def test_invgen_is_checked_every_5_seconds(self):
+        invoice = self.invoice(LNPayment.Status.INVGEN, expires_in=3600)
+        self.assertEqual(self.intervals(invoice, 10), [5] * 10)
+
+        # And right after it expires
+        invoice = self.invoice(LNPayment.Status.INVGEN, expires_in=2)
+        self.assertEqual(self.intervals(invoice, 1), [3])
+
+    def test_locked_backs_off_up_to_300_seconds(self):
+        invoice = self.invoice(LNPayment.Status.LOCKED)
+        self.assertEqual(self.intervals(invoice, 8),
+                         [10, 20, 40, 80, 160, 300, 300, 300])
+
+        # A change starts over
+        self.scheduler.reschedule(invoice, True, now=self.now)
+        self.assertEqual(self.scheduler.entries[invoice.payment_hash]["interval"], 5)
+
+    def test_locked_near_cltv_expiry_is_checked_more_often(self):
+        invoice = self.invoice(LNPayment.Status.LOCKED, expiry_height=700003)
+        # 3 blocks left: no more than 3 minutes
+        self.assertEqual(self.intervals(invoice, 8, block_height=700000),
+                         [10, 20, 40, 80, 160, 180, 180, 180])
+        # Expired: as often as it gets
+        self.assertEqual(self.intervals(invoice, 3, block_height=700010), [5, 5, 5])
+
+    def test_due_and_forgotten_invoices(self):
+        invoice = self.invoice(LNPayment.Status.LOCKED)
+        self.scheduler.sync([invoice], now=self.now)
+        self.assertEqual(self.scheduler.pop_due(now=self.now), [invoice.payment_hash])
+
+        self.scheduler.reschedule(invoice, False, now=self.now)
+        self.assertEqual(self.scheduler.pop_due(now=self.now + 9), [])
+        self.assertEqual(self.scheduler.pop_due(now=self.now + 10), [invoice.payment_hash])
+
+        # Settled by someone else: brought forward, then dropped once looked up
+        self.scheduler.reschedule(invoice, False, now=self.now)
+        invoice.status = LNPayment.Status.SETLED
+        self.scheduler.sync([invoice], now=self.now + 1)
+        self.assertEqual(self.scheduler.pop_due(now=self.now + 1), [invoice.payment_hash])
+        self.scheduler.reschedule(invoice, True, now=self.now + 1)
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertEqual(self.scheduler.pop_due(now=self.now + 1000), [])
+
+
+@patch("api.rates.AGGREGATION", "mad")
+class AggregateRatesTest(SimpleTestCase):
+
+    def test_currencies_without_rates_are_nan(self):
+        rates = np.array([[100, np.nan, np.nan],
+                          [102, 200, np.nan],
+                          [np.nan, 202, np.nan]])
+        median, contributors = aggregate(rates, np.array([1.0, 1.0, 1.0]))
+        np.testing.assert_array_equal(median, [101, 201, np.nan])
+        np.testing.assert_array_equal(contributors, [2, 2, 0])
+
+    def test_single_source(self):
+        median, contributors = aggregate(np.array([[100, np.nan]]), np.array([1.0]))
+        np.testing.assert_array_equal(median, [100, np.nan])
+        np.testing.assert_array_equal(contributors, [1, 0])
+
+    def test_outliers_are_rejected(self):
+        rates = np.array([[99], [100], [101], [150]])
+        median, contributors = aggregate(rates, np.ones(4))
+        np.testing.assert_array_equal(median, [100])
+        np.testing.assert_array_equal(contributors, [3])
+
+        # Unless within MIN_SPREAD of the median, even if all others agree
+        rates = np.array([[100], [100], [100], [102]])
+        median, contributors = aggregate(rates, np.ones(4))
+        np.testing.assert_array_equal(median, [100])
+        np.testing.assert_array_equal(contributors, [4])
+
+    def test_stale_sources_count_by_their_weight(self):
+        fresh = np.array([[100], [110]])
+        np.testing.assert_array_equal(weighted_median(fresh, np.ones(2)), [105])
+
+        # A stale source tips an even split, however little it weighs
+        rates = np.vstack([fresh, [[112]]])
+        np.testing.assert_array_equal(
+            weighted_median(rates, np.array([1.0, 1.0, 0.1])), [110])
+        # But not the majority
+        rates = np.array([[100], [101], [102], [200]])
+        np.testing.assert_array_equal(
+            weighted_median(rates, np.array([1.0, 1.0, 1.0, 0.5])), [101])
+
+        # Without weight left it does not count at all
+        median, contributors = aggregate(np.vstack([fresh, [[112]]]),
+                                         np.array([1.0, 1.0, 0.0]))
+        np.testing.assert_array_equal(median, [105])
+        np.testing.assert_array_equal(contributors, [2])
+
+
+class OrderConsumerTest(TestCase):
+
+    def setUp(self):
+        usd = Currency.objects.create(id=1, currency=1, exchange_rate=30000)
+        publish_rates({usd.id: 30000})
+        self.maker = User.objects.create(username="maker")
+        self.taker = User.objects.create(username="taker")
+        self.outsider = User.objects.create(username="outsider")
+        self.order = Order.objects.create(type=Order.Types.BUY,
+                                          currency=usd,
+                                          status=Order.Status.CHA,
+                                          amount=300,
+                                          last_satoshis=1000000,
+                                          maker=self.maker,
+                                          taker=self.taker,
+                                          expires_at=timezone.now() + timedelta(hours=1))
+        for bond in ("maker_bond", "taker_bond", "trade_escrow"):
+            setattr(self.order, bond, LNPayment.objects.create(
+                payment_hash=hashlib.sha256(bond.encode()).hexdigest(),
+                type=LNPayment.Types.HOLD,
+                status=LNPayment.Status.LOCKED,
+                num_satoshis=10000,
+                created_at=timezone.now(),
+                expires_at=timezone.now() + timedelta(hours=1)))
+        self.order.save()
+        cache.delete_many([presence.presence_key(self.order.id, role)
+                           for role in presence.ROLES])
+
+        # database_sync_to_async would close the connection of the test
+        patcher = patch("channels.db.close_old_connections")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def consumer(self, user):
+        consumer = OrderConsumer()
+        consumer.order_id = self.order.id
+        consumer.user = user
+        consumer.send = AsyncMock()
+        return consumer
+
+    def seen(self):
+        return {role: self.order.id in presence.heartbeats([self.order.id], role)
+                for role in presence.ROLES}
+
+    def test_pushed_updates_are_heartbeats(self):
+        async_to_sync(self.consumer(self.outsider).order_update)({})
+        self.assertEqual(self.seen(), {"maker": False, "taker": False})
+
+        async_to_sync(self.consumer(self.taker).order_update)({})
+        self.assertEqual(self.seen(), {"maker": False, "taker": True})
+
+        consumer = self.consumer(self.maker)
+        async_to_sync(consumer.order_update)({})
+        self.assertEqual(self.seen(), {"maker": True, "taker": True})
+        consumer.send.assert_awaited_once()
+
+
+class FollowInvoicesTest(TestCase):
+
+    def setUp(self):
+        self.command = FollowInvoices(stdout=StringIO())
+        self.lnpayment = LNPayment.objects.create(
+            payment_hash=hashlib.sha256(b"bond").hexdigest(),
+            type=LNPayment.Types.HOLD,
+            status=LNPayment.Status.INVGEN,
+            num_satoshis=10000,
+            created_at=timezone.now(),
+            expires_at=timezone.now() + timedelta(hours=1))
+        self.accepted = SimpleNamespace(state=3, htlcs=[])
+
+    def test_streams_are_not_held_up_by_a_sweep(self):
+        answer = asyncio.Event()
+
+        async def lookup_invoice(payment_hash, timeout=None):
+            await answer.wait()
+            return self.accepted
+
+        async def scenario():
+            node = SimpleNamespace(lookup_invoice=lookup_invoice)
+            sweep = asyncio.create_task(self.command.sweep_hold_invoices(node))
+            await asyncio.sleep(0.1)
+            # The bond gets locked while the sweep still waits on LND
+            finished = await sync_to_async(self.command.handle_invoice_update)(
+                self.lnpayment.payment_hash, self.accepted)
+            self.assertFalse(finished)
+            self.assertFalse(sweep.done())
+            answer.set()
+            return await sweep
+
+        with patch.object(FollowInvoices, "update_order_status") as update:
+            report = async_to_sync(scenario)()
+
+        self.assertEqual(report["num_lookups"], 1)
+        self.assertEqual(report["num_errors"], 0)
+        # The sweep saw INVGEN -> LOCKED too, but it was applied once
+        update.assert_called_once()
+        self.lnpayment.refresh_from_db()
+        self.assertEqual(self.lnpayment.status, LNPayment.Status.LOCKED)
+
+    def test_every_cycle_is_reported(self):
+        lookups = SimpleNamespace(map=lambda lookup, hashes: [
+            (SimpleNamespace(state=0, htlcs=[]), None, 0.01) for _ in hashes
+        ])
+        with patch.object(FollowInvoices, "executor", lookups):
+            self.command.follow_hold_invoices(adaptive=False)
+
+        # Nothing changed, the timings are still written
+        report = json.loads(self.command.stdout.getvalue().splitlines()[-1])
+        self.assertEqual(report["num_lookups"], 1)
+        self.assertEqual(report["lookup_p50"], 0.01)
+        self.assertIn("wall_time", report)
+        self.assertNotIn("invoices", report)
+
+
+class BookViewTest(TestCase):
+
+    def setUp(self):
+        usd = Currency.objects.create(id=1, currency=1, exchange_rate=30000)
+        publish_rates({usd.id: 30000})
+        maker = User.objects.create(username="maker")
+        Order.objects.create(type=Order.Types.BUY,
+                             currency=usd,
+                             status=Order.Status.PUB,
+                             amount=300,
+                             last_satoshis=1000000,
+                             maker=maker,
+                             expires_at=timezone.now() + timedelta(hours=1))
+        cache.delete_many([key(c, t) for key in (book_key, stats_key)
+                           for c in Currency.currency_dict.keys()
+                           for t in Order.Types.values])
+
+    def get(self, query, **headers):
+        request = APIRequestFactory().get("/api/book/" + query, **headers)
+        return BookView.as_view()(request)
+
+    def test_unknown_currencies_and_types_are_not_found(self):
+        for query in ("?currency=99999&type=1", "?currency=99999&type=2",
+                      "?currency=0&type=5", "?currency=1&type=5"):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.get(query)
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(len(queries), 0)
+        self.assertEqual(cache.get_many([book_key(99999, 1), book_key(0, 5),
+                                         book_key(1, 5)]), {})
+
+    def test_unchanged_books_are_not_modified(self):
+        response = self.get("?currency=1&type=0")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1)
+        etag = response["ETag"]
+
+        response = self.get("?currency=1&type=0", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        # A new order changes the snapshot
+        order = Order.objects.get()
+        order.pk = None
+        with self.captureOnCommitCallbacks(execute=True):
+            order.save()
+        response = self.get("?currency=1&type=0", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 2)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class InlineExecutor:
+    """Runs the jobs right away, in the thread and connection of the test"""
+
+    def submit(self, job, *args):
+        future = Future()
+        try:
+            future.set_result(job(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def make_payout(name, **fields):
+    fields = {
+        "type": LNPayment.Types.NORM,
+        "concept": LNPayment.Concepts.PAYBUYER,
+        "status": LNPayment.Status.FLIGHT,
+        "num_satoshis": 10000,
+        "created_at": timezone.now(),
+        "expires_at": timezone.now() + timedelta(hours=1),
+        **fields,
+    }
+    return LNPayment.objects.create(
+        payment_hash=hashlib.sha256(name.encode()).hexdigest(),
+        invoice=name,
+        **fields)
+
+
+class FollowPayoutsTest(TestCase):
+
+    def setUp(self):
+        self.usd = Currency.objects.create(id=1, currency=1, exchange_rate=30000)
+        self.command = FollowPayouts(stdout=StringIO())
+        self.command.executor = InlineExecutor()
+        self.command.running = {}
+        # Destination node of the fake invoices "<node>/<n>"
+        patcher = patch.object(FollowPayouts, "destination",
+                               lambda self, invoice: invoice.split("/")[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # The workers close their connection when done, not the one of the test
+        patcher = patch.object(connection, "close")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_order(self, name, **fields):
+        payout = make_payout(name, **fields)
+        order = Order.objects.create(type=Order.Types.BUY,
+                                     currency=self.usd,
+                                     status=Order.Status.PAY,
+                                     amount=300,
+                                     last_satoshis=10000,
+                                     payout=payout,
+                                     expires_at=timezone.now() + timedelta(hours=1))
+        return order, payout
+
+    def test_a_claimed_payout_is_not_sent_again(self):
+        _, payout = self.make_order("alice/1")
+        other = FollowPayouts(stdout=StringIO())
+        self.assertTrue(self.command.claim(payout.payment_hash))
+        self.assertFalse(other.claim(payout.payment_hash))
+
+        # Nor started by another follower
+        other.executor = InlineExecutor()
+        other.running = {}
+        with patch.object(FollowPayouts, "send_payment") as send:
+            other.start_payments()
+        send.assert_not_called()
+
+    def test_payouts_lnd_rejects_are_released(self):
+        _, payout = self.make_order("alice/1")
+        with patch.object(LNNode.routerstub, "SendPaymentV2",
+                          side_effect=Exception("unable to find a path")) as send:
+            self.command.start_payments()
+        send.assert_called_once()
+
+        payout.refresh_from_db()
+        self.assertFalse(payout.in_flight)
+        self.assertEqual(payout.status, LNPayment.Status.FLIGHT)
+        self.assertEqual(list(self.command.due_payments()),
+                         [(payout.payment_hash, payout.invoice)])
+
+    def test_payouts_per_destination_are_capped(self):
+        self.command.max_per_destination = 2
+        for n in range(4):
+            self.make_order(f"alice/{n}")
+        self.make_order("bob/0")
+
+        with patch.object(FollowPayouts, "send_payment") as send:
+            self.command.start_payments()
+
+        sent = list(LNPayment.objects.filter(in_flight=True).values_list(
+            "invoice", flat=True))
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(len([i for i in sent if i.startswith("alice/")]), 2)
+        self.assertIn("bob/0", sent)
+        self.assertEqual(send.call_count, 3)
+
+    def track(self, *responses, error=None):
+        """TrackPaymentV2 streaming `responses`, or failing with `error`"""
+        return patch.object(LNNode.routerstub, "TrackPaymentV2",
+                            side_effect=error,
+                            return_value=iter(responses))
+
+    def test_payouts_lnd_never_started_are_sent_again(self):
+        _, payout = self.make_order("alice/1", in_flight=True)
+        with self.track(error=RpcError(grpc.StatusCode.NOT_FOUND)):
+            self.command.track_payments()
+
+        payout.refresh_from_db()
+        self.assertFalse(payout.in_flight)
+        self.assertEqual(payout.status, LNPayment.Status.FLIGHT)
+
+        # The next round claims and sends it
+        self.command.running = {}
+        sent = SimpleNamespace(status=2, fee_msat=1000, payment_preimage="00")
+        with patch.object(LNNode.routerstub, "SendPaymentV2",
+                          return_value=iter([sent])) as send:
+            self.command.start_payments()
+        send.assert_called_once()
+        payout.refresh_from_db()
+        self.assertEqual(payout.status, LNPayment.Status.SUCCED)
+
+    def test_tracked_payouts_that_succeeded(self):
+        order, payout = self.make_order("alice/1", in_flight=True)
+        succeeded = SimpleNamespace(status=2, fee_msat=1000, payment_preimage="00")
+        with self.track(succeeded), patch.object(
+                LNNode.routerstub, "SendPaymentV2") as send:
+            self.command.track_payments()
+        # Re-attached, never sent again
+        send.assert_not_called()
+
+        payout.refresh_from_db()
+        order.refresh_from_db()
+        self.assertEqual(payout.status, LNPayment.Status.SUCCED)
+        self.assertEqual(payout.fee, 1)
+        self.assertEqual(order.status, Order.Status.SUC)
+
+    def test_tracked_payouts_that_failed(self):
+        order, payout = self.make_order("alice/1", in_flight=True)
+        with self.track(SimpleNamespace(status=3, failure_reason=2)):
+            self.command.track_payments()
+
+        payout.refresh_from_db()
+        order.refresh_from_db()
+        self.assertFalse(payout.in_flight)
+        self.assertEqual(payout.status, LNPayment.Status.FAILRO)
+        self.assertEqual(payout.routing_attempts, 1)
+        self.assertEqual(order.status, Order.Status.FAI)
+
+    def test_only_payouts_in_flight_are_tracked(self):
+        self.make_order("alice/1")
+        with self.track() as track:
+            self.command.track_payments()
+        track.assert_not_called()
+
+
+class RpcError(grpc.RpcError):
+
+    def __init__(self, code):
+        self._code = code
+
+    def code(self):
+        return self._code
+
+
+class PayoutClaimRaceTest(TransactionTestCase):
+
+    def test_only_one_follower_wins_the_claim(self):
+        payout = make_payout("alice/1")
+        followers = 8
+        barrier = threading.Barrier(followers)
+
+        def claim(_):
+            try:
+                barrier.wait()
+                return FollowPayouts().claim(payout.payment_hash)
+            finally:
+                connection.close()
+
+        # Every follower on its own connection, all at the same time
+        with ThreadPoolExecutor(max_workers=followers) as executor:
+            claims = list(executor.map(claim, range(followers)))
+
+        self.assertEqual(claims.count(True), 1)
+        payout.refresh_from_db()
+        self.assertTrue(payout.in_flight)
+
+
+class MarketStatsTest(TestCase):
+
+    def setUp(self):
+        self.usd = Currency.objects.create(id=1, currency=1, exchange_rate=30000)
+        self.now = datetime(2022, 5, 2, 12, 15, tzinfo=dt_timezone.utc)
+        redis = get_redis_connection("default")
+        redis.delete(stats.LIFETIME_KEY, stats.HOURS_READY_KEY, *[
+            stats.hour_key(self.now - timedelta(hours=hours)) for hours in range(26)])
+
+    def tick(self, timestamp, volume):
+        return MarketTick.objects.create(price=30000, volume=volume, premium=1,
+                                         currency=self.usd, timestamp=timestamp)
+
+    def market_stats(self):
+        with patch("api.stats.timezone.now", return_value=self.now):
+            return stats.market_stats()
+
+    def test_last_day_is_the_last_24_hours(self):
+        self.tick(self.now - timedelta(hours=24, minutes=50), 0.8)  # 11:25, out
+        self.tick(self.now - timedelta(hours=23, minutes=45), 0.1)  # 12:30, 3/4 in
+        self.tick(self.now - timedelta(hours=23), 0.2)
+        self.tick(self.now - timedelta(minutes=10), 0.4)
+
+        self.assertAlmostEqual(self.market_stats()["last_day_volume"], 0.675)
+
+    def test_ticks_are_counted_once(self):
+        self.tick(self.now - timedelta(hours=1), 0.1)
+        self.assertAlmostEqual(self.market_stats()["lifetime_volume"], 0.1)
+
+        # Already in the rebuilt totals
+        with patch("api.stats.timezone.now", return_value=self.now):
+            stats.record_tick(self.tick(self.now - timedelta(minutes=1), 0.2))
+        self.assertAlmostEqual(self.market_stats()["lifetime_volume"], 0.1)
+
+        # Added on top
+        stats.record_tick(self.tick(self.now + timedelta(minutes=1), 0.4))
+        self.now += timedelta(minutes=2)
+        result = self.market_stats()
+        self.assertAlmostEqual(result["lifetime_volume"], 0.5)
+        self.assertAlmostEqual(result["last_day_volume"], 0.5)
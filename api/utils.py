@@ -2,6 +2,8 @@ import requests, ring, os
 from decouple import config
 import numpy as np
 import requests
+from contextlib import contextmanager
+from django.db import connection
 
 from api.models import Order
 
@@ -12,56 +14,6 @@ def get_tor_session():
                        'https': 'socks5://127.0.0.1:9050'}
     return session
 
-market_cache = {}
-@ring.dict(market_cache, expire=3)  # keeps in cache for 3 seconds
-def get_exchange_rates(currencies):
-    """
-    Params: list of currency codes.
-    Checks for exchange rates in several public APIs.
-    Returns the median price list.
-    """
-
-    session = get_tor_session()
-
-    APIS = config("MARKET_PRICE_APIS",
-                  cast=lambda v: [s.strip() for s in v.split(",")])
-
-    api_rates = []
-    for api_url in APIS:
-        try:  # If one API is unavailable pass
-            if "blockchain.info" in api_url:
-                blockchain_prices = session.get(api_url).json()
-                blockchain_rates = []
-                for currency in currencies:
-                    try:  # If a currency is missing place a None
-                        blockchain_rates.append(
-                            float(blockchain_prices[currency]["last"]))
-                    except:
-                        blockchain_rates.append(np.nan)
-                api_rates.append(blockchain_rates)
-
-            elif "yadio.io" in api_url:
-                yadio_prices = session.get(api_url).json()
-                yadio_rates = []
-                for currency in currencies:
-                    try:
-                        yadio_rates.append(float(
-                            yadio_prices["BTC"][currency]))
-                    except:
-                        yadio_rates.append(np.nan)
-                api_rates.append(yadio_rates)
-        except:
-            pass
-
-    if len(api_rates) == 0:
-        return None  # Wops there is not API available!
-
-    exchange_rates = np.array(api_rates)
-    median_rates = np.nanmedian(exchange_rates, axis=0)
-
-    return median_rates.tolist()
-
-
 def get_lnd_version():
 
     # If dockerized, return LND_VERSION envvar used for docker image.
@@ -113,16 +65,15 @@ def compute_premium_percentile(order):
     return round(np.sum(rates < order_rate) / len(rates), 2)
 
 
-def compute_avg_premium(queryset):
-    weighted_premiums = []
-    volumes = []
+@contextmanager
+def count_queries():
+    """Yields the list of the SQL queries run inside the block so far"""
+
+    queries = []
 
-    # We exclude BTC, as LN <-> BTC swap premiums should not be  mixed with FIAT.
-    for tick in queryset.exclude(currency=1000):
-        weighted_premiums.append(tick.premium * tick.volume)
-        volumes.append(tick.volume)
+    def count(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
 
-    total_volume = sum(volumes)
-    # Avg_premium is the weighted average of the premiums by volume
-    avg_premium = sum(weighted_premiums) / total_volume
-    return avg_premium, total_volume
\ No newline at end of file
+    with connection.execute_wrapper(count):
+        yield queries
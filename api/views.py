@@ -1,6 +1,6 @@
 import os
 from re import T
-from django.db.models import Sum, Q
+from django.db.models import Q
 from rest_framework import status, viewsets
 from rest_framework.generics import CreateAPIView, ListAPIView
 from rest_framework.views import APIView
@@ -12,12 +12,16 @@ from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.models import User
 
 from api.serializers import ListOrderSerializer, MakeOrderSerializer, UpdateOrderSerializer, ClaimRewardSerializer, PriceSerializer, UserGenSerializer
-from api.models import LNPayment, MarketTick, Order, Currency, Profile
+from api.models import LNPayment, Order, Currency, Profile
 from control.models import AccountingDay
 from api.logics import Logics
 from api.messages import Telegram
 from secrets import token_urlsafe
-from api.utils import get_lnd_version, get_commit_robosats, compute_premium_percentile, compute_avg_premium
+from api.utils import get_lnd_version, get_commit_robosats, compute_premium_percentile, count_queries
+from api.book import get_book, book_stats
+from api.stats import market_stats, last_ticks
+from api.longpoll import order_version
+from api import presence
 
 from .nick_generator.nick_generator import NickGenerator
 from robohash import Robohash
@@ -25,6 +29,7 @@ from scipy.stats import entropy
 from math import log2
 import numpy as np
 import hashlib
+import json
 from pathlib import Path
 from datetime import timedelta, datetime
 from django.utils import timezone
@@ -158,6 +163,30 @@ class OrderView(viewsets.ViewSet):
     serializer_class = UpdateOrderSerializer
     lookup_url_kwarg = "order_id"
 
+    # Most queries OrderView.get may run for an order in each status, whoever asks.
+    # Pinned by the tests, overruns in production are logged.
+    query_budget = {
+        Order.Status.WFB: 1,
+        Order.Status.PUB: 3,
+        Order.Status.PAU: 3,
+        Order.Status.TAK: 1,
+        Order.Status.UCA: 1,
+        Order.Status.EXP: 1,
+        Order.Status.WF2: 5,
+        Order.Status.WFE: 5,
+        Order.Status.WFI: 1,
+        Order.Status.CHA: 1,
+        Order.Status.FSE: 1,
+        Order.Status.DIS: 1,
+        Order.Status.CCA: 1,
+        Order.Status.PAY: 1,
+        Order.Status.SUC: 1,
+        Order.Status.FAI: 2,
+        Order.Status.WFR: 1,
+        Order.Status.MLD: 1,
+        Order.Status.TLD: 1,
+    }
+
     def get(self, request, format=None):
         """
         Full trade pipeline takes place while looking/refreshing the order page.
@@ -179,24 +208,74 @@ class OrderView(viewsets.ViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        order = Order.objects.filter(id=order_id)
+        # For long-polling: ?since=<version> is answered when the order changes.
+        # Read before the order, so a change committed in between is not marked
+        # as already seen by the client.
+        version = order_version(order_id)
+
+        with count_queries() as queries:
+            order = self.order_queryset().filter(id=order_id).first()
+
+            # check if the order is found in the db
+            if order == None:
+                return Response({"bad_request": "Invalid Order Id"},
+                                status.HTTP_404_NOT_FOUND)
+
+            # Note down that the taker/maker was here recently, so counterpart knows if the user is paying attention.
+            # A heartbeat in Redis, written to the order later by the flush_presence task.
+            if order.maker == request.user:
+                presence.heartbeat(order, "maker")
+            if order.taker == request.user:
+                presence.heartbeat(order, "taker")
+
+            data, status_code = self.order_payload(order, request.user)
+
+        if len(queries) > self.query_budget[order.status]:
+            print(f"OrderView.get ran {len(queries)} queries for order {order.id} "
+                  f"({order.get_status_display()}), its budget is "
+                  f"{self.query_budget[order.status]}")
+
+        data["version"] = version
+        # False when not served through OrderLongPoll (e.g. under WSGI): ?since=
+        # is answered right away, clients should poll at their usual interval.
+        data["long_poll"] = getattr(request, "scope", {}).get("long_poll", False)
+        return Response(data, status_code)
+
+    @classmethod
+    def order_queryset(cls):
+        """Orders with everything order_payload looks at, fetched in one query"""
+        return Order.objects.select_related(
+            "currency",
+            "maker",
+            "maker__profile",
+            "taker",
+            "taker__profile",
+            "maker_bond",
+            "taker_bond",
+            "trade_escrow",
+            "payout",
+        )
 
-        # check if exactly one order is found in the db
-        if len(order) != 1:
-            return Response({"bad_request": "Invalid Order Id"},
-                            status.HTTP_404_NOT_FOUND)
+    @classmethod
+    def order_payload(cls, order, user):
+        """What a user sees of an order. Returns (data, http status).
+        Used by OrderView.get and by the order websocket consumer (api/consumers.py).
+        The order should come from order_queryset()."""
 
-        # This is our order.
-        order = order[0]
+        # Participants use the joined user and profile, instead of fetching the profile again
+        if order.maker == user:
+            user = order.maker
+        elif order.taker == user:
+            user = order.taker
 
         # 2) If order has been cancelled
         if order.status == Order.Status.UCA:
-            return Response(
+            return (
                 {"bad_request": "This order has been cancelled by the maker"},
                 status.HTTP_400_BAD_REQUEST,
             )
         if order.status == Order.Status.CCA:
-            return Response(
+            return (
                 {
                     "bad_request":
                     "This order has been cancelled collaborativelly"
@@ -208,38 +287,29 @@ class OrderView(viewsets.ViewSet):
         data["total_secs_exp"] = order.t_to_expire(order.status)
 
         # if user is under a limit (penalty), inform him.
-        is_penalized, time_out = Logics.is_penalized(request.user)
+        is_penalized, time_out = Logics.is_penalized(user)
         if is_penalized:
-            data["penalty"] = request.user.profile.penalty_expiration
+            data["penalty"] = user.profile.penalty_expiration
 
         # Add booleans if user is maker, taker, partipant, buyer or seller
-        data["is_maker"] = order.maker == request.user
-        data["is_taker"] = order.taker == request.user
+        data["is_maker"] = order.maker == user
+        data["is_taker"] = order.taker == user
         data["is_participant"] = data["is_maker"] or data["is_taker"]
 
         # 3.a) If not a participant and order is not public, forbid.
         if not data["is_participant"] and order.status != Order.Status.PUB:
-            return Response(
+            return (
                 {"bad_request": "You are not allowed to see this order"},
                 status.HTTP_403_FORBIDDEN,
             )
 
-        # WRITE Update last_seen for maker and taker.
-        # Note down that the taker/maker was here recently, so counterpart knows if the user is paying attention.
-        if order.maker == request.user:
-            order.maker_last_seen = timezone.now()
-            order.save()
-        if order.taker == request.user:
-            order.taker_last_seen = timezone.now()
-            order.save()
-
         # Add activity status of participants based on last_seen
-        if order.taker_last_seen != None:
-            data["taker_status"] = Logics.user_activity_status(
-                order.taker_last_seen)
-        if order.maker_last_seen != None:
-            data["maker_status"] = Logics.user_activity_status(
-                order.maker_last_seen)
+        taker_status = presence.activity_status(order, "taker")
+        if taker_status != None:
+            data["taker_status"] = taker_status
+        maker_status = presence.activity_status(order, "maker")
+        if maker_status != None:
+            data["maker_status"] = maker_status
 
         # 3.b If order is between public and WF2
         if order.status >= Order.Status.PUB and order.status < Order.Status.WF2:
@@ -249,25 +319,24 @@ class OrderView(viewsets.ViewSet):
             # num similar orders, and maker information to enable telegram notifications.
             if data["is_maker"] and order.status in [Order.Status.PUB, Order.Status.PAU]:
                 data["premium_percentile"] = compute_premium_percentile(order)
-                data["num_similar_orders"] = len(
-                    Order.objects.filter(currency=order.currency,
-                                         status=Order.Status.PUB))
+                data["num_similar_orders"] = Order.objects.filter(
+                    currency=order.currency, status=Order.Status.PUB).count()
                 # Adds/generate telegram token and whether it is enabled
-                data = {**data,**Telegram.get_context(request.user)}
+                data = {**data,**Telegram.get_context(user)}
 
         # 4) Non participants can view details (but only if PUB)
         elif not data["is_participant"] and order.status != Order.Status.PUB:
-            return Response(data, status=status.HTTP_200_OK)
+            return data, status.HTTP_200_OK
 
         # For participants add positions, nicks and status as a message and hold invoices status
-        data["is_buyer"] = Logics.is_buyer(order, request.user)
-        data["is_seller"] = Logics.is_seller(order, request.user)
+        data["is_buyer"] = Logics.is_buyer(order, user)
+        data["is_seller"] = Logics.is_seller(order, user)
         data["maker_nick"] = str(order.maker)
         data["taker_nick"] = str(order.taker)
         data["status_message"] = Order.Status(order.status).label
         data["is_fiat_sent"] = order.is_fiat_sent
         data["is_disputed"] = order.is_disputed
-        data["ur_nick"] = request.user.username
+        data["ur_nick"] = user.username
 
         # Add whether hold invoices are LOCKED (ACCEPTED)
         # Is there a maker bond? If so, True if locked, False otherwise
@@ -298,27 +367,27 @@ class OrderView(viewsets.ViewSet):
                 # Seller sees the amount he sends
                 if data["is_seller"]:
                     data["trade_satoshis"] = Logics.escrow_amount(
-                        order, request.user)[1]["escrow_amount"]
+                        order, user)[1]["escrow_amount"]
                 # Buyer sees the amount he receives
                 elif data["is_buyer"]:
                     data["trade_satoshis"] = Logics.payout_amount(
-                        order, request.user)[1]["invoice_amount"]
+                        order, user)[1]["invoice_amount"]
 
         # 5) If status is 'waiting for maker bond' and user is MAKER, reply with a MAKER hold invoice.
         if order.status == Order.Status.WFB and data["is_maker"]:
-            valid, context = Logics.gen_maker_hold_invoice(order, request.user)
+            valid, context = Logics.gen_maker_hold_invoice(order, user)
             if valid:
                 data = {**data, **context}
             else:
-                return Response(context, status.HTTP_400_BAD_REQUEST)
+                return (context, status.HTTP_400_BAD_REQUEST)
 
         # 6)  If status is 'waiting for taker bond' and user is TAKER, reply with a TAKER hold invoice.
         elif order.status == Order.Status.TAK and data["is_taker"]:
-            valid, context = Logics.gen_taker_hold_invoice(order, request.user)
+            valid, context = Logics.gen_taker_hold_invoice(order, user)
             if valid:
                 data = {**data, **context}
             else:
-                return Response(context, status.HTTP_400_BAD_REQUEST)
+                return (context, status.HTTP_400_BAD_REQUEST)
 
         # 7 a. ) If seller and status is 'WF2' or 'WFE'
         elif data["is_seller"] and (order.status == Order.Status.WF2
@@ -327,11 +396,11 @@ class OrderView(viewsets.ViewSet):
             if (order.maker_bond.status == order.taker_bond.status ==
                     LNPayment.Status.LOCKED):
                 valid, context = Logics.gen_escrow_hold_invoice(
-                    order, request.user)
+                    order, user)
                 if valid:
                     data = {**data, **context}
                 else:
-                    return Response(context, status.HTTP_400_BAD_REQUEST)
+                    return (context, status.HTTP_400_BAD_REQUEST)
 
         # 7.b) If user is Buyer and status is 'WF2' or 'WFI'
         elif data["is_buyer"] and (order.status == Order.Status.WF2
@@ -340,11 +409,11 @@ class OrderView(viewsets.ViewSet):
             # If the two bonds are locked, reply with an AMOUNT so he can send the buyer invoice.
             if (order.maker_bond.status == order.taker_bond.status ==
                     LNPayment.Status.LOCKED):
-                valid, context = Logics.payout_amount(order, request.user)
+                valid, context = Logics.payout_amount(order, user)
                 if valid:
                     data = {**data, **context}
                 else:
-                    return Response(context, status.HTTP_400_BAD_REQUEST)
+                    return (context, status.HTTP_400_BAD_REQUEST)
 
         # 8) If status is 'CHA' or 'FSE' and all HTLCS are in LOCKED
         elif order.status in [
@@ -376,7 +445,7 @@ class OrderView(viewsets.ViewSet):
 
         # 9) If status is 'Failed routing', reply with retry amounts, time of next retry and ask for invoice at third.
         elif (order.status == Order.Status.FAI
-              and order.payout.receiver == request.user
+              and order.payout.receiver == user
               ):  # might not be the buyer if after a dispute where winner wins
             data["retries"] = order.payout.routing_attempts
             data["next_retry_time"] = order.payout.last_routing_time + timedelta(
@@ -387,7 +456,7 @@ class OrderView(viewsets.ViewSet):
             if order.payout.status == LNPayment.Status.EXPIRE:
                 data["invoice_expired"] = True
                 # Add invoice amount once again if invoice was expired.
-                data["invoice_amount"] = Logics.payout_amount(order,request.user)[1]["invoice_amount"]
+                data["invoice_amount"] = Logics.payout_amount(order,user)[1]["invoice_amount"]
 
         # 10) If status is 'Expired', "Sending", "Finished" or "failed routing", add info for renewal:
         elif order.status in [Order.Status.EXP, Order.Status.SUC, Order.Status.PAY,  Order.Status.FAI]:
@@ -400,7 +469,7 @@ class OrderView(viewsets.ViewSet):
                 data["expiry_reason"] = order.expiry_reason
                 data["expiry_message"] = Order.ExpiryReasons(order.expiry_reason).label
             
-        return Response(data, status.HTTP_200_OK)
+        return (data, status.HTTP_200_OK)
 
     def take_update_confirm_dispute_cancel(self, request, format=None):
         """
@@ -778,87 +847,46 @@ class BookView(ListAPIView):
     queryset = Order.objects.filter(status=Order.Status.PUB)
 
     def get(self, request, format=None):
+        """Served from the book snapshots (api/book.py), no database queries.
+        Supports conditional requests (ETag / If-None-Match)."""
         currency = request.GET.get("currency")
         type = request.GET.get("type")
 
-        queryset = Order.objects.filter(status=Order.Status.PUB)
-
         # Currency 0 and type 2 are special cases treated as "ANY". (These are not really possible choices)
-        if int(currency) == 0 and int(type) != 2:
-            queryset = Order.objects.filter(type=type, status=Order.Status.PUB)
-        elif int(type) == 2 and int(currency) != 0:
-            queryset = Order.objects.filter(currency=currency,
-                                            status=Order.Status.PUB)
-        elif not (int(currency) == 0 and int(type) == 2):
-            queryset = Order.objects.filter(currency=currency,
-                                            type=type,
-                                            status=Order.Status.PUB)
-
-        if len(queryset) == 0:
+        book_data = get_book(currency, type)
+
+        if len(book_data) == 0:
             return Response(
                 {"not_found": "No orders found, be the first to make one"},
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        book_data = []
-        for order in queryset:
-            data = ListOrderSerializer(order).data
-            data["maker_nick"] = str(order.maker)
-
-            # Compute current premium for those orders that are explicitly priced.
-            data["price"], data["premium"] = Logics.price_and_premium_now(
-                order)
-            data["maker_status"] = Logics.user_activity_status(
-                order.maker_last_seen)
-            for key in ("status","taker"):  # Non participants should not see the status or who is the taker
-                del data[key]
+        etag = '"' + hashlib.md5(
+            json.dumps(book_data, sort_keys=True, default=str).encode()).hexdigest() + '"'
+        if request.META.get("HTTP_IF_NONE_MATCH") == etag:
+            return Response(status=status.HTTP_304_NOT_MODIFIED,
+                            headers={"ETag": etag})
 
-            book_data.append(data)
-
-        return Response(book_data, status=status.HTTP_200_OK)
+        return Response(book_data, status=status.HTTP_200_OK, headers={"ETag": etag})
 
 class InfoView(ListAPIView):
 
     def get(self, request):
         context = {}
 
-        context["num_public_buy_orders"] = len(
-            Order.objects.filter(type=Order.Types.BUY,
-                                 status=Order.Status.PUB))
-        context["num_public_sell_orders"] = len(
-            Order.objects.filter(type=Order.Types.SELL,
-                                 status=Order.Status.PUB))
-        context["book_liquidity"] = Order.objects.filter(status=Order.Status.PUB).aggregate(Sum('last_satoshis'))['last_satoshis__sum']
-        context["book_liquidity"] = 0 if context["book_liquidity"] == None else context["book_liquidity"]
+        num_orders, liquidity = book_stats()
+        context["num_public_buy_orders"] = num_orders[Order.Types.BUY]
+        context["num_public_sell_orders"] = num_orders[Order.Types.SELL]
+        context["book_liquidity"] = liquidity
 
         # Number of active users (logged in in last 30 minutes)
         today = datetime.today()
         context["active_robots_today"] = len(
             User.objects.filter(last_login__day=today.day))
 
-        # Compute average premium and volume of today
-        last_day = timezone.now() - timedelta(days=1)
-        queryset = MarketTick.objects.filter(timestamp__gt=last_day)
-        if not len(queryset) == 0:
-            avg_premium, total_volume = compute_avg_premium(queryset)
-        # If no contracts, fallback to lifetime avg premium
-        else:
-            queryset = MarketTick.objects.all()
-            avg_premium, _ = compute_avg_premium(queryset)
-            total_volume = 0
-
-        queryset = MarketTick.objects.all()
-        if not len(queryset) == 0:
-            volume_contracted = []
-            for tick in queryset:
-                volume_contracted.append(tick.volume)
-            lifetime_volume = sum(volume_contracted)
-        else:
-            lifetime_volume = 0
+        # Average premium and volume of today, lifetime volume. Running totals.
+        context.update(market_stats())
 
-        context["last_day_nonkyc_btc_premium"] = round(avg_premium, 2)
-        context["last_day_volume"] = total_volume
-        context["lifetime_volume"] = lifetime_volume
         context["lnd_version"] = get_lnd_version()
         context["robosats_running_commit_hash"] = get_commit_robosats()
         context["alternative_site"] = config("ALTERNATIVE_SITE")
@@ -920,23 +948,7 @@ class PriceView(CreateAPIView):
 
     def get(self, request):
 
-        payload = {}
-        queryset = Currency.objects.all().order_by('currency')
-
-        for currency in queryset:
-            code = Currency.currency_dict[str(currency.currency)]
-            try:
-                last_tick = MarketTick.objects.filter(currency=currency).latest('timestamp')
-                payload[code] = {
-                    'price': last_tick.price,
-                    'volume': last_tick.volume,
-                    'premium': last_tick.premium,
-                    'timestamp': last_tick.timestamp,
-                }
-            except:
-                payload[code] = None
-
-        return Response(payload, status.HTTP_200_OK)
+        return Response(last_ticks(), status.HTTP_200_OK)
 
 class LimitView(ListAPIView):
 
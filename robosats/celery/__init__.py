@@ -55,6 +55,14 @@ app.conf.beat_schedule = {
         "task": "cache_external_market_prices",
         "schedule": timedelta(seconds=60),
     },
+    "prune-rate-history": {  # Downsamples and expires the exchange rate history every hour
+        "task": "prune_rate_history",
+        "schedule": timedelta(hours=1),
+    },
+    "flush-presence": {  # Writes maker/taker last seen heartbeats to the orders every minute
+        "task": "flush_presence",
+        "schedule": timedelta(seconds=60),
+    },
 }
 
 app.conf.timezone = "UTC"
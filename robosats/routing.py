@@ -1,12 +1,17 @@
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
+from django.core.asgi import get_asgi_application
+from api.longpoll import OrderLongPoll
 import chat.routing
+import api.routing
 
 application = ProtocolTypeRouter({
+    "http":
+    OrderLongPoll(get_asgi_application()),
     "websocket":
     AuthMiddlewareStack(
         URLRouter(
-            chat.routing.websocket_urlpatterns,
-            # TODO add api.routing.websocket_urlpatterns when Order page works with websocket
+            chat.routing.websocket_urlpatterns +
+            api.routing.websocket_urlpatterns
         )),
 })